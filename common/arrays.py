@@ -0,0 +1,56 @@
+import numpy as np
+from sqlalchemy import LargeBinary
+from sqlalchemy.types import TypeDecorator
+
+
+# Cabeçalho: ndim seguido das dimensões, todos int64 little-endian. Com 8 bytes por campo
+# os dados começam alinhados, e np.frombuffer lê direto do bytea sem copiar.
+HEADER_DTYPE = np.dtype('<i8')
+
+
+def pack_array(values, dtype='<f8'):
+    """
+    Serializa um array (ou lista aninhada retangular) em bytes: cabeçalho com o formato
+    e os dados em `dtype` little-endian.
+    :return: bytes, ou None se não houver valores
+    """
+    if values is None:
+        return None
+    array = np.ascontiguousarray(values, dtype=dtype)
+    if array.size == 0:
+        return None
+    header = np.array((array.ndim,) + array.shape, dtype=HEADER_DTYPE)
+    return header.tobytes() + array.tobytes()
+
+
+def unpack_array(data, dtype='<f8'):
+    """
+    Lê os bytes gravados por pack_array como ndarray somente leitura que aponta para o
+    próprio buffer (sem cópia).
+    """
+    if data is None:
+        return None
+    ndim = int(np.frombuffer(data, dtype=HEADER_DTYPE, count=1)[0])
+    shape = tuple(np.frombuffer(data, dtype=HEADER_DTYPE, count=ndim, offset=HEADER_DTYPE.itemsize))
+    offset = HEADER_DTYPE.itemsize * (ndim + 1)
+    return np.frombuffer(data, dtype=dtype, offset=offset).reshape(shape)
+
+
+class PackedArray(TypeDecorator):
+    """
+    Coluna bytea/BLOB com um array NumPy compactado por pack_array.
+    Aceita ndarray ou listas na gravação e devolve ndarray na leitura.
+    """
+
+    impl = LargeBinary
+    cache_ok = True
+
+    def __init__(self, dtype='<f8'):
+        super().__init__()
+        self.dtype = np.dtype(dtype).str
+
+    def process_bind_param(self, value, dialect):
+        return pack_array(value, self.dtype)
+
+    def process_result_value(self, value, dialect):
+        return unpack_array(value, self.dtype)
@@ -0,0 +1,25 @@
+import numpy as np
+
+
+def band_edges(energies, occupied):
+    """
+    Calcula VBM, CBM, gap fundamental e gap direto.
+    :param energies: autovalores em eV no formato (spin, kpoint, band)
+    :param occupied: máscara booleana com o mesmo formato indicando os estados ocupados
+    :return: dict com os valores em eV, ou None se não houver estados ocupados e vazios
+    """
+    if not occupied.any() or occupied.all():
+        return None
+
+    # Extremos por k-point, reduzindo sobre spin e banda
+    valence = np.where(occupied, energies, -np.inf).max(axis=(0, 2))
+    conduction = np.where(occupied, np.inf, energies).min(axis=(0, 2))
+    vbm = float(valence.max())
+    cbm = float(conduction.min())
+
+    return {
+        "vbm": vbm,
+        "cbm": cbm,
+        "band_gap": max(cbm - vbm, 0.0),
+        "direct_gap": max(float((conduction - valence).min()), 0.0)
+    }
@@ -0,0 +1,220 @@
+from itertools import islice
+from sqlalchemy import insert, select, update, values, column, bindparam
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import SQLAlchemyError
+
+
+BATCH_SIZE = 1000
+
+
+def iter_batches(records, size=BATCH_SIZE):
+    """Agrupa um iterável em listas de até `size` itens, sem materializar o resto."""
+    iterator = iter(records)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def _uniform(rows):
+    """Completa os dicts com None para que todas as linhas tenham as mesmas colunas (INSERT multi-linha)."""
+    keys = []
+    for row in rows:
+        keys.extend(key for key in row if key not in keys)
+    return [{key: row.get(key) for key in keys} for row in rows]
+
+
+def bulk_insert_jobs(session, job_model, status_model, file_column, records, batch_size=BATCH_SIZE, skip_existing=True,
+                     after_batch=None):
+    """
+    Grava jobs e seus status em lotes. Por lote: um SELECT das saídas já conhecidas,
+    um INSERT multi-linha dos jobs com RETURNING job_id, um INSERT multi-linha dos
+    status e um único commit, em vez de ~4 idas ao banco e 2 commits por job.
+    Se o lote falhar (ex.: outro processo gravou o mesmo conteúdo no meio tempo), ele é
+    regravado job a job, e só as saídas que falharem de novo ficam de fora (e são listadas).
+    :param file_column: coluna da tabela de status com o arquivo de saída (chave do job)
+    :param records: iterável de (valores do job, valores do status sem job_id)
+    :param skip_existing: ignora saídas que já têm job gravado
+    :param after_batch: função(session, [(job, status, job_id), ...]) chamada após os INSERTs de cada
+                        lote, na mesma transação: se ela falhar, o lote é desfeito como os demais erros
+    :return: número de jobs inseridos
+    """
+    total = 0
+    file_attr = getattr(status_model, file_column)
+    for batch in iter_batches(records, batch_size):
+        try:
+            if skip_existing:
+                files = [status[file_column] for _, status in batch]
+                known = set(session.scalars(select(file_attr).where(file_attr.in_(files))))
+                unique = []
+                for job, status in batch:
+                    if status[file_column] not in known:
+                        known.add(status[file_column])
+                        unique.append((job, status))
+                batch = unique
+            batch = _drop_known_content(session, job_model, batch)
+            if not batch:
+                continue
+
+            stored = _insert_batch(session, job_model, status_model, batch, after_batch)
+            session.commit()
+        except SQLAlchemyError as e:
+            session.rollback()
+            print(f"Erro ao gravar o lote de jobs: {e}. Gravando um job por vez.")
+            stored = _insert_one_by_one(session, job_model, status_model, file_column, batch, after_batch)
+        if not stored:
+            continue
+        total += len(stored)
+        print(f"Lote de {len(stored)} jobs gravado ({total} no total).")
+    return total
+
+
+def _insert_batch(session, job_model, status_model, batch, after_batch=None):
+    """
+    INSERTs multi-linha dos jobs e dos status de um lote e after_batch, sem commit.
+    :return: lista de ((job, status), job_id) na ordem do lote
+    """
+    job_ids = session.scalars(
+        insert(job_model).returning(job_model.job_id, sort_by_parameter_order=True),
+        _uniform([job for job, _ in batch])
+    ).all()
+    session.execute(
+        insert(status_model),
+        _uniform([dict(status, job_id=job_id) for (_, status), job_id in zip(batch, job_ids)])
+    )
+    stored = list(zip(batch, job_ids))
+    if after_batch:
+        after_batch(session, [(job, status, job_id) for (job, status), job_id in stored])
+    return stored
+
+
+def _insert_one_by_one(session, job_model, status_model, file_column, batch, after_batch=None):
+    """
+    Regrava um lote que falhou com um commit por job, para que uma linha ruim não
+    descarte as demais. :return: lista de ((job, status), job_id) gravados
+    """
+    stored = []
+    for record in batch:
+        try:
+            written = _insert_batch(session, job_model, status_model, [record], after_batch)
+            session.commit()
+            stored.extend(written)
+        except SQLAlchemyError as e:
+            session.rollback()
+            print(f"Erro ao gravar {record[1].get(file_column)}: {e}")
+    if len(stored) < len(batch):
+        print(f"{len(batch) - len(stored)} saídas do lote não foram gravadas.")
+    return stored
+
+
+def _drop_known_content(session, job_model, batch):
+    """
+    Remove do lote os jobs cujo content_hash já está gravado ou se repete no lote
+    (o índice único rejeitaria o lote inteiro).
+    """
+    hash_attr = getattr(job_model, 'content_hash', None)
+    hashes = [job['content_hash'] for job, _ in batch if job.get('content_hash')]
+    if hash_attr is None or not hashes:
+        return batch
+    known = set(session.scalars(select(hash_attr).where(hash_attr.in_(hashes))))
+    unique = []
+    for job, status in batch:
+        content_hash = job.get('content_hash')
+        if content_hash in known:
+            continue
+        if content_hash:
+            known.add(content_hash)
+        unique.append((job, status))
+    if len(unique) < len(batch):
+        print(f"{len(batch) - len(unique)} saídas com conteúdo já gravado ignoradas.")
+    return unique
+
+
+def _required_columns(model):
+    """Colunas sem as quais uma linha nova não pode ser inserida (NOT NULL sem default)."""
+    return {
+        column.key for column in model.__table__.columns
+        if not column.nullable and not column.primary_key and column.default is None and column.server_default is None
+    }
+
+
+def _insert_on_conflict(session, model, group, columns, conflict_column, updates, dialect):
+    dialect_insert = postgresql.insert if dialect == 'postgresql' else sqlite.insert
+    stmt = dialect_insert(model).values(group)
+    if updates:
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[conflict_column],
+            set_={column: stmt.excluded[column] for column in updates}
+        )
+    else:
+        stmt = stmt.on_conflict_do_nothing(index_elements=[conflict_column])
+    session.execute(stmt)
+
+
+def _update_from_values(session, model, group, columns, conflict_column, updates, dialect):
+    key = getattr(model, conflict_column)
+    if dialect != 'postgresql':
+        stmt = update(model.__table__).where(key == bindparam('_key')).values({name: bindparam(name) for name in updates})
+        session.execute(stmt, [dict({name: row[name] for name in updates}, _key=row[conflict_column]) for row in group])
+        return
+    # UPDATE ... FROM (VALUES ...): todas as alterações em uma única instrução
+    table = model.__table__.c
+    changes = values(*[column(name, table[name].type) for name in columns], name='changes').data(
+        [tuple(row[name] for name in columns) for row in group]
+    )
+    session.execute(
+        update(model)
+        .where(key == changes.c[conflict_column])
+        .values({name: changes.c[name] for name in updates})
+    )
+
+
+def write_rows(session, model, rows, conflict_column='job_id', update_columns=None):
+    """
+    Executa as instruções de upsert_rows dentro da transação corrente, sem commit e sem
+    tratar erros: para gravar junto com outras alterações que devem valer ou falhar juntas.
+    """
+    if isinstance(rows, dict):
+        rows = [rows]
+    dialect = session.get_bind().dialect.name
+    required = _required_columns(model)
+
+    # Linhas com as mesmas colunas vão juntas na mesma instrução
+    groups = {}
+    for row in rows:
+        groups.setdefault(tuple(row), []).append(row)
+    for columns, group in groups.items():
+        # A mesma chave duas vezes na mesma instrução não é aceita: vale a última alteração
+        group = list({row[conflict_column]: row for row in group}.values())
+        updates = [
+            column for column in columns
+            if column != conflict_column and (update_columns is None or column in update_columns)
+        ]
+        if required.issubset(columns):
+            _insert_on_conflict(session, model, group, columns, conflict_column, updates, dialect)
+        elif updates:
+            _update_from_values(session, model, group, columns, conflict_column, updates, dialect)
+    return len(rows)
+
+
+def upsert_rows(session, model, rows, conflict_column='job_id', update_columns=None):
+    """
+    Grava uma ou várias linhas numa tabela com chave única em conflict_column, com uma
+    instrução por conjunto de colunas e um único commit:
+    - linhas completas: INSERT ... ON CONFLICT (conflict_column) DO UPDATE;
+    - alterações parciais (ex.: só job_id e status), que não podem gerar uma linha nova
+      por faltar colunas NOT NULL: UPDATE ... FROM (VALUES ...).
+    Só as colunas presentes em cada linha são atualizadas; o restante é preservado.
+    :param rows: dict ou lista de dicts coluna -> valor
+    :param update_columns: se dado, limita as colunas atualizadas quando a linha já existe
+    :return: número de linhas gravadas ou None em caso de erro
+    """
+    try:
+        count = write_rows(session, model, rows, conflict_column, update_columns)
+        session.commit()
+        return count
+    except SQLAlchemyError as e:
+        session.rollback()
+        print(f"Erro ao gravar o status: {e}")
+        return None
@@ -0,0 +1,170 @@
+import os
+import time
+import pickle
+import sqlite3
+import threading
+import zlib
+import inspect
+import functools
+import dotenv
+
+
+dotenv.load_dotenv()
+
+# PARSE_CACHE_DIR vazio usa o diretório padrão; 'off' ou '0' desativa o cache
+CACHE_DIR = os.getenv('PARSE_CACHE_DIR') or os.path.join(os.path.expanduser('~'), '.cache', 'moquecaufes')
+MAX_BYTES = int(os.getenv('PARSE_CACHE_MAX_BYTES') or 2 * 1024 ** 3)
+# Após exceder o limite, remove as entradas menos usadas até esta fração dele
+EVICT_TO = 0.9
+LOCK_TIMEOUT = 30  # s de espera pelo lock do SQLite quando vários processos gravam
+COMPRESSION_LEVEL = 1
+
+_MISSING = object()
+
+
+class ParseCache:
+    """
+    Cache local (SQLite em modo WAL) dos resultados dos parsers, chaveado pela identidade
+    do arquivo (caminho, tamanho, mtime_ns, inode) e pela versão do parser.
+    Os valores são gravados como pickle comprimido com zlib. Vários processos podem ler e
+    gravar ao mesmo tempo; ao passar de `max_bytes`, as entradas usadas há mais tempo saem.
+    Qualquer erro do cache vira um miss: o parser roda normalmente.
+    """
+
+    def __init__(self, directory=CACHE_DIR, max_bytes=MAX_BYTES):
+        self.path = os.path.join(directory, 'parse_cache.sqlite')
+        self.max_bytes = max_bytes
+        self._local = threading.local()
+        self._warned = False
+
+    def _connection(self):
+        # Uma conexão por thread e por processo (conexões SQLite não sobrevivem a um fork)
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None and self._local.pid == os.getpid():
+            return connection
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        connection = sqlite3.connect(self.path, timeout=LOCK_TIMEOUT, isolation_level=None)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.execute(
+            """CREATE TABLE IF NOT EXISTS entries (
+                key TEXT PRIMARY KEY,
+                value BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                last_used REAL NOT NULL
+            )"""
+        )
+        connection.execute("CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used)")
+        self._local.connection = connection
+        self._local.pid = os.getpid()
+        return connection
+
+    def _warn(self, error):
+        if not self._warned:
+            print(f"Aviso: cache de parsing indisponível ({error}). Os arquivos serão lidos normalmente.")
+            self._warned = True
+
+    @staticmethod
+    def file_key(file_path):
+        """Identidade do arquivo: (caminho real, tamanho, mtime_ns, inode), ou None se não existir."""
+        try:
+            path = os.path.realpath(file_path)
+            stat = os.stat(path)
+        except (OSError, TypeError, ValueError):
+            return None
+        return path, stat.st_size, stat.st_mtime_ns, stat.st_ino
+
+    def get(self, key):
+        try:
+            connection = self._connection()
+            row = connection.execute("SELECT value FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return _MISSING
+            connection.execute("UPDATE entries SET last_used = ? WHERE key = ?", (time.time(), key))
+            return pickle.loads(zlib.decompress(row[0]))
+        except (sqlite3.Error, OSError, pickle.UnpicklingError, zlib.error, EOFError, AttributeError) as e:
+            self._warn(e)
+            return _MISSING
+
+    def put(self, key, value):
+        try:
+            data = zlib.compress(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL), COMPRESSION_LEVEL)
+            if len(data) > self.max_bytes:
+                return
+            connection = self._connection()
+            connection.execute(
+                "INSERT OR REPLACE INTO entries (key, value, size, last_used) VALUES (?, ?, ?, ?)",
+                (key, data, len(data), time.time())
+            )
+            self._evict(connection)
+        except (sqlite3.Error, OSError, pickle.PicklingError, TypeError) as e:
+            self._warn(e)
+
+    def _evict(self, connection):
+        total = connection.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        target = total - int(self.max_bytes * EVICT_TO)
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            freed = 0
+            for key, size in connection.execute("SELECT key, size FROM entries ORDER BY last_used").fetchall():
+                if freed >= target:
+                    break
+                connection.execute("DELETE FROM entries WHERE key = ?", (key,))
+                freed += size
+            connection.execute("COMMIT")
+        except sqlite3.Error:
+            connection.execute("ROLLBACK")
+            raise
+
+    def clear(self):
+        try:
+            self._connection().execute("DELETE FROM entries")
+        except sqlite3.Error as e:
+            self._warn(e)
+
+
+def _enabled():
+    return CACHE_DIR.lower() not in ('off', '0')
+
+
+parse_cache = ParseCache()
+
+
+def cached_parse(version):
+    """
+    Decorador dos parsers de arquivo: o resultado é lido do parse_cache quando o arquivo
+    (primeiro argumento) não mudou desde o último parsing com a mesma `version` e os mesmos
+    argumentos. Resultados vazios e arquivos alterados durante a leitura não são guardados.
+    :param version: versão do parser; incrementar sempre que o formato do resultado mudar
+    """
+    def decorator(function):
+        signature = inspect.signature(function)
+        name = f"{function.__module__}.{function.__qualname__}"
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _enabled():
+                return function(*args, **kwargs)
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            arguments = list(bound.arguments.items())
+            identity = ParseCache.file_key(arguments[0][1])
+            if identity is None:
+                return function(*args, **kwargs)
+
+            key = repr((name, version, identity, arguments[1:]))
+            result = parse_cache.get(key)
+            if result is not _MISSING:
+                return result
+
+            result = function(*args, **kwargs)
+            # Job ainda escrevendo a saída: o resultado não corresponde mais a esta identidade
+            if result and ParseCache.file_key(arguments[0][1]) == identity:
+                parse_cache.put(key, result)
+            return result
+
+        wrapper.uncached = function
+        return wrapper
+    return decorator
@@ -0,0 +1,188 @@
+import os
+import ast
+import json
+import threading
+from datetime import datetime
+import dotenv
+from sqlalchemy import create_engine, Column, String, Integer, DateTime, JSON, select, text
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import sessionmaker, scoped_session
+from sqlalchemy.exc import SQLAlchemyError
+from common.arrays import pack_array
+
+dotenv.load_dotenv()
+
+POOL_SIZE = int(os.getenv('DB_POOL_SIZE') or 5)
+MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW') or 10)
+POOL_RECYCLE = 1800  # s: renova conexões antes que o servidor as derrube por inatividade
+
+_lock = threading.Lock()
+_engines = {}
+_sessions = {}
+_schemas_ready = set()
+
+# Colunas JSON dos modelos: JSONB no PostgreSQL (indexável com GIN) e None gravado como
+# NULL de SQL, não como o valor JSON 'null'
+JSON_DOCUMENT = JSON(none_as_null=True).with_variant(JSONB(none_as_null=True), 'postgresql')
+
+Base = declarative_base()
+
+
+class SchemaVersion(Base):
+    """Versão do schema de cada pacote já aplicada no banco (evita create_all a cada execução)."""
+    __tablename__ = 'schema_version'
+
+    component = Column(String, primary_key=True)
+    version = Column(Integer, nullable=False)
+    updated_at = Column(DateTime)
+
+
+def database_url():
+    """URL do PostgreSQL a partir das variáveis do .env."""
+    return (
+        f"postgresql+pg8000://{os.getenv('DB_USER')}:{os.getenv('DB_PASSWORD')}"
+        f"@{os.getenv('DB_HOST')}:{os.getenv('DB_PORT')}/{os.getenv('DB_NAME')}"
+    )
+
+
+def get_engine(url=None, pool_size=POOL_SIZE, max_overflow=MAX_OVERFLOW):
+    """
+    Engine compartilhado do processo (um por URL), com pool de conexões e pre-ping,
+    então pipelines, daemon e carga em lote não abrem uma conexão nova por arquivo.
+    """
+    url = url or database_url()
+    with _lock:
+        engine = _engines.get(url)
+        if engine is None:
+            engine = create_engine(
+                url,
+                pool_size=pool_size,
+                max_overflow=max_overflow,
+                pool_pre_ping=True,
+                pool_recycle=POOL_RECYCLE
+            )
+            _engines[url] = engine
+        return engine
+
+
+def get_session(engine):
+    """
+    Sessão reaproveitada por thread para o engine (scoped_session). Depois de
+    session.close() a mesma sessão volta a ser usada pelo próximo job da thread.
+    """
+    with _lock:
+        registry = _sessions.get(engine)
+        if registry is None:
+            registry = scoped_session(sessionmaker(bind=engine))
+            _sessions[engine] = registry
+    return registry()
+
+
+def ensure_schema(engine, component, metadata, version, upgrade=None):
+    """
+    Cria/atualiza as tabelas de um pacote só quando a versão gravada em schema_version
+    difere de `version`. No caso comum custa um SELECT por processo, em vez da reflexão
+    de todas as tabelas feita pelo create_all.
+    create_all, upgrade e a gravação da versão rodam numa única transação (o PostgreSQL
+    desfaz também o DDL): se a migração falhar, o erro é propagado, nada fica pela metade
+    e a próxima execução tenta de novo. No PostgreSQL um advisory lock impede que dois
+    processos migrem o mesmo pacote ao mesmo tempo.
+    :param upgrade: função(connection) com os ajustes que o create_all não faz (ex.: update_tables)
+    :return: True se o schema foi (re)aplicado
+    """
+    key = (str(engine.url), component)
+    if key in _schemas_ready:
+        return False
+
+    current = None
+    try:
+        with engine.connect() as connection:
+            current = _schema_version(connection, component)
+    except SQLAlchemyError:
+        # Banco novo: a tabela schema_version ainda não existe
+        pass
+
+    applied = current != version
+    if applied:
+        with engine.begin() as connection:
+            if connection.dialect.name == 'postgresql':
+                connection.execute(text("SELECT pg_advisory_xact_lock(hashtext(:component))"), {"component": component})
+            SchemaVersion.__table__.create(connection, checkfirst=True)
+            # Outro processo pode ter migrado enquanto este esperava o lock
+            applied = _schema_version(connection, component) != version
+            if applied:
+                metadata.create_all(connection)
+                if upgrade:
+                    upgrade(connection)
+                table = SchemaVersion.__table__
+                updated = connection.execute(
+                    table.update().where(table.c.component == component)
+                    .values(version=version, updated_at=datetime.now())
+                )
+                if not updated.rowcount:
+                    connection.execute(table.insert().values(component=component, version=version, updated_at=datetime.now()))
+    _schemas_ready.add(key)
+    return applied
+
+
+def _schema_version(connection, component):
+    return connection.execute(
+        select(SchemaVersion.version).where(SchemaVersion.component == component)
+    ).scalar()
+
+
+def column_type(connection, table, name):
+    """Tipo (information_schema.data_type) de uma coluna no PostgreSQL, ou None se ela não existir."""
+    return connection.execute(text(
+        """SELECT data_type FROM information_schema.columns
+            WHERE table_schema = current_schema() AND table_name = :table AND column_name = :column"""
+    ), {"table": table, "column": name}).scalar()
+
+
+def migrate_to_jsonb(connection, table, columns):
+    """
+    Migração única das colunas json de uma tabela existente para jsonb; os valores
+    JSON 'null' gravados antes do none_as_null viram NULL de SQL.
+    Colunas que já são jsonb não são reescritas.
+    """
+    for name in columns:
+        if column_type(connection, table, name) != 'json':
+            continue
+        connection.execute(text(f"ALTER TABLE {table} ALTER COLUMN {name} TYPE JSONB USING {name}::jsonb"))
+        connection.execute(text(f"UPDATE {table} SET {name} = NULL WHERE {name} = 'null'::jsonb"))
+
+
+def _legacy_array(value):
+    """Lista aninhada a partir do texto antigo: repr de lista do Python ou JSON (inclusive JSON dentro de string)."""
+    while isinstance(value, str):
+        try:
+            value = json.loads(value)
+        except ValueError:
+            value = ast.literal_eval(value)
+    return value
+
+
+def migrate_to_packed(connection, table, key, columns, dtype='<f8'):
+    """
+    Migração única de colunas texto/json com listas de números para o formato de PackedArray.
+    A coluna antiga é renomeada, os valores são convertidos em Python linha a linha e
+    gravados na nova coluna bytea, e a antiga é removida. Colunas já em bytea são ignoradas.
+    """
+    for name in columns:
+        data_type = column_type(connection, table, name)
+        if data_type is None or data_type == 'bytea':
+            continue
+        legacy = f"{name}_legacy"
+        connection.execute(text(f"ALTER TABLE {table} RENAME COLUMN {name} TO {legacy}"))
+        connection.execute(text(f"ALTER TABLE {table} ADD COLUMN {name} BYTEA"))
+        rows = connection.execute(text(f"SELECT {key}, {legacy}::text FROM {table} WHERE {legacy} IS NOT NULL"))
+        updates = []
+        for row_key, value in rows:
+            try:
+                updates.append({"key": row_key, "value": pack_array(_legacy_array(value), dtype)})
+            except (ValueError, SyntaxError) as e:
+                print(f"Aviso: {table}.{name} do registro {row_key} não pôde ser convertido ({e}).")
+        if updates:
+            connection.execute(text(f"UPDATE {table} SET {name} = :value WHERE {key} = :key"), updates)
+        connection.execute(text(f"ALTER TABLE {table} DROP COLUMN {legacy}"))
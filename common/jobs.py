@@ -0,0 +1,228 @@
+import threading
+from datetime import datetime
+from sqlalchemy import Column, Integer, String, Float, DateTime, Index, PrimaryKeyConstraint, select, func, text, tuple_, event
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import Session
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import SQLAlchemyError
+from common.db import ensure_schema
+
+
+SCHEMA_VERSION = 1
+# Conversões para eV, unidade comum da coluna energy
+RY_TO_EV = 13.605693122994
+HARTREE_TO_EV = 27.211386245988
+# Valor da coluna package (o mesmo das tabelas de detalhe) -> sufixo das partições
+PARTITIONS = {'QE': 'qe', 'vasp': 'vasp', 'ORCA': 'orca'}
+CORE_COLUMNS = ('package', 'created_at', 'job_id', 'user_id', 'sys_name', 'description',
+                'status', 'output_file', 'content_hash', 'energy', 'updated_at')
+# Tentativas quando outro processo cria a mesma partição ao mesmo tempo
+PARTITION_RETRIES = 2
+
+_lock = threading.Lock()
+_partitions = set()
+
+Base = declarative_base()
+
+
+class CoreJob(Base):
+    """
+    Tabela única com as colunas comuns dos jobs de QE, VASP e ORCA. Os dados de cada
+    pacote continuam nas tabelas de detalhe (qe_jobs, vasp_jobs, orca_jobs), ligadas
+    por (package, job_id). No PostgreSQL a tabela é particionada por pacote (LIST) e,
+    dentro de cada pacote, por mês de created_at (RANGE); as partições são criadas
+    conforme os jobs chegam.
+    """
+    __tablename__ = 'jobs'
+    __table_args__ = (
+        # As chaves de partição fazem parte da chave primária (exigência do PostgreSQL)
+        PrimaryKeyConstraint('package', 'created_at', 'job_id'),
+        Index('ix_jobs_user_system_created', 'user_id', 'sys_name', 'created_at'),
+        Index('ix_jobs_package_job', 'package', 'job_id'),
+        {'postgresql_partition_by': 'LIST (package)'}
+    )
+
+    package = Column(String, nullable=False)
+    created_at = Column(DateTime, nullable=False)
+    job_id = Column(Integer, nullable=False, autoincrement=False)
+    user_id = Column(String, nullable=False)
+    sys_name = Column(String, nullable=False)
+    description = Column(String, nullable=True)
+    status = Column(String)
+    output_file = Column(String)
+    content_hash = Column(String(64))
+    # Energia total/final do job em eV
+    energy = Column(Float)
+    updated_at = Column(DateTime)
+
+
+def create_core_tables(engine):
+    """Cria a tabela jobs (uma vez por versão do schema, ver common.db.ensure_schema)."""
+    return ensure_schema(engine, 'jobs', Base.metadata, SCHEMA_VERSION)
+
+
+def _as_datetime(value):
+    if isinstance(value, str):
+        return datetime.fromisoformat(value)
+    return value
+
+
+def _month(value):
+    return datetime(value.year, value.month, 1)
+
+
+def _next_month(month):
+    return datetime(month.year + month.month // 12, month.month % 12 + 1, 1)
+
+
+def ensure_partitions(connection, package, months):
+    """
+    Cria (se preciso) a partição do pacote e as partições mensais de `months`.
+    Só no PostgreSQL; em outros bancos jobs é uma tabela comum.
+    :return: chaves (pacote, mês) criadas ou verificadas, para marcar após o commit
+    """
+    if connection.dialect.name != 'postgresql':
+        return set()
+    suffix = PARTITIONS[package]
+    checked = set()
+    for month in {_month(value) for value in months}:
+        key = (package, month)
+        if key in _partitions:
+            continue
+        if (package, None) not in _partitions and (package, None) not in checked:
+            connection.execute(text(
+                f"CREATE TABLE IF NOT EXISTS jobs_{suffix} PARTITION OF jobs "
+                f"FOR VALUES IN ('{package}') PARTITION BY RANGE (created_at)"
+            ))
+            checked.add((package, None))
+        connection.execute(text(
+            f"CREATE TABLE IF NOT EXISTS jobs_{suffix}_{month:%Y_%m} PARTITION OF jobs_{suffix} "
+            f"FOR VALUES FROM ('{month:%Y-%m-%d}') TO ('{_next_month(month):%Y-%m-%d}')"
+        ))
+        checked.add(key)
+    return checked
+
+
+def write_jobs(session, rows):
+    """
+    Grava (INSERT ... ON CONFLICT DO UPDATE) as linhas de jobs de uma lista de dicts com
+    CORE_COLUMNS dentro da transação corrente, sem commit e sem tratar erros: a linha de
+    jobs vale ou falha junto com o job e o status gravados na mesma transação.
+    O created_at de um job fica fixo na primeira gravação (é chave de partição); sem
+    created_at no detalhe, vale o momento da gravação.
+    :return: número de linhas gravadas
+    """
+    if isinstance(rows, dict):
+        rows = [rows]
+    rows = [dict(row) for row in rows if row.get('job_id') is not None]
+    if not rows:
+        return 0
+    dialect = session.get_bind().dialect.name
+    dialect_insert = postgresql.insert if dialect == 'postgresql' else sqlite.insert
+
+    keys = {(row['package'], row['job_id']) for row in rows}
+    known = {
+        (package, job_id): created_at
+        for package, job_id, created_at in session.execute(
+            select(CoreJob.package, CoreJob.job_id, CoreJob.created_at)
+            .where(tuple_(CoreJob.package, CoreJob.job_id).in_(keys))
+        )
+    }
+    now = datetime.now()
+    for row in rows:
+        row['created_at'] = (known.get((row['package'], row['job_id']))
+                             or _as_datetime(row.get('created_at')) or now)
+        row['updated_at'] = _as_datetime(row.get('updated_at')) or now
+
+    for package in {row['package'] for row in rows}:
+        months = [row['created_at'] for row in rows if row['package'] == package]
+        # As partições criadas só passam a ser conhecidas após o commit (_mark_partitions)
+        session.info.setdefault('core_partitions', set()).update(
+            ensure_partitions(session.connection(), package, months)
+        )
+
+    # A mesma chave duas vezes na mesma instrução não é aceita: vale a última linha
+    unique = {(row['package'], row['created_at'], row['job_id']): row for row in rows}
+    stmt = dialect_insert(CoreJob).values([{column: row.get(column) for column in CORE_COLUMNS}
+                                           for row in unique.values()])
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['package', 'created_at', 'job_id'],
+        set_={column: stmt.excluded[column] for column in CORE_COLUMNS
+              if column not in ('package', 'created_at', 'job_id')}
+    )
+    session.execute(stmt)
+    return len(unique)
+
+
+def record_jobs(session, rows):
+    """
+    write_jobs numa transação própria, repetida se outro processo criar a mesma partição ao
+    mesmo tempo.
+    :return: número de linhas gravadas ou None em caso de erro
+    """
+    for attempt in range(PARTITION_RETRIES):
+        try:
+            count = write_jobs(session, rows)
+            session.commit()
+            return count
+        except SQLAlchemyError as e:
+            session.rollback()
+            if attempt + 1 == PARTITION_RETRIES:
+                print(f"Erro ao gravar na tabela jobs: {e}")
+    return None
+
+
+@event.listens_for(Session, 'after_commit')
+def _mark_partitions(session):
+    checked = session.info.pop('core_partitions', None)
+    if checked:
+        with _lock:
+            _partitions.update(checked)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _forget_partitions(session):
+    # O CREATE TABLE das partições foi desfeito junto com a transação
+    session.info.pop('core_partitions', None)
+
+
+def copy_to_core(connection, package, select_sql):
+    """
+    Migração única: copia para jobs os jobs já gravados na tabela de detalhe de um pacote.
+    :param select_sql: SELECT com as colunas de CORE_COLUMNS, nessa ordem e com created_at não nulo
+    """
+    months = connection.execute(text(
+        f"SELECT DISTINCT date_trunc('month', created_at) FROM ({select_sql}) AS detail ({', '.join(CORE_COLUMNS)})"
+    )).scalars().all()
+    ensure_partitions(connection, package, months)
+    connection.execute(text(
+        f"INSERT INTO jobs ({', '.join(CORE_COLUMNS)}) {select_sql} ON CONFLICT DO NOTHING"
+    ))
+
+
+def latest_energies(session, package=None, user_id=None, since=None):
+    """
+    Energia (eV) do job mais recente de cada sistema.
+    Com `package` e `since`, o PostgreSQL lê só as partições do pacote e dos meses a partir
+    de `since`; o filtro por usuário usa o índice (user_id, sys_name, created_at).
+    :return: lista de (package, sys_name, job_id, created_at, energy)
+    """
+    ranked = select(
+        CoreJob.package, CoreJob.sys_name, CoreJob.job_id, CoreJob.created_at, CoreJob.energy,
+        func.row_number().over(
+            partition_by=(CoreJob.package, CoreJob.sys_name),
+            order_by=CoreJob.created_at.desc()
+        ).label('position')
+    ).where(CoreJob.energy.isnot(None))
+    if package is not None:
+        ranked = ranked.where(CoreJob.package == package)
+    if user_id is not None:
+        ranked = ranked.where(CoreJob.user_id == user_id)
+    if since is not None:
+        ranked = ranked.where(CoreJob.created_at >= since)
+    ranked = ranked.subquery()
+    return session.execute(
+        select(ranked.c.package, ranked.c.sys_name, ranked.c.job_id, ranked.c.created_at, ranked.c.energy)
+        .where(ranked.c.position == 1)
+        .order_by(ranked.c.package, ranked.c.sys_name)
+    ).all()
@@ -0,0 +1,317 @@
+import bz2
+import gzip
+import hashlib
+import io
+import lzma
+import os
+
+
+BLOCK_SIZE = 64 * 1024
+ENCODING = 'utf-8'
+
+# Assinaturas (magic bytes) dos formatos de compressão aceitos
+MAGIC_NUMBERS = (
+    (b'\x1f\x8b', 'gzip'),
+    (b'\xfd7zXZ\x00', 'xz'),
+    (b'BZh', 'bz2'),
+    (b'\x28\xb5\x2f\xfd', 'zstd'),
+)
+
+
+def _as_bytes(marker):
+    return marker.encode(ENCODING) if isinstance(marker, str) else marker
+
+
+def detect_compression(file_path):
+    """
+    Identifica a compressão do arquivo pelos primeiros bytes, independente da extensão.
+    :return: 'gzip', 'xz', 'bz2', 'zstd' ou None para texto puro
+    """
+    with open(file_path, 'rb') as file:
+        head = file.read(6)
+    for magic, name in MAGIC_NUMBERS:
+        if head.startswith(magic):
+            return name
+    return None
+
+
+def _open_zstd(file_path, mode):
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError(f"{file_path} está comprimido com zstd: instale o pacote 'zstandard'.")
+    return zstandard.open(file_path, mode, encoding=ENCODING if 't' in mode else None)
+
+
+def new_content_hash():
+    """Hash usado para identificar o conteúdo (descomprimido) de uma saída."""
+    return hashlib.sha256()
+
+
+class _HashingStream(io.RawIOBase):
+    """
+    Repassa as leituras de um fluxo binário atualizando o hash. Ao fechar, lê o que o
+    parser deixou de fora, para que o hash cubra sempre o arquivo inteiro.
+    """
+
+    def __init__(self, stream, content_hash):
+        super().__init__()
+        self._stream = stream
+        self._hash = content_hash
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self._stream.read(len(buffer))
+        size = len(data)
+        buffer[:size] = data
+        self._hash.update(data)
+        return size
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            while True:
+                block = self._stream.read(BLOCK_SIZE)
+                if not block:
+                    break
+                self._hash.update(block)
+        finally:
+            self._stream.close()
+            super().close()
+
+
+def open_output(file_path, mode='r', content_hash=None):
+    """
+    Abre uma saída (QE/ORCA/vasprun.xml) para leitura, descomprimindo em streaming
+    se o arquivo for .gz/.xz/.bz2/.zst. Nada é descomprimido para o disco.
+    :param mode: 'r' (texto) ou 'rb' (bytes)
+    :param content_hash: objeto de new_content_hash() atualizado com os bytes (descomprimidos)
+                         durante a própria leitura; fica completo quando o arquivo é fechado
+    :return: objeto arquivo
+    """
+    if content_hash is not None:
+        stream = io.BufferedReader(_HashingStream(open_output(file_path, 'rb'), content_hash), BLOCK_SIZE)
+        if 'b' in mode:
+            return stream
+        return io.TextIOWrapper(stream, encoding=ENCODING, errors='replace')
+
+    compression = detect_compression(file_path)
+    if compression is None:
+        return open(file_path, mode)
+
+    mode = 'rb' if 'b' in mode else 'rt'
+    if compression == 'zstd':
+        return _open_zstd(file_path, mode)
+    opener = {'gzip': gzip.open, 'xz': lzma.open, 'bz2': bz2.open}[compression]
+    if mode == 'rt':
+        return opener(file_path, mode, encoding=ENCODING, errors='replace')
+    return opener(file_path, mode)
+
+
+def _iter_blocks(file_path, block_size=BLOCK_SIZE):
+    """Lê o arquivo (descomprimido) em blocos, do início ao fim."""
+    with open_output(file_path, 'rb') as file:
+        while True:
+            block = file.read(block_size)
+            if not block:
+                return
+            yield block
+
+
+def file_content_hash(file_path):
+    """
+    Hash do conteúdo sem fazer o parsing (mesmo valor que o calculado via open_output),
+    usado para reconhecer uma saída já gravada antes de processá-la.
+    :return: hash em hexadecimal
+    """
+    content_hash = new_content_hash()
+    for block in _iter_blocks(file_path):
+        content_hash.update(block)
+    return content_hash.hexdigest()
+
+
+def combined_hash(*hashes):
+    """Hash único de um job com vários arquivos (ex.: scf + nscf do QE); os ausentes (None) ficam de fora."""
+    hashes = [value for value in hashes if value]
+    if len(hashes) <= 1:
+        return hashes[0] if hashes else None
+    return hashlib.sha256(':'.join(hashes).encode()).hexdigest()
+
+
+def read_tail(file_path, size=BLOCK_SIZE):
+    """
+    Lê apenas os últimos `size` bytes do arquivo.
+    :return: texto decodificado do final do arquivo
+    """
+    if detect_compression(file_path):
+        # Fluxo comprimido não permite ir direto ao fim: guarda só os últimos bytes
+        tail = b''
+        for block in _iter_blocks(file_path):
+            tail = (tail + block)[-size:]
+        return tail.decode(ENCODING, errors='replace')
+
+    with open(file_path, 'rb') as file:
+        file.seek(0, os.SEEK_END)
+        end = file.tell()
+        file.seek(max(0, end - size))
+        return file.read().decode(ENCODING, errors='replace')
+
+
+def rfind_marker(file_path, marker, block_size=BLOCK_SIZE, max_bytes=None):
+    """
+    Procura a última ocorrência de `marker` lendo blocos do fim para o início do arquivo.
+    O custo é proporcional à distância entre o marcador e o fim do arquivo, não ao tamanho total.
+    :param max_bytes: limita quantos bytes a partir do fim serão examinados
+    :return: offset em bytes da ocorrência ou -1
+    """
+    marker = _as_bytes(marker)
+    overlap = len(marker) - 1
+    if detect_compression(file_path):
+        return _find_last_forward(file_path, marker, block_size, max_bytes)
+
+    with open(file_path, 'rb') as file:
+        file.seek(0, os.SEEK_END)
+        end = file.tell()
+        pos = end
+        carry = b''
+        while pos > 0:
+            start = max(0, pos - block_size)
+            file.seek(start)
+            # O trecho inicial do bloco anterior cobre marcadores partidos entre blocos
+            chunk = file.read(pos - start) + carry
+            index = chunk.rfind(marker)
+            if index != -1:
+                return start + index
+            carry = chunk[:overlap] if overlap else b''
+            pos = start
+            if max_bytes is not None and end - pos >= max_bytes:
+                break
+    return -1
+
+
+def _find_last_forward(file_path, marker, block_size, max_bytes):
+    """Versão de rfind_marker para arquivos comprimidos: uma passada para frente em streaming."""
+    overlap = len(marker) - 1
+    last = -1
+    position = 0
+    carry = b''
+    for block in _iter_blocks(file_path, block_size):
+        chunk = carry + block
+        index = chunk.rfind(marker)
+        if index != -1:
+            last = position - len(carry) + index
+        carry = chunk[-overlap:] if overlap else b''
+        position += len(block)
+    if last != -1 and max_bytes is not None and position - last > max_bytes:
+        return -1
+    return last
+
+
+def tail_contains(file_path, marker, size=BLOCK_SIZE):
+    """Verifica se `marker` aparece nos últimos `size` bytes do arquivo."""
+    return rfind_marker(file_path, marker, block_size=size, max_bytes=size) != -1
+
+
+def iter_lines_from(file_path, offset=0):
+    """Itera as linhas do arquivo (decodificadas) a partir de um offset em bytes."""
+    with open_output(file_path, 'rb') as file:
+        file.seek(offset)
+        for raw in file:
+            yield raw.decode(ENCODING, errors='replace')
+
+
+def read_last_line_with(file_path, marker, block_size=BLOCK_SIZE):
+    """
+    Retorna a linha que contém a última ocorrência de `marker`, ou None.
+    Útil para valores que só interessam na última vez que aparecem (ex.: energia final).
+    """
+    offset = rfind_marker(file_path, marker, block_size=block_size)
+    if offset == -1:
+        return None
+    return next(iter_lines_from(file_path, offset), None)
+
+
+class OutputFollower:
+    """
+    Acompanha uma saída em escrita entre verificações sucessivas, lendo só os bytes novos.
+    Guarda o offset (logo após a última linha completa), o inode e o tamanho do arquivo;
+    uma linha ainda incompleta não é consumida e volta a ser lida inteira no próximo poll,
+    então um marcador partido entre duas escritas nunca se perde. Se o arquivo encolher
+    (truncado) ou trocar de inode (rotacionado/reescrito), a leitura recomeça do início.
+    on_line, se dado, recebe cada linha completa nova (ex.: um estimador de progresso).
+    """
+
+    def __init__(self, file_path, markers=(), offset=0, inode=None, on_line=None):
+        self.file_path = file_path
+        self.markers = tuple(markers)
+        self.on_line = on_line
+        self.found = set()
+        self.offset = offset
+        self.inode = inode
+        self.size = None
+        self.resets = 0
+        self._compressed = None
+
+    def reset(self):
+        """Volta ao início do arquivo, descartando os marcadores já encontrados."""
+        self.offset = 0
+        self.size = None
+        self.found = set()
+        self.resets += 1
+
+    def changed(self):
+        """
+        Confere inode e tamanho do arquivo.
+        :return: True se há bytes novos para ler
+        """
+        stat = os.stat(self.file_path)
+        if self._compressed is None:
+            self._compressed = detect_compression(self.file_path) is not None
+        rotated = self.inode is not None and stat.st_ino != self.inode
+        # Em arquivos comprimidos o offset conta bytes descomprimidos: não compara com o tamanho
+        truncated = not self._compressed and stat.st_size < self.offset
+        if rotated or truncated:
+            print(f"Aviso: {self.file_path} foi {'substituído' if rotated else 'truncado'}. Relendo desde o início.")
+            self.reset()
+            self._compressed = detect_compression(self.file_path) is not None
+        self.inode = stat.st_ino
+        if stat.st_size == self.size:
+            return False
+        self.size = stat.st_size
+        return True
+
+    def iter_new_lines(self):
+        """Gera as linhas completas escritas desde o último poll, avançando o offset a cada uma."""
+        if not self.changed():
+            return
+        with open_output(self.file_path, 'rb') as file:
+            file.seek(self.offset)
+            for raw in file:
+                line = raw.decode(ENCODING, errors='replace')
+                self._match(line)
+                if not raw.endswith(b'\n'):
+                    # Linha ainda sendo escrita: fica para o próximo poll
+                    return
+                self.offset += len(raw)
+                if self.on_line:
+                    self.on_line(line)
+                yield line
+
+    def poll(self):
+        """Lê os bytes novos. :return: lista com as linhas completas novas"""
+        return list(self.iter_new_lines())
+
+    def _match(self, line):
+        for marker in self.markers:
+            if marker in line:
+                self.found.add(marker)
+
+    def seen(self, marker):
+        return marker in self.found
+
+    def state(self):
+        """Estado mínimo para retomar o acompanhamento depois (ex.: em outro processo)."""
+        return {"offset": self.offset, "inode": self.inode, "size": self.size}
@@ -0,0 +1,142 @@
+import heapq
+import itertools
+import math
+import time
+
+
+MIN_INTERVAL = 15.0  # s
+MAX_INTERVAL = 1800.0  # s
+BACKOFF = 2.0
+# Bytes que um job costuma escrever entre dois eventos úteis (uma iteração SCF, um ciclo de otimização)
+CHUNK_BYTES = 4096
+SMOOTHING = 0.3  # peso da medida mais recente nas médias móveis
+
+
+def log_progress(first, last, target):
+    """
+    Fração concluída de uma grandeza que cai de forma aproximadamente geométrica até um
+    alvo (precisão SCF, gradiente da otimização): log(first/last) / log(first/target).
+    :return: fração entre 0 e 1, ou None sem dados suficientes
+    """
+    if not target or not first or not last:
+        return None
+    if first <= target or last <= target:
+        return 1.0
+    return min(1.0, max(0.0, math.log(first / last) / math.log(first / target)))
+
+
+class PollClock:
+    """
+    Estima quando vale a pena verificar um job de novo.
+    - Saída parada: o intervalo dobra a cada verificação (até max_interval).
+    - Saída crescendo: intervalo ~ tempo para escrever CHUNK_BYTES na taxa observada.
+    - Com progresso conhecido (fração de 0 a 1 do SCF/otimização), o intervalo não passa
+      da metade do tempo estimado até o fim, então as verificações se aproximam do término.
+    """
+
+    def __init__(self, min_interval=MIN_INTERVAL, max_interval=MAX_INTERVAL, backoff=BACKOFF):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.interval = min_interval
+        self.size = None
+        self.checked_at = None
+        self.growth_rate = None
+        self.progress = None
+        self.progress_at = None
+        self.progress_rate = None
+        self.checks = 0
+
+    def _smooth(self, previous, value):
+        return value if previous is None else SMOOTHING * value + (1 - SMOOTHING) * previous
+
+    def _observe_progress(self, progress, now):
+        if progress is None:
+            return
+        if self.progress is None or progress < self.progress:
+            # Primeiro valor ou novo ciclo (ex.: SCF de outro passo iônico)
+            self.progress, self.progress_at, self.progress_rate = progress, now, None
+        elif progress > self.progress and now > self.progress_at:
+            rate = (progress - self.progress) / (now - self.progress_at)
+            self.progress_rate = self._smooth(self.progress_rate, rate)
+            self.progress, self.progress_at = progress, now
+
+    def eta(self):
+        """Segundos estimados até o fim do ciclo corrente, ou None."""
+        if self.progress is None or not self.progress_rate:
+            return None
+        return (1.0 - self.progress) / self.progress_rate
+
+    def observe(self, size, progress=None, now=None):
+        """
+        Registra uma verificação.
+        :param size: tamanho atual da saída em bytes (None se ainda não existe)
+        :param progress: fração concluída estimada, ou None
+        :return: segundos até a próxima verificação
+        """
+        now = time.time() if now is None else now
+        self.checks += 1
+        first = self.checked_at is None
+        grew = not first and size is not None and self.size is not None and size > self.size
+        if grew and now > self.checked_at:
+            self.growth_rate = self._smooth(self.growth_rate, (size - self.size) / (now - self.checked_at))
+        self._observe_progress(progress, now)
+        self.size, self.checked_at = size, now
+
+        if first:
+            interval = self.min_interval
+        elif grew:
+            interval = CHUNK_BYTES / self.growth_rate if self.growth_rate else self.interval
+        else:
+            interval = self.interval * self.backoff
+        eta = self.eta()
+        if eta is not None:
+            interval = min(interval, eta / 2)
+        self.interval = min(max(interval, self.min_interval), self.max_interval)
+        return self.interval
+
+
+class PollScheduler:
+    """
+    Fila de prioridade (heapq) das próximas verificações. Reagendar um item substitui a
+    entrada anterior; as entradas obsoletas são descartadas quando chegam ao topo.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._due = {}
+        self._counter = itertools.count()
+
+    def __len__(self):
+        return len(self._due)
+
+    def push(self, item, delay, now=None):
+        due = (time.time() if now is None else now) + delay
+        self._due[item] = due
+        heapq.heappush(self._heap, (due, next(self._counter), item))
+
+    def discard(self, item):
+        self._due.pop(item, None)
+
+    def _drop_stale(self):
+        while self._heap and self._due.get(self._heap[0][2]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+
+    def pop_due(self, now=None):
+        """:return: itens cuja verificação já venceu, do mais atrasado ao mais recente"""
+        now = time.time() if now is None else now
+        due_items = []
+        self._drop_stale()
+        while self._heap and self._heap[0][0] <= now:
+            due, _, item = heapq.heappop(self._heap)
+            del self._due[item]
+            due_items.append(item)
+            self._drop_stale()
+        return due_items
+
+    def next_delay(self, now=None):
+        """:return: segundos até o próximo vencimento, ou None se a fila estiver vazia"""
+        self._drop_stale()
+        if not self._heap:
+            return None
+        return max(0.0, self._heap[0][0] - (time.time() if now is None else now))
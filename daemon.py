@@ -0,0 +1,50 @@
+import argparse
+from watcher.daemon import run_daemon, PIPELINE_WORKERS, TIMEOUT
+from common.scheduler import MIN_INTERVAL, MAX_INTERVAL
+from watcher.sources import SpoolSource, QueueSource
+from common.db import get_engine
+from sqlalchemy.exc import SQLAlchemyError
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Observa vários jobs em um único processo e executa a pipeline de cada um ao término")
+    parser.add_argument("--spool", help="Diretório com os pedidos em arquivos .json")
+    parser.add_argument("--queue", action="store_true", help="Lê os pedidos da tabela watch_queue")
+    parser.add_argument("--min_interval", type=float, default=MIN_INTERVAL, help="Menor intervalo entre verificações de um job, em segundos")
+    parser.add_argument("--max_interval", type=float, default=MAX_INTERVAL, help="Maior intervalo entre verificações de um job, em segundos")
+    parser.add_argument("--workers", type=int, default=PIPELINE_WORKERS, help="Pipelines executadas em paralelo")
+    parser.add_argument("--timeout", type=float, default=TIMEOUT, help="Tempo limite por job, em segundos")
+    parser.add_argument("--no_inotify", action="store_true", help="Desativa o inotify e usa apenas a varredura por stat")
+    parser.add_argument("--progressive", action="store_true", help="Grava o estado parcial dos jobs ORCA enquanto rodam")
+
+    args = parser.parse_args()
+    if not args.spool and not args.queue:
+        parser.error("informe --spool e/ou --queue")
+
+    # Um único engine para a fila e para as pipelines de todos os jobs
+    try:
+        engine = get_engine(pool_size=args.workers + 1)
+    except SQLAlchemyError as e:
+        print(f"Erro ao conectar ao DB: {e}")
+        exit(1)
+
+    sources = []
+    if args.spool:
+        sources.append(SpoolSource(args.spool))
+    if args.queue:
+        sources.append(QueueSource(engine))
+
+    run_daemon(
+        sources,
+        engine,
+        min_interval=args.min_interval,
+        max_interval=args.max_interval,
+        workers=args.workers,
+        timeout=args.timeout,
+        use_inotify=not args.no_inotify,
+        progressive=args.progressive
+    )
+
+
+if __name__ == "__main__":
+    main()
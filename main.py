@@ -16,6 +16,8 @@ def main():
     parser.add_argument("--user_id", required=True, help="ID do usuário (string)")
     parser.add_argument("--sys_name", required=True, help="Identificador do sistema estudado")
     parser.add_argument("--desc", required=False, help="Descrição do sistema, por exemplo átomos adicionados ou removidos")
+    parser.add_argument("--on_duplicate", choices=["upsert", "skip"], default="upsert",
+                        help="Saída com conteúdo já gravado: 'upsert' atualiza o job existente, 'skip' ignora sem fazer o parsing")
 
     args = parser.parse_args()
     if args.package == "QE":
@@ -44,7 +46,8 @@ def main():
             nscf_file=args.nscf_path,
             user_id=args.user_id,
             sys_name=args.sys_name,
-            desc=args.desc
+            desc=args.desc,
+            on_duplicate=args.on_duplicate
         )
 
     except Exception as e:
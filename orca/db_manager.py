@@ -1,17 +1,22 @@
-from sqlalchemy import create_engine, Column, Integer, String, Float, DateTime, JSON, Boolean, ForeignKey
+from sqlalchemy import Column, Integer, String, Float, DateTime, Boolean, ForeignKey, LargeBinary
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, relationship
-from sqlalchemy.exc import SQLAlchemyError
-import dotenv, os
-
-dotenv.load_dotenv()
-db_url = (
-    f"postgresql+pg8000://{os.getenv('DB_USER')}:{os.getenv('DB_PASSWORD')}"
-    f"@{os.getenv('DB_HOST')}:{os.getenv('DB_PORT')}/{os.getenv('DB_NAME')}"
-)
+from sqlalchemy.orm import relationship
+from sqlalchemy.exc import SQLAlchemyError, IntegrityError
+from sqlalchemy.sql import text
+from datetime import datetime
+from common.bulk import bulk_insert_jobs, upsert_rows, write_rows, BATCH_SIZE
+from common.db import get_engine, get_session, ensure_schema, migrate_to_jsonb, JSON_DOCUMENT
+from common.arrays import PackedArray
+from common.jobs import create_core_tables, copy_to_core, write_jobs, HARTREE_TO_EV
+from .orbitals import OrbitalSpectrum
 
 
 Base = declarative_base()
+# Incrementar a cada mudança nos modelos/update_tables para que create_or_update_tables as aplique
+SCHEMA_VERSION = 6
+JSON_COLUMNS = ('spin_up_orbitals', 'spin_down_orbitals', 'vibrational_frequencies', 'ir_spectrum', 'opt_elements')
+# Tentativas quando outro processo grava a mesma saída ao mesmo tempo (a segunda vira atualização)
+UPSERT_RETRIES = 2
 
 
 # Definindo as tabelas (Models)
@@ -23,24 +28,50 @@ class Job(Base):
     user_id = Column(String, nullable=False)
     sys_name = Column(String, nullable=False)
     description = Column(String, nullable=True)
+    # sha256 do conteúdo (descomprimido) da saída: a mesma saída nunca gera dois jobs
+    content_hash = Column(String(64), unique=True, index=True)
+    # Momento da primeira gravação do job (chave de partição da tabela jobs)
+    created_at = Column(DateTime, default=datetime.now)
     updated_at = Column(DateTime, nullable=False)
-    final_energy = Column(Float, nullable=False)
-    spin_up_orbitals = Column(JSON, nullable=True)
-    spin_down_orbitals = Column(JSON, nullable=True)
-    vibrational_frequencies = Column(JSON, nullable=True)
-    ir_spectrum = Column(JSON, nullable=True)
+    # Nula enquanto um job em andamento ainda não imprimiu a primeira energia SCF
+    final_energy = Column(Float, nullable=True)
+    spin_up_orbitals = Column(JSON_DOCUMENT, nullable=True)
+    spin_down_orbitals = Column(JSON_DOCUMENT, nullable=True)
+    vibrational_frequencies = Column(JSON_DOCUMENT, nullable=True)
+    ir_spectrum = Column(JSON_DOCUMENT, nullable=True)
+    # Tabelas completas de orbitais (n_orbitals x 4: index, occupation, E(Eh), E(eV));
+    # spin_*_orbitals guardam só o resumo LUMO/HOMOs usado nas consultas
+    orbitals_up = Column(PackedArray(), nullable=True)
+    orbitals_down = Column(PackedArray(), nullable=True)
+    # Trajetória da otimização de geometria: float64 little-endian, um valor por ciclo
+    # (coordenadas: n_cycles x n_atoms x 3, em Å, na ordem de opt_elements)
+    opt_cycles = Column(Integer, nullable=True)
+    opt_elements = Column(JSON_DOCUMENT, nullable=True)
+    opt_energies = Column(LargeBinary, nullable=True)
+    opt_gradient_norms = Column(LargeBinary, nullable=True)
+    opt_coordinates = Column(LargeBinary, nullable=True)
 
 
     job_status = relationship("JobStatus", back_populates="job", cascade="all, delete-orphan")
 
+    def orbital_spectrum(self):
+        """Tabelas de orbitais de cada spin como OrbitalSpectrum, sobre os buffers lidos do banco."""
+        if self.orbitals_up is None or self.orbitals_down is None:
+            return None
+        return {
+            "spin_up": OrbitalSpectrum(self.orbitals_up.ravel()),
+            "spin_down": OrbitalSpectrum(self.orbitals_down.ravel())
+        }
+
 
 class JobStatus(Base):
     __tablename__ = 'orca_job_status'
 
     id = Column(Integer, primary_key=True, autoincrement=True)
-    job_id = Column(Integer, ForeignKey('orca_jobs.job_id'))
+    job_id = Column(Integer, ForeignKey('orca_jobs.job_id'), unique=True)
     user_id = Column(String, nullable=False)
-    output_file = Column(String, nullable=False)
+    # Chave do job: uma saída tem um único job
+    output_file = Column(String, nullable=False, unique=True, index=True)
     status = Column(String, nullable=False)
     package = Column(String, nullable=False)
     created_at = Column(DateTime)
@@ -52,39 +83,37 @@ class JobStatus(Base):
         """
         Atualiza ou cria um registro de status para um job específico.
         """
-        existing_status = session.query(cls).filter_by(job_id=job_id).first()
-        if existing_status:
-            existing_status.status = status
-            existing_status.created_at = datetime.utcnow()
-        else:
-            new_status = cls(job_id=job_id, status=status)
-            session.add(new_status)
-        session.commit()
+        return upsert_status(session, {"job_id": job_id, "status": status, "created_at": datetime.utcnow()})
 
 
 # Conectando ao db
 def connect_to_db():
-    """Conecta ao banco de dados PostgreSQL usando SQLAlchemy e retorna o engine e o session."""
+    """Engine compartilhado (common.db), com pool de conexões e pre-ping."""
     try:
-        engine = create_engine(db_url)
-        return engine
+        return get_engine()
     except SQLAlchemyError as e:
         print(f"Erro ao conectar ao banco de dados: {e}")
         return None
 
 
 def create_session(engine):
-    Session = sessionmaker(bind=engine)
-    return Session()
+    """Sessão reaproveitada entre os jobs da mesma thread; session.close() a devolve ao registro."""
+    return get_session(engine)
 
 
 def create_or_update_tables(engine):
-    """Cria ou atualiza as tabelas no banco de dados com base nos modelos definidos."""
+    """
+    Cria ou atualiza as tabelas no banco de dados com base nos modelos definidos.
+    :return: False se a migração falhou (ela é repetida na próxima chamada)
+    """
     try:
-        Base.metadata.create_all(engine)
-        print("Tabelas criadas ou atualizadas com sucesso.")
+        create_core_tables(engine)
+        if ensure_schema(engine, 'orca', Base.metadata, SCHEMA_VERSION, upgrade=update_tables):
+            print("Tabelas criadas ou atualizadas com sucesso.")
+        return True
     except SQLAlchemyError as e:
         print(f"Erro ao criar ou atualizar as tabelas: {e}")
+        return False
 
 
 def insert_orca_data(session, job):
@@ -100,41 +129,163 @@ def insert_orca_data(session, job):
         return None
 
 
-def insert_status_data(session, data):
-    """Insere dados do status da conta na tabela de status"""
-    try:
-        #verificar se o job_id já existe
-        exists_status = session.query(JobStatus).filter_by(job_id=data.job_id).first()
-        if exists_status:
-            exists_status.status = data.status
-            exists_status.output_file = data.output_file
-            exists_status.created_at = data.created_at
-            session.commit()
-            print(f"Status do job {data.job_id} atualizado com sucesso.")
-        else:
-            job_status = JobStatus(
-                job_id=data.job_id,
-                user_id=data.user_id,
-                output_file=data.output_file,
-                status=data.status,
-                package=data.package,
-                created_at=data.created_at
-            )
+def find_job_by_hash(session, content_hash):
+    """Job já gravado com este conteúdo, ou None."""
+    if not content_hash:
+        return None
+    return session.query(Job).filter(Job.content_hash == content_hash).first()
+
+
+def find_job_by_output(session, output_file):
+    """Job já associado a esta saída (chave: pacote + arquivo de saída, via tabela de status), ou None."""
+    return (session.query(Job)
+            .join(JobStatus, JobStatus.job_id == Job.job_id)
+            .filter(JobStatus.output_file == output_file, Job.package == 'ORCA')
+            .order_by(Job.job_id.desc())
+            .first())
 
-            session.add(job_status)
+
+def upsert_orca_data(session, output_file, values, status_values=None, core_row=None):
+    """
+    Insere o job desta saída ou atualiza o já existente, em vez de criar uma linha nova a cada chamada.
+    Na atualização só os campos com valor são escritos, e o SQLAlchemy deixa fora do UPDATE
+    as colunas cujo valor não mudou.
+    Com status_values e core_row, o status e a linha da tabela jobs são gravados na mesma
+    transação: ou os três valem, ou nenhum. Como orca_job_status.output_file
+    é único, dois processos gravando a mesma saída não criam dois jobs: a transação do
+    segundo é desfeita e repetida, já como atualização do job gravado pelo primeiro.
+    :param values: dict coluna -> valor
+    :param status_values: dict com as colunas de orca_job_status (sem job_id)
+    :param core_row: função(job) -> linha da tabela jobs (common.jobs.write_jobs)
+    :return: job ou None em caso de erro
+    """
+    for attempt in range(UPSERT_RETRIES):
+        try:
+            # O mesmo conteúdo em outro caminho (ex.: cópia ou saída reenviada) também é o mesmo job
+            job = find_job_by_hash(session, values.get("content_hash")) or find_job_by_output(session, output_file)
+            inserted = job is None
+            if inserted:
+                job = Job(**values)
+                session.add(job)
+            else:
+                for key, value in values.items():
+                    if value is not None:
+                        setattr(job, key, value)
+            session.flush()
+            if status_values is not None:
+                write_rows(session, JobStatus, dict(status_values, job_id=job.job_id),
+                           update_columns=STATUS_UPDATE_COLUMNS)
+            if core_row is not None:
+                write_jobs(session, core_row(job))
             session.commit()
-            print(f"Status do job {data.job_id} inserido com sucesso.")
-    except SQLAlchemyError as e:
-        session.rollback()
-        print(f"Erro ao inserir o status do job: {e}")
+            print("Job inserido com sucesso." if inserted else f"Job {job.job_id} atualizado com sucesso.")
+            return job
+        except IntegrityError as e:
+            session.rollback()
+            if attempt + 1 == UPSERT_RETRIES:
+                print(f"Erro ao inserir ou atualizar o job: {e}")
+        except SQLAlchemyError as e:
+            session.rollback()
+            print(f"Erro ao inserir ou atualizar o job: {e}")
+            return None
+    return None
+
+
+def insert_orca_batch(session, records, batch_size=BATCH_SIZE, skip_existing=True, after_batch=None):
+    """
+    Insere um lote de jobs e seus status com INSERT multi-linha e um commit por lote
+    (ver common.bulk.bulk_insert_jobs). Usado na carga de muitas saídas de uma vez.
+    :param records: iterável de (dict do job, dict do status sem job_id)
+    :return: número de jobs inseridos
+    """
+    return bulk_insert_jobs(session, Job, JobStatus, 'output_file', records, batch_size, skip_existing, after_batch)
+
+
+# Colunas atualizadas quando o job já tem status (as demais ficam como na inserção)
+STATUS_UPDATE_COLUMNS = ('status', 'output_file', 'created_at')
+
+
+def _status_row(data):
+    return {column.key: getattr(data, column.key) for column in JobStatus.__table__.columns if column.key != 'id'}
+
+
+def upsert_status(session, changes):
+    """
+    Grava uma ou várias alterações de status (dict ou lista de dicts com job_id) com
+    INSERT ... ON CONFLICT (job_id) DO UPDATE: uma ida ao banco e um commit, sem SELECT
+    prévio e sem risco de dois monitores criarem status duplicados para o mesmo job.
+    :return: número de alterações gravadas ou None em caso de erro
+    """
+    return upsert_rows(session, JobStatus, changes, update_columns=STATUS_UPDATE_COLUMNS)
+
+
+def insert_status_data(session, data):
+    """Insere o status de um job na tabela de status, ou atualiza o existente."""
+    if upsert_status(session, _status_row(data)) is not None:
+        print(f"Status do job {data.job_id} gravado com sucesso.")
 
 
 # Função para atualizar as tabelas (caso necessário)
-def update_tables(engine):
-    """Atualiza as tabelas no banco de dados, se necessário."""
-    try:
-        # Exemplo: Verificar e aplicar alterações no schema, se necessário.
-        # Se você estiver usando Alembic para migrações, pode chamar a função `alembic.command.upgrade`.
-        pass
-    except SQLAlchemyError as e:
-        print(f"Erro ao atualizar as tabelas: {e}")
\ No newline at end of file
+def update_tables(connection):
+    """
+    Ajustes de schema que o create_all não faz em tabelas já existentes.
+    orca_job_status.job_id passa a ser único (exigido pelo ON CONFLICT do upsert_status):
+    status duplicados de um mesmo job são removidos, ficando o mais recente.
+    As colunas JSON passam a jsonb (com índices GIN e de expressão), as colunas orbitals_*
+    e opt_* (trajetória da otimização) são adicionadas.
+    orca_job_status.output_file passa a ser único (chave do job): de status repetidos para a
+    mesma saída fica o mais recente, e os jobs duplicados dos demais são removidos.
+    final_energy passa a aceitar NULL (jobs em andamento).
+    A coluna content_hash é adicionada com índice único.
+    orca_jobs ganha created_at (preenchido com updated_at nas linhas antigas) e os jobs
+    existentes são copiados para a tabela jobs (common.jobs).
+    """
+    if connection.dialect.name != 'postgresql':
+        return
+    connection.execute(text(
+        """DELETE FROM orca_job_status a
+            USING orca_job_status b
+            WHERE a.job_id = b.job_id AND a.id < b.id"""
+    ))
+    connection.execute(text(
+        "CREATE UNIQUE INDEX IF NOT EXISTS orca_job_status_job_id_key ON orca_job_status (job_id)"
+    ))
+    connection.execute(text(
+        """WITH removed AS (
+                DELETE FROM orca_job_status a
+                USING orca_job_status b
+                WHERE a.output_file = b.output_file AND a.id < b.id
+                RETURNING a.job_id
+            ), core AS (
+                DELETE FROM jobs WHERE package = 'ORCA' AND job_id IN (SELECT job_id FROM removed)
+            )
+            DELETE FROM orca_jobs WHERE job_id IN (SELECT job_id FROM removed)"""
+    ))
+    connection.execute(text("DROP INDEX IF EXISTS ix_orca_job_status_output_file"))
+    connection.execute(text(
+        "CREATE UNIQUE INDEX ix_orca_job_status_output_file ON orca_job_status (output_file)"
+    ))
+    connection.execute(text("ALTER TABLE orca_jobs ALTER COLUMN final_energy DROP NOT NULL"))
+    migrate_to_jsonb(connection, 'orca_jobs', JSON_COLUMNS)
+    for statement in (
+        "ALTER TABLE orca_jobs ADD COLUMN IF NOT EXISTS content_hash VARCHAR(64)",
+        "CREATE UNIQUE INDEX IF NOT EXISTS ix_orca_jobs_content_hash ON orca_jobs (content_hash)",
+        "ALTER TABLE orca_jobs ADD COLUMN IF NOT EXISTS orbitals_up BYTEA",
+        "ALTER TABLE orca_jobs ADD COLUMN IF NOT EXISTS orbitals_down BYTEA",
+        "ALTER TABLE orca_jobs ADD COLUMN IF NOT EXISTS opt_cycles INTEGER",
+        "ALTER TABLE orca_jobs ADD COLUMN IF NOT EXISTS opt_elements JSONB",
+        "ALTER TABLE orca_jobs ADD COLUMN IF NOT EXISTS opt_energies BYTEA",
+        "ALTER TABLE orca_jobs ADD COLUMN IF NOT EXISTS opt_gradient_norms BYTEA",
+        "ALTER TABLE orca_jobs ADD COLUMN IF NOT EXISTS opt_coordinates BYTEA",
+        "CREATE INDEX IF NOT EXISTS ix_orca_jobs_vibrational_frequencies ON orca_jobs USING gin (vibrational_frequencies jsonb_path_ops)",
+        "CREATE INDEX IF NOT EXISTS ix_orca_jobs_ir_spectrum ON orca_jobs USING gin (ir_spectrum jsonb_path_ops)",
+        "CREATE INDEX IF NOT EXISTS ix_orca_jobs_lumo_up_ev ON orca_jobs (((spin_up_orbitals #>> '{LUMO,energy_ev}')::float8))",
+        "CREATE INDEX IF NOT EXISTS ix_orca_jobs_lumo_down_ev ON orca_jobs (((spin_down_orbitals #>> '{LUMO,energy_ev}')::float8))",
+    ):
+        connection.execute(text(statement))
+    connection.execute(text("ALTER TABLE orca_jobs ADD COLUMN IF NOT EXISTS created_at TIMESTAMP"))
+    connection.execute(text("UPDATE orca_jobs SET created_at = updated_at WHERE created_at IS NULL"))
+    copy_to_core(connection, 'ORCA', f"""
+        SELECT 'ORCA', j.created_at, j.job_id, j.user_id, j.sys_name,
+               j.description, s.status, s.output_file, j.content_hash, j.final_energy * {HARTREE_TO_EV}, j.updated_at
+        FROM orca_jobs j LEFT JOIN orca_job_status s ON s.job_id = j.job_id""")
@@ -1,4 +1,35 @@
-import time
+import re
+from common.readers import read_tail, OutputFollower
+from common.scheduler import log_progress
+from .parser import TERMINATED_MARKER, ERROR_MARKERS
+
+
+TAIL_SIZE = 64 * 1024
+# Linha da tabela de convergência da otimização: valor atual e tolerância
+RMS_GRADIENT_PATTERN = re.compile(r"^\s*RMS gradient\s+([-+]?\d*\.\d+(?:[eE][-+]?\d+)?)\s+([-+]?\d*\.\d+(?:[eE][-+]?\d+)?)")
+
+
+class OptProgress:
+    """
+    Fração concluída de uma otimização de geometria, estimada pela queda (em escala log)
+    do RMS do gradiente desde o primeiro ciclo até a tolerância impressa pelo ORCA.
+    """
+
+    def __init__(self):
+        self.tolerance = None
+        self.first = None
+        self.last = None
+
+    def feed(self, line):
+        if 'RMS gradient' in line:
+            match = RMS_GRADIENT_PATTERN.match(line)
+            if match:
+                self.last, self.tolerance = float(match.group(1)), float(match.group(2))
+                if self.first is None:
+                    self.first = self.last
+
+    def fraction(self):
+        return log_progress(self.first, self.last, self.tolerance)
 
 
 def check_job_done(output_path):
@@ -9,12 +40,12 @@ def check_job_done(output_path):
     job_done = False
     error = False
     try:
-        with open(output_path, 'r') as file:
-            content: str = file.read()
-            if '****ORCA TERMINATED NORMALLY****' in content:
-                job_done = True
-            elif 'Error' in content:
-                error = True
+        # As mensagens de término ficam no fim do arquivo: lê apenas o último bloco
+        tail = read_tail(output_path, TAIL_SIZE)
+        if TERMINATED_MARKER in tail:
+            job_done = True
+        elif any(marker in tail for marker in ERROR_MARKERS):
+            error = True
 
     except FileNotFoundError as e:
         print(f"Erro: {e}")
@@ -25,26 +56,51 @@ def check_job_done(output_path):
         return 'COMPLETED'
 
 
-def monitor_jobs(output_path, job_id=None, session=None):
+def new_follower(output_path, on_line=None):
+    """OutputFollower da saída do ORCA, atento aos marcadores de término e de erro."""
+    return OutputFollower(output_path, markers=(TERMINATED_MARKER,) + ERROR_MARKERS, on_line=on_line)
+
+
+def follow_job(follower):
+    """
+    Versão incremental de check_job_done: lê só o que foi escrito desde o último poll
+    do mesmo follower, considerando os marcadores vistos em qualquer ponto do arquivo.
+    """
+    try:
+        follower.poll()
+    except FileNotFoundError as e:
+        print(f"Erro: {e}")
+        return 'FAILED'
+    if follower.seen(TERMINATED_MARKER):
+        return 'COMPLETED'
+    if any(follower.seen(marker) for marker in ERROR_MARKERS):
+        return 'FAILED'
+
+
+def monitor_jobs(output_path, job_id=None, session=None, job_done=None, follower=None):
     """
     Função para monitorar o arquivo de saida ORCA até que a string 'ORCA RUN TERMINATED NORMALLY' seja encontrada.
     Quando encontrada, o loop é interrompido, retornando o status da conta.
+    Se job_done já vier do parser (parse_orca_output), o arquivo não é lido novamente.
+    Com um follower (new_follower) reaproveitado entre chamadas, cada verificação lê só os bytes novos.
     """
     status = "RUNNING"
     #chamada da classe definida no db_manager (futuro)
 
-    job_done = check_job_done(output_path)
+    if job_done is None:
+        job_done = follow_job(follower) if follower else check_job_done(output_path)
     if job_done == "COMPLETED":
         status = 'COMPLETED'
         print("Execução encerrada com sucesso. Processando dados...")
         return status
-    # elif job_done == 'FAILED':
-    #     status = 'FAILED'
-    #     print(f"Erro encontrado no arquivo de saida. Job marcado como {job_done}.")
-    #     return status
+    elif job_done == 'FAILED':
+        # O mesmo status com que o daemon encerra o job (follow_job)
+        status = 'FAILED'
+        print(f"Erro encontrado no arquivo de saida. Job marcado como {job_done}.")
+        return status
 
+    # Sem espera fixa aqui: quem repete a verificação (ex.: o daemon) agenda a próxima pelo PollClock
     print("Aguardando que ambos os arquivos cheguem ao fim...")
-    time.sleep(5)  # Aguarda 10 minutos antes de verificar novamente.
     return status
 
 if __name__ == '__main__':
@@ -0,0 +1,129 @@
+import re
+from array import array
+import numpy as np
+
+
+CYCLE_PATTERN = re.compile(r"GEOMETRY OPTIMIZATION CYCLE\s+(\d+)")
+COORDINATE_PATTERN = re.compile(r"^\s*([A-Za-z]{1,3})\s+(-?\d+\.\d+)\s+(-?\d+\.\d+)\s+(-?\d+\.\d+)\s*$")
+ENERGY_PATTERN = re.compile(r"FINAL SINGLE POINT ENERGY\s+([-+]?\d*\.\d+|\d+)")
+GRADIENT_NORM_PATTERN = re.compile(r"Norm of the cartesian gradient\s*\.*\s*([-+]?\d*\.\d+)")
+RMS_GRADIENT_PATTERN = re.compile(r"^\s*RMS gradient\s+([-+]?\d*\.\d+)")
+COORDINATES_HEADER = 'CARTESIAN COORDINATES (ANGSTROEM)'
+
+
+class OptimizationScanner:
+    """
+    Segue os ciclos de uma otimização de geometria do ORCA linha a linha.
+    Cada bloco 'CARTESIAN COORDINATES (ANGSTROEM)' abre um passo; a energia e o gradiente
+    que aparecem depois dele pertencem a esse passo. Apenas o passo corrente fica em memória.
+    """
+
+    def __init__(self):
+        self.cycle = 0
+        self._step = None
+        self._reading_coordinates = False
+
+    def feed(self, line):
+        """Processa uma linha; retorna o passo anterior quando um novo bloco de coordenadas começa."""
+        if self._reading_coordinates:
+            match = COORDINATE_PATTERN.match(line)
+            if match:
+                self._step["elements"].append(match.group(1))
+                self._step["coordinates"].extend(map(float, match.groups()[1:]))
+                return None
+            if not self._step["elements"]:
+                # Linha de traços entre o título e a tabela
+                return None
+            # A tabela termina na primeira linha que não é uma coordenada
+            self._reading_coordinates = False
+
+        if COORDINATES_HEADER in line:
+            finished = self._step
+            self._step = {
+                "cycle": self.cycle,
+                "elements": [],
+                "coordinates": array('d'),
+                "energy": np.nan,
+                "gradient_norm": np.nan,
+                "rms_gradient": np.nan
+            }
+            self._reading_coordinates = True
+            return self._finish(finished)
+
+        if self._step is None:
+            if 'GEOMETRY OPTIMIZATION CYCLE' in line:
+                self._cycle_header(line)
+            return None
+
+        if 'GEOMETRY OPTIMIZATION CYCLE' in line:
+            self._cycle_header(line)
+        elif 'FINAL SINGLE POINT ENERGY' in line:
+            match = ENERGY_PATTERN.search(line)
+            if match:
+                self._step["energy"] = float(match.group(1))
+        elif 'Norm of the cartesian gradient' in line:
+            match = GRADIENT_NORM_PATTERN.search(line)
+            if match:
+                self._step["gradient_norm"] = float(match.group(1))
+        elif 'RMS gradient' in line:
+            match = RMS_GRADIENT_PATTERN.match(line)
+            if match:
+                self._step["rms_gradient"] = float(match.group(1))
+        return None
+
+    def _cycle_header(self, line):
+        match = CYCLE_PATTERN.search(line)
+        if match:
+            self.cycle = int(match.group(1))
+
+    def close(self):
+        """Finaliza a leitura e retorna o último passo, se houver."""
+        finished, self._step = self._step, None
+        return self._finish(finished)
+
+    @staticmethod
+    def _finish(step):
+        if step is None or not step["elements"]:
+            return None
+        step["coordinates"] = np.frombuffer(step["coordinates"], dtype=np.float64).reshape(-1, 3)
+        return step
+
+
+class OptimizationTrajectory:
+    """Acumula os passos de uma otimização em buffers array('d') compactos."""
+
+    def __init__(self):
+        self.elements = None
+        self.cycles = array('i')
+        self.energies = array('d')
+        self.gradient_norms = array('d')
+        self.rms_gradients = array('d')
+        self.coordinates = array('d')
+
+    def __len__(self):
+        return len(self.cycles)
+
+    def append(self, step):
+        if self.elements is None:
+            self.elements = step["elements"]
+        elif len(step["elements"]) != len(self.elements):
+            # Bloco de coordenadas de outro sistema (ex.: fragmento); fora da trajetória
+            return
+        self.cycles.append(step["cycle"])
+        self.energies.append(step["energy"])
+        self.gradient_norms.append(step["gradient_norm"])
+        self.rms_gradients.append(step["rms_gradient"])
+        self.coordinates.extend(step["coordinates"].ravel())
+
+    def as_arrays(self):
+        if not len(self):
+            return None
+        # Cópias: os buffers continuam recebendo passos se a leitura prosseguir
+        return {
+            "elements": self.elements,
+            "cycles": np.array(self.cycles, dtype=np.int32),
+            "energies": np.array(self.energies, dtype=np.float64),
+            "gradient_norms": np.array(self.gradient_norms, dtype=np.float64),
+            "rms_gradients": np.array(self.rms_gradients, dtype=np.float64),
+            "coordinates": np.array(self.coordinates, dtype=np.float64).reshape(len(self), -1, 3)
+        }
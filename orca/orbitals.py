@@ -0,0 +1,94 @@
+from array import array
+import numpy as np
+
+
+# Colunas da tabela de orbitais do ORCA: NO, OCC, E(Eh), E(eV)
+ORBITAL_COLUMNS = 4
+DEFAULT_HOMOS = 9
+
+
+def new_orbital_table():
+    """Buffer plano (array('d')) onde o parser acumula as linhas da tabela de orbitais."""
+    return array('d')
+
+
+class OrbitalSpectrum:
+    """
+    Tabela completa de orbitais de um spin, armazenada em colunas NumPy
+    (index, occupation, energy_eh, energy_ev) em vez de um dict por orbital.
+    """
+
+    def __init__(self, table):
+        data = np.frombuffer(table, dtype=np.float64).reshape(-1, ORBITAL_COLUMNS) if len(table) else \
+            np.empty((0, ORBITAL_COLUMNS))
+        self.index = data[:, 0].astype(np.int32)
+        self.occupation = data[:, 1]
+        self.energy_eh = data[:, 2]
+        self.energy_ev = data[:, 3]
+
+    def __len__(self):
+        return len(self.index)
+
+    def to_array(self):
+        """Tabela (n_orbitals, 4) no formato das colunas orbitals_* de orca_jobs."""
+        return np.column_stack([self.index, self.occupation, self.energy_eh, self.energy_ev])
+
+    def lumo_position(self):
+        """Posição (na tabela) do primeiro orbital desocupado, ou None."""
+        empty = np.flatnonzero(self.occupation == 0.0)
+        return int(empty[0]) if len(empty) else None
+
+    def homo_positions(self, count=DEFAULT_HOMOS):
+        """Posições dos `count` orbitais ocupados logo abaixo do LUMO, ordenadas por índice."""
+        occupied = self.occupation == 1.0
+        lumo = self.lumo_position()
+        if lumo is not None:
+            occupied &= self.index < self.index[lumo]
+        positions = np.flatnonzero(occupied)
+        positions = positions[-count:] if count > 0 else positions[:0]
+        return positions[np.argsort(self.index[positions], kind='stable')]
+
+    def homo_position(self):
+        positions = self.homo_positions(1)
+        return int(positions[0]) if len(positions) else None
+
+    def gap(self, unit='ev'):
+        """Gap HOMO-LUMO em eV (unit='ev') ou Hartree (unit='eh')."""
+        homo, lumo = self.homo_position(), self.lumo_position()
+        if homo is None or lumo is None:
+            return None
+        energies = self.energy_ev if unit == 'ev' else self.energy_eh
+        return float(energies[lumo] - energies[homo])
+
+    def frontier(self, below=DEFAULT_HOMOS, above=1):
+        """
+        Fatia de orbitais de fronteira: `below` ocupados abaixo do LUMO e `above` a partir do LUMO.
+        :return: dict de arrays (index, occupation, energy_eh, energy_ev)
+        """
+        positions = self.homo_positions(below)
+        lumo = self.lumo_position()
+        if lumo is not None and above:
+            positions = np.concatenate([positions, np.arange(lumo, min(lumo + above, len(self)))])
+        return {
+            "index": self.index[positions],
+            "occupation": self.occupation[positions],
+            "energy_eh": self.energy_eh[positions],
+            "energy_ev": self.energy_ev[positions]
+        }
+
+    def orbital(self, position):
+        """Visão em dict de um orbital, no formato armazenado em orca_jobs."""
+        return {
+            "index": int(self.index[position]),
+            "occupation": float(self.occupation[position]),
+            "energy_orb": float(self.energy_eh[position]),
+            "energy_ev": float(self.energy_ev[position])
+        }
+
+    def to_json(self, homos=DEFAULT_HOMOS):
+        """Formato JSON atual das colunas spin_*_orbitals: LUMO e os HOMOs logo abaixo dele."""
+        lumo = self.lumo_position()
+        return {
+            "LUMO": self.orbital(lumo) if lumo is not None else None,
+            "HOMOs": [self.orbital(position) for position in self.homo_positions(homos)]
+        }
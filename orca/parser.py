@@ -1,138 +1,273 @@
 import re
 import logging
+from common.readers import rfind_marker, iter_lines_from, read_last_line_with, open_output, new_content_hash
+from common.cache import cached_parse
+from .orbitals import OrbitalSpectrum, new_orbital_table
+from .optimization import OptimizationScanner, OptimizationTrajectory
 
 
-def extract_orbitals_and_homos(content):
-    pattern_orbital = r"^\s*(\d+)\s+(1\.0000|0\.0000)\s+([-+]?\d*\.\d+|\d+)\s+([-+]?\d*\.\d+|\d+)"
-    energy_pattern = r"FINAL SINGLE POINT ENERGY\s+([-+]?\d*\.\d+|\d+)"
+# Versão do formato dos resultados (chave do cache de parsing em common.cache)
+PARSER_VERSION = 2
+ORBITAL_PATTERN = re.compile(r"^\s*(\d+)\s+(1\.0000|0\.0000)\s+([-+]?\d*\.\d+|\d+)\s+([-+]?\d*\.\d+|\d+)")
+ENERGY_PATTERN = re.compile(r"FINAL SINGLE POINT ENERGY\s+([-+]?\d*\.\d+|\d+)")
+SPIN_UP_PATTERN = re.compile(r"\bSPIN\s+UP\s+ORBITALS\b")
+SPIN_DOWN_PATTERN = re.compile(r"\bSPIN\s+DOWN\s+ORBITALS\b")
+FREQ_PATTERN = re.compile(r"^\s*(\d+):\s*([\d\.]+)\s*cm\*\*-1")
+SPECTRUM_PATTERN = re.compile(r"^\s*(\d+):\s*([\d\.]+)\s*(\d+\.\d+)\s*(\d+\.\d+)\s*([\(\-0-9,\. \)]+)")
+TERMINATED_MARKER = '****ORCA TERMINATED NORMALLY****'
+# Linhas que o ORCA imprime ao abortar. 'Error' sozinho não serve: todo ciclo SCF imprime 'Last DIIS Error'
+ERROR_MARKERS = ('ORCA finished by error termination', 'aborting the run')
+
+
+class OrcaOutputScanner:
+    """
+    Percorre a saída do ORCA linha a linha, uma única vez.
+    Guarda apenas o último bloco de orbitais de cada spin, a última energia e as
+    tabelas de frequências/IR, então a memória não cresce com o tamanho do arquivo.
+    """
+
+    def __init__(self):
+        self.terminated = False
+        self.error = False
+        self.final_energy = None
+        # Hash do conteúdo, quando o scanner leu o arquivo inteiro (scan_orca_output)
+        self.content_hash = None
+        self.spin_up_rows = None
+        self.spin_down_rows = None
+        self.frequencies = []
+        self.ir_spectrum = []
+        self.trajectory = OptimizationTrajectory()
+        self._optimization = OptimizationScanner()
+        self._section = None
+        self._section_started = False
+
+    def feed(self, line):
+        """Processa uma linha da saída."""
+        step = self._optimization.feed(line)
+        if step is not None:
+            self.trajectory.append(step)
 
-    # Ajuste para capturar as seções SPIN UP e SPIN DOWN
-    pattern_spin_up = r"\bSPIN\s+UP\s+ORBITALS\b"
-    pattern_spin_down = r"\bSPIN\s+DOWN\s+ORBITALS\b"
-    with open(content, 'r') as file:
-        content = file.read()
+        if self._section is not None:
+            match = ORBITAL_PATTERN.match(line)
+            if match:
+                self._section.extend(map(float, match.groups()))
+                self._section_started = True
+                return
+            if self._section_started:
+                # Fim da tabela de orbitais
+                self._section = None
 
-    # Encontrar as posições das seções SPIN UP e SPIN DOWN
-    spin_up_start_indices = [m.start() for m in re.finditer(pattern_spin_up, content)]
-    spin_down_start_indices = [m.start() for m in re.finditer(pattern_spin_down, content)]
+        if 'ORBITALS' in line:
+            if SPIN_UP_PATTERN.search(line):
+                self.spin_up_rows = self._open_section()
+                # O SPIN DOWN anterior é de outro ciclo: o par só fecha com o próximo SPIN DOWN
+                self.spin_down_rows = None
+                return
+            if SPIN_DOWN_PATTERN.search(line):
+                self.spin_down_rows = self._open_section()
+                return
 
-    if not spin_up_start_indices or not spin_down_start_indices:
-        #raise ValueError("Não foi possível encontrar as seções de SPIN UP e SPIN DOWN.")
+        if 'FINAL SINGLE POINT ENERGY' in line:
+            match = ENERGY_PATTERN.search(line)
+            if match:
+                self.final_energy = float(match.group(1))
+            return
+
+        if ':' in line:
+            if 'cm**-1' in line:
+                match = FREQ_PATTERN.match(line)
+                if match:
+                    self.frequencies.append({
+                        "mode": int(match.group(1)),
+                        "frequency_cm1": float(match.group(2))
+                    })
+                    return
+            if '(' in line:
+                match = SPECTRUM_PATTERN.match(line)
+                if match:
+                    self.ir_spectrum.append(_spectrum_entry(match.groups()))
+                    return
+
+        if TERMINATED_MARKER in line:
+            self.terminated = True
+        elif any(marker in line for marker in ERROR_MARKERS):
+            self.error = True
+
+    def close(self):
+        """Fecha o último passo da otimização ao fim da leitura."""
+        step = self._optimization.close()
+        if step is not None:
+            self.trajectory.append(step)
+
+    def _open_section(self):
+        self._section = new_orbital_table()
+        self._section_started = False
+        return self._section
+
+    def orbital_block_closed(self):
+        """True quando o SPIN DOWN que segue o último SPIN UP já foi lido por completo."""
+        return self.spin_down_rows is not None and self._section is None
+
+    def status(self):
+        """Mesma convenção do monitor: 'COMPLETED', 'FAILED' ou None."""
+        if self.terminated:
+            return 'COMPLETED'
+        if self.error:
+            return 'FAILED'
         return None
 
-    last_spin_up_index = spin_up_start_indices[-1]
-    last_spin_down_index = spin_down_start_indices[-1]
-
-    spin_up_content = content[last_spin_up_index:last_spin_down_index]
-    spin_down_content = content[last_spin_down_index:]
-
-    orbitals_up = re.findall(pattern_orbital, spin_up_content, re.MULTILINE)
-    orbitals_down = re.findall(pattern_orbital, spin_down_content, re.MULTILINE)
-
-    spin_up_data = [{
-        "index": int(m[0]),
-        "occupation": float(m[1]),
-        "energy_orb": float(m[2]),
-        "energy_ev": float(m[3])
-    } for m in orbitals_up]
-    spin_down_data = [{
-        "index": int(m[0]),
-        "occupation": float(m[1]),
-        "energy_orb": float(m[2]),
-        "energy_ev": float(m[3])
-    } for m in orbitals_down]
-
-    lumo_up = next((orbital for orbital in spin_up_data if orbital['occupation'] == 0.0000), None)
-    lumo_down = next((orbital for orbital in spin_down_data if orbital['occupation'] == 0.0000), None)
-
-    # Encontrar os 10 HOMOs acima do LUMO
-    homos_up = [orbital for orbital in spin_up_data if orbital['occupation'] == 1.0000]
-    homos_down = [orbital for orbital in spin_down_data if orbital['occupation'] == 1.0000]
-
-    # Encontrar os HOMOs que estão abaixo do LUMO (com index < LUMO['index'])
-    homos_below_lumo_up = [homo for homo in homos_up if homo['index'] < lumo_up['index']]
-    homos_below_lumo_down = [homo for homo in homos_down if homo['index'] < lumo_down['index']]
-
-    # Se houver HOMOs abaixo do LUMO, pegar os 10 mais próximos
-    selected_homos_up = homos_below_lumo_up[-9:]  # Para pegar os 10 mais próximos ao LUMO
-    selected_homos_up.reverse()  # Reverter para pegar do mais próximo ao mais distante
-    selected_homos_down = homos_below_lumo_down[-9:]
-    selected_homos_down.reverse()
-
-    # Ordenar HOMOs por 'index'
-    selected_homos_up.sort(key=lambda x: x['index'])
-    selected_homos_down.sort(key=lambda x: x['index'])
-
-    # Energia final do sistema
-    energy_match = re.findall(energy_pattern, content)
-    final_energy = float(energy_match[-1]) if energy_match else None
+    def orbital_spectrum(self):
+        """Tabelas completas de orbitais (último bloco) de cada spin, como OrbitalSpectrum."""
+        if self.spin_up_rows is None or self.spin_down_rows is None:
+            return None
+        return {
+            "spin_up": OrbitalSpectrum(self.spin_up_rows),
+            "spin_down": OrbitalSpectrum(self.spin_down_rows)
+        }
+
+    def orbital_data(self):
+        spectrum = self.orbital_spectrum()
+        if spectrum is None:
+            return None
+        return {
+            "spin_up_orbitals": spectrum["spin_up"].to_json(),
+            "spin_down_orbitals": spectrum["spin_down"].to_json(),
+            "final_energy": self.final_energy
+        }
+
+    def vibrational_data(self):
+        if not self.frequencies and not self.ir_spectrum:
+            return None
+        return {
+            "vibrational_frequencies": self.frequencies,
+            "ir_spectrum": self.ir_spectrum,
+            "final_energy": self.final_energy
+        }
+
+
+def _spectrum_entry(m):
+    # Extrair e processar as coordenadas
+    coords_str = m[4].strip()  # Limpar espaços extras no início e no final da string
+    coords_str = coords_str.split('(')[-1].split(')')[0].strip()
+
+    coordinates = tuple(map(float, coords_str.split()))
 
     return {
-        "spin_up_orbitals": {
-            "LUMO": lumo_up,
-            "HOMOs": selected_homos_up
-        },
-        "spin_down_orbitals": {
-            "LUMO": lumo_down,
-            "HOMOs": selected_homos_down
-        },
-        "final_energy": final_energy
+        "mode": int(m[0]),
+        "frequency_cm1": float(m[1]),
+        "epsilon": float(m[2]),
+        "intensity": float(m[3]),
+        "coordinates": coordinates
     }
 
 
-def extract_vibrational_data(file_path):
+def scan_orca_output(file_path):
     """
-    Extrai as freq. vibracionais e espectro IR do arquivo de saída
-    :param file_path:
-    :return: json com os pares chave:valor
+    Lê a saída do ORCA uma única vez e devolve o scanner preenchido.
+    :param file_path: caminho do arquivo .out
+    :return: OrcaOutputScanner
     """
-    freq_pattern = r"^\s*(\d+):\s*([\d\.]+)\s*cm\*\*-1"
-    spectrum_pattern = r"^\s*(\d+):\s*([\d\.]+)\s*(\d+\.\d+)\s*(\d+\.\d+)\s*([\(\-0-9,\. \)]+)"
-    energy_pattern = r"FINAL SINGLE POINT ENERGY\s+([-+]?\d*\.\d+|\d+)"
-
-    with open(file_path, 'r') as file:
-        content = file.read()
+    scanner = OrcaOutputScanner()
+    content_hash = new_content_hash()
+    with open_output(file_path, 'r', content_hash) as file:
+        for line in file:
+            scanner.feed(line)
+    scanner.close()
+    scanner.content_hash = content_hash.hexdigest()
+    return scanner
 
-    vib_matches = re.findall(freq_pattern, content, re.MULTILINE)
-    spectrum_matches = re.findall(spectrum_pattern, content, re.MULTILINE)
-    if not vib_matches and not spectrum_matches:
-        return None
-
-    frequencies = [{
-        "mode": int(m[0]),
-        "frequency_cm1": float(m[1])
-    } for m in vib_matches]
 
-    ir_spectrum = []
-    for m in spectrum_matches or []:
-        # Extrair e processar as coordenadas
-        coords_str = m[4].strip()  # Limpar espaços extras no início e no final da string
-        coords_str = coords_str.split('(')[-1].split(')')[0].strip()
+def iter_opt_cycles(file_path):
+    """
+    Gera cada ciclo de uma otimização de geometria (energia, norma do gradiente e
+    coordenadas em Å como array (n_atoms, 3)) sem manter o arquivo em memória.
+    """
+    scanner = OptimizationScanner()
+    with open_output(file_path, 'r') as file:
+        for line in file:
+            step = scanner.feed(line)
+            if step is not None:
+                yield step
+    step = scanner.close()
+    if step is not None:
+        yield step
 
-        coordinates = tuple(map(float, coords_str.split()))
 
-        ir_spectrum.append({
-            "mode": int(m[0]),
-            "frequency_cm1": float(m[1]),
-            "epsilon": float(m[2]),
-            "intensity": float(m[3]),
-            "coordinates": coordinates
-        })
+@cached_parse(PARSER_VERSION)
+def parse_orca_output(file_path):
+    """
+    Extrai, em uma única leitura, o status de término, o último bloco de orbitais,
+    as frequências, o espectro IR e a energia final.
+    :param file_path: caminho do arquivo .out
+    :return: dict com os pares chave:valor
+    """
+    return scanner_result(scan_orca_output(file_path))
 
-        energy_match = re.findall(energy_pattern, content)
-        final_energy = float(energy_match[-1]) if energy_match else None
 
+def scanner_result(scanner, partial=False):
+    """
+    Monta o resultado de parse_orca_output a partir de um scanner já alimentado.
+    :param partial: leitura em andamento (job rodando); um bloco de orbitais ainda sendo
+                    escrito fica de fora para não misturar o SPIN UP novo com o SPIN DOWN anterior
+    """
+    orbitals_ready = not partial or scanner.orbital_block_closed()
     return {
-        "vibrational_frequencies": frequencies,
-        "ir_spectrum": ir_spectrum,
-        "final_energy": final_energy
+        "status": scanner.status(),
+        "orbital_data": scanner.orbital_data() if orbitals_ready else None,
+        "orbital_spectrum": scanner.orbital_spectrum() if orbitals_ready else None,
+        "vib_data": scanner.vibrational_data(),
+        "opt_trajectory": scanner.trajectory.as_arrays(),
+        "final_energy": scanner.final_energy,
+        "content_hash": scanner.content_hash
     }
 
 
+def read_final_energy(file_path):
+    """Lê a última 'FINAL SINGLE POINT ENERGY' procurando a partir do fim do arquivo."""
+    line = read_last_line_with(file_path, 'FINAL SINGLE POINT ENERGY')
+    match = ENERGY_PATTERN.search(line) if line else None
+    return float(match.group(1)) if match else None
+
+
+@cached_parse(PARSER_VERSION)
+def extract_orbitals_and_homos(content):
+    """
+    Localiza o último bloco 'SPIN UP ORBITALS' a partir do fim do arquivo e lê apenas
+    esse bloco e o 'SPIN DOWN' seguinte, sem percorrer os ciclos anteriores.
+    """
+    offset = rfind_marker(content, 'SPIN UP ORBITALS')
+    if offset == -1:
+        return None
+
+    scanner = OrcaOutputScanner()
+    lines = iter_lines_from(content, offset)
+    for line in lines:
+        scanner.feed(line)
+        if scanner.orbital_block_closed():
+            break
+    lines.close()
+
+    if scanner.spin_down_rows is None:
+        # Saída truncada entre os blocos: volta para a leitura completa
+        return scan_orca_output(content).orbital_data()
+
+    orbital_data = scanner.orbital_data()
+    orbital_data["final_energy"] = read_final_energy(content)
+    return orbital_data
+
+
+@cached_parse(PARSER_VERSION)
+def extract_vibrational_data(file_path):
+    """
+    Extrai as freq. vibracionais e espectro IR do arquivo de saída
+    :param file_path:
+    :return: json com os pares chave:valor
+    """
+    return scan_orca_output(file_path).vibrational_data()
+
+
 if __name__ == '__main__':
      vibrational_data = extract_vibrational_data(file_path='C:/Users/User/aws/testmoqueca/h2o.out')
      orbital_data = extract_orbitals_and_homos(content='C:/Users/User/aws/testmoqueca/00grau3GRton3GRtm3.out')
      print(f"Dados de fonons: {vibrational_data}\n"
            f"Dados de orbitais: {orbital_data}")
-
-
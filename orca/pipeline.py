@@ -1,82 +1,116 @@
-from .db_manager import connect_to_db, create_or_update_tables, insert_orca_data, insert_status_data, create_session, JobStatus, Job
-from .parser import extract_vibrational_data, extract_orbitals_and_homos
+from .db_manager import connect_to_db, create_or_update_tables, upsert_orca_data, insert_orca_batch, create_session, find_job_by_hash, JobStatus, Job, BATCH_SIZE
+from .parser import parse_orca_output, scanner_result
 from .monitor import monitor_jobs
+from .spectrum import spectrum_cache
+from common.readers import file_content_hash
+from common.jobs import write_jobs, HARTREE_TO_EV
 from datetime import datetime
-from sqlalchemy.sql import text
 
 
 def create_database_orca(engine):
     """Cria ou atualiza as tabelas no banco de dados."""
-    create_or_update_tables(engine)
+    return create_or_update_tables(engine)
 
 
-def process_and_store_orca_data(output_file, user_id, sys_name, engine, desc):
+def orca_job_values(orca_data, user_id, sys_name, desc):
+    """Colunas de orca_jobs a partir do resultado de parse_orca_output/scanner_result."""
+    orbital_data = orca_data.get('orbital_data')
+    orbital_spectrum = orca_data.get('orbital_spectrum')
+    vib_data = orca_data.get('vib_data')
+    opt_trajectory = orca_data.get('opt_trajectory')
+
+    return dict(
+        package='ORCA',
+        user_id=user_id,
+        sys_name=sys_name,
+        description=desc,
+        content_hash=orca_data.get('content_hash'),
+        updated_at=datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        final_energy=orca_data.get('final_energy'),
+        spin_up_orbitals=orbital_data.get('spin_up_orbitals') if orbital_data else None,
+        spin_down_orbitals=orbital_data.get('spin_down_orbitals') if orbital_data else None,
+        orbitals_up=orbital_spectrum['spin_up'].to_array() if orbital_spectrum else None,
+        orbitals_down=orbital_spectrum['spin_down'].to_array() if orbital_spectrum else None,
+        vibrational_frequencies=vib_data.get('vibrational_frequencies') if vib_data else None,
+        ir_spectrum=vib_data.get('ir_spectrum') if vib_data else None,
+        opt_cycles=len(opt_trajectory['cycles']) if opt_trajectory else None,
+        opt_elements=opt_trajectory['elements'] if opt_trajectory else None,
+        opt_energies=opt_trajectory['energies'].astype('<f8').tobytes() if opt_trajectory else None,
+        opt_gradient_norms=opt_trajectory['gradient_norms'].astype('<f8').tobytes() if opt_trajectory else None,
+        opt_coordinates=opt_trajectory['coordinates'].astype('<f8').tobytes() if opt_trajectory else None
+    )
+
+
+def orca_status_values(output_file, status, user_id):
+    """Colunas de orca_job_status (sem job_id)."""
+    return dict(
+        user_id=user_id,
+        output_file=output_file,
+        status=status,
+        package='ORCA',
+        created_at=datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    )
+
+
+def orca_core_values(job_values, status_values, job_id):
+    """Linha da tabela jobs (common.jobs) a partir das colunas de orca_jobs e orca_job_status."""
+    energy = job_values.get('final_energy')
+    return dict(
+        package='ORCA',
+        job_id=job_id,
+        created_at=job_values.get('created_at') or status_values.get('created_at'),
+        user_id=job_values.get('user_id'),
+        sys_name=job_values.get('sys_name'),
+        description=job_values.get('description'),
+        status=status_values.get('status'),
+        output_file=status_values.get('output_file'),
+        content_hash=job_values.get('content_hash'),
+        energy=energy * HARTREE_TO_EV if energy is not None else None,
+        updated_at=job_values.get('updated_at')
+    )
+
+
+def store_orca_job(session, output_file, orca_data, status, user_id, sys_name, desc):
+    """
+    Grava o estado atual do job na linha (única) da sua saída, o status e a linha da tabela
+    jobs, na mesma transação.
+    Chamado a cada verificação enquanto o job roda e uma última vez ao término; antes da
+    primeira energia SCF, final_energy fica nula.
+    :return: job ou None
+    """
+    values = orca_job_values(orca_data, user_id, sys_name, desc)
+    status_values = orca_status_values(output_file, status, user_id)
+    job_data = upsert_orca_data(
+        session, output_file, values, status_values,
+        core_row=lambda job: orca_core_values(dict(values, created_at=job.created_at), status_values, job.job_id)
+    )
+    if job_data:
+        print("Status do job armazenado com sucesso.")
+        # Espectros alargados em cache deixam de valer quando o job muda
+        spectrum_cache.invalidate(job_data.job_id)
+    return job_data
+
+
+def process_and_store_orca_data(output_file, user_id, sys_name, engine, desc, on_duplicate='upsert'):
+    """
+    :param on_duplicate: 'upsert' reprocessa e atualiza o job com o mesmo conteúdo ou caminho;
+                         'skip' não faz o parsing se o conteúdo já estiver gravado
+    """
     session = create_session(engine)
     if not session:
         print("Erro ao iniciar sessão no DB")
         return
 
     try:
-        status = monitor_jobs(output_file)
+        if on_duplicate == 'skip' and find_job_by_hash(session, file_content_hash(output_file)):
+            print(f"{output_file} já está armazenado (mesmo conteúdo). Nada a fazer.")
+            return
+        # Uma única leitura do arquivo fornece o status e todos os dados
+        orca_data = parse_orca_output(output_file)
+        status = monitor_jobs(output_file, job_done=orca_data.get('status'))
         if status in ('COMPLETED', 'RUNNING', 'FAILED'):
-            orbital_data = extract_orbitals_and_homos(output_file)
-            vib_data = extract_vibrational_data(output_file)
-
-            spin_up_orbitals = orbital_data.get('spin_up_orbitals') if orbital_data else None
-            spin_down_orbitals = orbital_data.get('spin_down_orbitals') if orbital_data else None
-            vibrational_frequencies = vib_data.get('vibrational_frequencies') if vib_data else None
-            ir_spectrum = vib_data.get('ir_spectrum') if vib_data else None
-
-            job_data = Job(
-                package='ORCA',
-                user_id=user_id,
-                sys_name=sys_name,
-                description=desc,
-                updated_at=datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-                final_energy=orbital_data.get('final_energy') if orbital_data else vib_data.get('final_energy'),
-                spin_up_orbitals=spin_up_orbitals,
-                spin_down_orbitals=spin_down_orbitals,
-                vibrational_frequencies=vibrational_frequencies,
-                ir_spectrum=ir_spectrum
-            )
-            job_data = insert_orca_data(session, job_data)
-            if job_data:
-                session.execute(text(
-                    """UPDATE orca_jobs
-                        SET spin_up_orbitals = NULL
-                        WHERE spin_up_orbitals::TEXT = 'null';
-
-                        UPDATE orca_jobs
-                        SET spin_down_orbitals = NULL
-                        WHERE spin_down_orbitals::TEXT = 'null';
-                        
-                        UPDATE orca_jobs
-                        SET vibrational_frequencies = NULL
-                        WHERE vibrational_frequencies::TEXT = 'null';
-                        
-                        UPDATE orca_jobs
-                        SET ir_spectrum = NULL
-                        WHERE ir_spectrum::TEXT = 'null';
-                    """
-                ))
-                session.commit()
-
-                try:
-                    orca_status_data = JobStatus(
-                        job_id=job_data.job_id,
-                        user_id=user_id,
-                        output_file=output_file,
-                        status=status,
-                        package='ORCA',
-                        created_at=datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                    )
-                    insert_status_data(session=session, data=orca_status_data)
-                    session.commit()
-                    print("Status do job armazenado com sucesso.")
-                except Exception as e:
-                    session.rollback()
-                    print(f"{e}")
-
+            # Chamadas repetidas para a mesma saída atualizam a mesma linha
+            store_orca_job(session, output_file, orca_data, status, user_id, sys_name, desc)
         else:
             print(f"O job terminou com status: {status}. Verifique os logs.")
             return
@@ -88,7 +122,70 @@ def process_and_store_orca_data(output_file, user_id, sys_name, engine, desc):
         session.close()
 
 
-def run_pipeline(scf_file, nscf_file=None, user_id=None, sys_name=None, desc=None):
+def ingest_orca_scan(output_file, scanner, user_id, sys_name, engine, desc, final=False):
+    """
+    Ingestão progressiva: grava o que um OrcaOutputScanner (alimentado só com as linhas
+    novas, ex.: pelo OutputFollower do daemon) já leu, sem reler o arquivo.
+    :param final: o job terminou; fecha o scanner e grava o status final
+    """
+    session = create_session(engine)
+    if not session:
+        print("Erro ao iniciar sessão no DB")
+        return
+
+    try:
+        if final:
+            scanner.close()
+            # O scanner só viu as linhas novas de cada verificação: o hash é calculado no fim
+            scanner.content_hash = file_content_hash(output_file)
+        status = (scanner.status() or 'RUNNING') if final else 'RUNNING'
+        orca_data = scanner_result(scanner, partial=not final)
+        store_orca_job(session, output_file, orca_data, status, user_id, sys_name, desc)
+    except Exception as e:
+        session.rollback()
+        print(f"Erro ao processar e armazenar os dados: {e}")
+    finally:
+        session.close()
+
+
+def backfill_outputs(outputs, engine, batch_size=BATCH_SIZE):
+    """
+    Carga em lote de saídas do ORCA já terminadas. Cada item de `outputs` é um dict com
+    output_file, user_id, sys_name e desc; os arquivos são lidos à medida que os lotes são
+    gravados (insert_orca_batch). Saídas sem energia SCF são ignoradas.
+    :return: número de jobs inseridos
+    """
+    def records():
+        for item in outputs:
+            output_file = item["output_file"]
+            try:
+                orca_data = parse_orca_output(output_file)
+            except Exception as e:
+                print(f"Erro ao processar {output_file}: {e}")
+                continue
+            if orca_data.get('final_energy') is None:
+                print(f"{output_file} não tem energia SCF. Ignorado.")
+                continue
+            # Sem a mensagem de término numa saída antiga, o job não terminou
+            status = orca_data.get('status') or 'FAILED'
+            yield (
+                orca_job_values(orca_data, item["user_id"], item["sys_name"], item.get("desc")),
+                orca_status_values(output_file, status, item["user_id"])
+            )
+
+    session = create_session(engine)
+    try:
+        return insert_orca_batch(session, records(), batch_size, after_batch=record_core_jobs)
+    finally:
+        session.close()
+
+
+def record_core_jobs(session, batch):
+    """Grava na tabela jobs os jobs de um lote de insert_orca_batch, na transação do lote."""
+    write_jobs(session, [orca_core_values(job, status, job_id) for job, status, job_id in batch])
+
+
+def run_pipeline(scf_file, nscf_file=None, user_id=None, sys_name=None, desc=None, on_duplicate='upsert'):
     # Conectar ao banco de dados
     engine = connect_to_db()
 
@@ -107,7 +204,8 @@ def run_pipeline(scf_file, nscf_file=None, user_id=None, sys_name=None, desc=Non
         user_id=user_id,
         sys_name=sys_name,
         desc=desc,
-        engine=engine
+        engine=engine,
+        on_duplicate=on_duplicate
     )
 
 
@@ -0,0 +1,113 @@
+from collections import OrderedDict
+import numpy as np
+from .db_manager import Job
+
+
+DEFAULT_GRID = (0.0, 4000.0, 1.0)  # cm**-1: início, fim, passo
+DEFAULT_WIDTH = 10.0  # FWHM em cm**-1
+CACHE_SIZE = 512
+# Limita o tamanho da matriz grade x modos avaliada de uma vez
+MAX_BLOCK_ELEMENTS = 1_000_000
+
+
+def ir_sticks(ir_spectrum):
+    """
+    Converte a lista de modos IR (formato de extract_vibrational_data) em arrays.
+    :return: (frequências em cm**-1, intensidades em km/mol)
+    """
+    if not ir_spectrum:
+        return np.empty(0), np.empty(0)
+    frequencies = np.fromiter((mode["frequency_cm1"] for mode in ir_spectrum), dtype=np.float64, count=len(ir_spectrum))
+    intensities = np.fromiter((mode["intensity"] for mode in ir_spectrum), dtype=np.float64, count=len(ir_spectrum))
+    return frequencies, intensities
+
+
+def make_grid(grid=DEFAULT_GRID):
+    start, stop, step = grid
+    return np.arange(start, stop + step / 2, step)
+
+
+def broaden(frequencies, intensities, grid, width=DEFAULT_WIDTH, shape='lorentzian'):
+    """
+    Alarga as linhas do espectro com perfis normalizados (área = intensidade).
+    A soma sobre os modos é feita por broadcasting, em blocos da grade.
+    :param width: largura a meia altura (FWHM) em cm**-1
+    :param shape: 'lorentzian' ou 'gaussian'
+    :return: array com a intensidade em cada ponto da grade
+    """
+    if shape not in ('lorentzian', 'gaussian'):
+        raise ValueError(f"Perfil desconhecido: {shape}")
+
+    frequencies = np.asarray(frequencies, dtype=np.float64)
+    intensities = np.asarray(intensities, dtype=np.float64)
+    grid = np.asarray(grid, dtype=np.float64)
+    curve = np.zeros_like(grid)
+    if frequencies.size == 0:
+        return curve
+
+    block = max(1, MAX_BLOCK_ELEMENTS // frequencies.size)
+    if shape == 'lorentzian':
+        half_width = width / 2.0
+        for start in range(0, grid.size, block):
+            delta = grid[start:start + block, None] - frequencies[None, :]
+            profile = (half_width / np.pi) / (delta ** 2 + half_width ** 2)
+            curve[start:start + block] = profile @ intensities
+    else:
+        sigma = width / (2.0 * np.sqrt(2.0 * np.log(2.0)))
+        norm = 1.0 / (sigma * np.sqrt(2.0 * np.pi))
+        for start in range(0, grid.size, block):
+            delta = grid[start:start + block, None] - frequencies[None, :]
+            profile = norm * np.exp(-0.5 * (delta / sigma) ** 2)
+            curve[start:start + block] = profile @ intensities
+    return curve
+
+
+class SpectrumCache:
+    """Cache LRU em memória dos espectros alargados, por (job, largura, perfil, grade)."""
+
+    def __init__(self, maxsize=CACHE_SIZE):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+
+    def get(self, key):
+        value = self._data.get(key)
+        if value is not None:
+            self._data.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self._data[key] = value
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def invalidate(self, job_id):
+        for key in [key for key in self._data if key[0] == job_id]:
+            del self._data[key]
+
+
+spectrum_cache = SpectrumCache()
+
+
+def broadened_ir_spectrum(session, job_id, width=DEFAULT_WIDTH, shape='lorentzian', grid=DEFAULT_GRID):
+    """
+    Espectro IR alargado de um job de orca_jobs, calculado uma vez e reaproveitado do cache.
+    :param grid: tupla (início, fim, passo) em cm**-1
+    :return: (grade, curva) como arrays somente leitura, ou None se o job não tiver espectro IR
+    """
+    key = (job_id, float(width), shape, tuple(grid))
+    cached = spectrum_cache.get(key)
+    if cached is not None:
+        return cached
+
+    job = session.get(Job, job_id)
+    if job is None or not job.ir_spectrum:
+        return None
+
+    frequencies, intensities = ir_sticks(job.ir_spectrum)
+    x = make_grid(grid)
+    y = broaden(frequencies, intensities, x, width=width, shape=shape)
+    x.flags.writeable = False
+    y.flags.writeable = False
+    spectrum_cache.put(key, (x, y))
+    return x, y
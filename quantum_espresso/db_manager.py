@@ -1,17 +1,24 @@
-from sqlalchemy import create_engine, Column, Integer, String, Float, DateTime, JSON, Boolean, ForeignKey
+from sqlalchemy import Column, Integer, BigInteger, String, Float, DateTime, Boolean, ForeignKey, LargeBinary
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, relationship
-from sqlalchemy.exc import SQLAlchemyError
-import dotenv, os
-
-dotenv.load_dotenv()
-db_url = (
-    f"postgresql+pg8000://{os.getenv('DB_USER')}:{os.getenv('DB_PASSWORD')}"
-    f"@{os.getenv('DB_HOST')}:{os.getenv('DB_PORT')}/{os.getenv('DB_NAME')}"
-)
+from sqlalchemy.orm import relationship
+from sqlalchemy.exc import SQLAlchemyError, IntegrityError
+from sqlalchemy.sql import text
+from common.bulk import bulk_insert_jobs, upsert_rows, write_rows, BATCH_SIZE
+from common.db import get_engine, get_session, ensure_schema, migrate_to_jsonb, migrate_to_packed, column_type, JSON_DOCUMENT
+from common.arrays import PackedArray
+from common.jobs import create_core_tables, copy_to_core, RY_TO_EV, write_jobs
+import numpy as np
+from datetime import datetime
+from .parser import parse_scf_history
 
 
 Base = declarative_base()
+# Incrementar a cada mudança nos modelos/update_tables para que create_or_update_tables as aplique
+SCHEMA_VERSION = 7
+JSON_COLUMNS = ('pseudopotentials', 'final_positions')
+ARRAY_COLUMNS = ('crystal_coord',)
+# Tentativas quando outro processo grava o mesmo conteúdo ao mesmo tempo (a segunda vira atualização)
+UPSERT_RETRIES = 2
 
 
 # Definindo as tabelas (Models)
@@ -22,7 +29,9 @@ class Job(Base):
     package = Column(String, nullable=False)
     user_id = Column(String, nullable=False)
     sys_name = Column(String, nullable=False)
-    desc = Column(String, nullable=True)
+    description = Column(String, nullable=True)
+    # sha256 do conteúdo (descomprimido) das saídas scf + nscf: o mesmo conteúdo nunca gera dois jobs
+    content_hash = Column(String(64), unique=True, index=True)
     updated_at = Column(DateTime, nullable=False)
     created_at = Column(DateTime)
     completed_at = Column(DateTime)
@@ -32,19 +41,32 @@ class Job(Base):
     kohn_sham_states = Column(Integer)
     total_energy = Column(Float)
     fermi_energy = Column(Float)
-    pseudopotentials = Column(JSON)
-    crystal_coord = Column(JSON)
+    vbm = Column(Float)
+    cbm = Column(Float)
+    band_gap = Column(Float)
+    pseudopotentials = Column(JSON_DOCUMENT)
+    # Vetores da célula (3 x 3, em unidades de alat)
+    crystal_coord = Column(PackedArray())
     scf_conv = Column(Boolean, unique=False, default=True)
+    # relax/vc-relax: geometria final e trajetória BFGS em float64 little-endian
+    # (energias em Ry, forças totais em Ry/bohr, posições n_steps x n_atoms x 3, células n_steps x 3 x 3 em Å)
+    final_positions = Column(JSON_DOCUMENT)
+    relax_steps = Column(Integer)
+    relax_energies = Column(LargeBinary)
+    relax_forces = Column(LargeBinary)
+    relax_positions = Column(LargeBinary)
+    relax_cells = Column(LargeBinary)
 
     job_status = relationship("JobStatus", back_populates="job", cascade="all, delete-orphan")
+    scf_history = relationship("ScfHistory", back_populates="job", uselist=False, cascade="all, delete-orphan")
 
 class JobStatus(Base):
     __tablename__ = 'qe_job_status'
 
     id = Column(Integer, primary_key=True, autoincrement=True)
-    job_id = Column(Integer, ForeignKey('qe_jobs.job_id'))
+    job_id = Column(Integer, ForeignKey('qe_jobs.job_id'), unique=True)
     user_id = Column(String, nullable=False)
-    scf_file = Column(String, nullable=False)
+    scf_file = Column(String, nullable=False, index=True)
     nscf_file = Column(String, nullable=True)
     status = Column(String, nullable=False)
     package = Column(String, nullable=False)
@@ -58,39 +80,68 @@ class JobStatus(Base):
         """
         Atualiza ou cria um registro de status para um job específico.
         """
-        existing_status = session.query(cls).filter_by(job_id=job_id).first()
-        if existing_status:
-            existing_status.status = status
-            existing_status.updated_at = datetime.utcnow()
-        else:
-            new_status = cls(job_id=job_id, status=status)
-            session.add(new_status)
-        session.commit()
+        return upsert_status(session, {"job_id": job_id, "status": status, "updated_at": datetime.utcnow()})
+
+
+class ScfHistory(Base):
+    """
+    Histórico de convergência SCF de um job: séries por iteração gravadas como bytes
+    little-endian (int32 para iterations, float64 para energies/accuracies), o offset
+    em bytes do arquivo até onde já foram lidas e o inode do arquivo nesse momento.
+    """
+    __tablename__ = 'qe_scf_history'
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    job_id = Column(Integer, ForeignKey('qe_jobs.job_id'), nullable=False, unique=True)
+    scf_file = Column(String, nullable=False)
+    byte_offset = Column(BigInteger, nullable=False, default=0)
+    # Um inode diferente na próxima leitura indica saída substituída: a série recomeça
+    file_inode = Column(BigInteger)
+    n_iterations = Column(Integer, nullable=False, default=0)
+    iterations = Column(LargeBinary, nullable=False, default=b'')
+    energies = Column(LargeBinary, nullable=False, default=b'')
+    accuracies = Column(LargeBinary, nullable=False, default=b'')
+    updated_at = Column(DateTime)
+
+    job = relationship('Job', back_populates='scf_history')
+
+    def as_arrays(self):
+        """Decodifica as séries para NumPy sem cópia."""
+        return {
+            "iterations": np.frombuffer(self.iterations, dtype='<i4'),
+            "energies": np.frombuffer(self.energies, dtype='<f8'),
+            "accuracies": np.frombuffer(self.accuracies, dtype='<f8')
+        }
 
 
 # Função para conectar ao banco de dados PostgreSQL
 def connect_to_db():
-    """Conecta ao banco de dados PostgreSQL usando SQLAlchemy e retorna o engine e o session."""
+    """Engine compartilhado (common.db), com pool de conexões e pre-ping."""
     try:
-        engine = create_engine(db_url)
-        return engine
+        return get_engine()
     except SQLAlchemyError as e:
         print(f"Erro ao conectar ao banco de dados: {e}")
         return None
 
 
 def create_session(engine):
-    Session = sessionmaker(bind=engine)
-    return Session()
+    """Sessão reaproveitada entre os jobs da mesma thread; session.close() a devolve ao registro."""
+    return get_session(engine)
 
 # Função para criar ou atualizar as tabelas do banco de dados
 def create_or_update_tables(engine):
-    """Cria ou atualiza as tabelas no banco de dados com base nos modelos definidos."""
+    """
+    Cria ou atualiza as tabelas no banco de dados com base nos modelos definidos.
+    :return: False se a migração falhou (ela é repetida na próxima chamada)
+    """
     try:
-        Base.metadata.create_all(engine)
-        print("Tabelas criadas ou atualizadas com sucesso.")
+        create_core_tables(engine)
+        if ensure_schema(engine, 'quantum_espresso', Base.metadata, SCHEMA_VERSION, upgrade=update_tables):
+            print("Tabelas criadas ou atualizadas com sucesso.")
+        return True
     except SQLAlchemyError as e:
         print(f"Erro ao criar ou atualizar as tabelas: {e}")
+        return False
 
 
 # Função para inserir um job na tabela 'jobs'
@@ -107,46 +158,192 @@ def insert_qe_data(session, job):
         return None
 
 
-# Função para inserir o status do job na tabela 'job_status'
-def insert_status_data(session, data):
-    """Insere o status de um job na tabela de status."""
-    try:
-        #verificar se o job_id já existe
-        exists_status = session.query(JobStatus).filter_by(job_id=data.job_id).first()
-        if exists_status:
-            exists_status.status = data.status
-            exists_status.scf_file = data.scf_file
-            exists_status.nscf_file = data.nscf_file
-            exists_status.updated_at = data.updated_at
-            session.commit()
-            print(f"Status do job {data.job_id} atualizado com sucesso.")
-        else:
-            job_status = JobStatus(
-                job_id=data.job_id,
-                user_id=data.user_id,
-                scf_file=data.scf_file,
-                nscf_file=data.nscf_file,
-                status=data.status,
-                package=data.package,
-                created_at=data.created_at,
-                updated_at=data.updated_at
-            )
-
-            session.add(job_status)
+def find_job_by_hash(session, content_hash):
+    """Job já gravado com este conteúdo, ou None."""
+    if not content_hash:
+        return None
+    return session.query(Job).filter(Job.content_hash == content_hash).first()
+
+
+def find_job_by_output(session, output_file):
+    """Job já associado a esta saída (chave: pacote + arquivo de saída, via tabela de status), ou None."""
+    return (session.query(Job)
+            .join(JobStatus, JobStatus.job_id == Job.job_id)
+            .filter(JobStatus.scf_file == output_file, Job.package == 'QE')
+            .order_by(Job.job_id.desc())
+            .first())
+
+
+def upsert_qe_data(session, output_file, values, status_values=None, core_row=None):
+    """
+    Insere o job desta saída ou atualiza o já existente, em vez de criar uma linha nova a cada chamada.
+    Na atualização só os campos com valor são escritos, e o SQLAlchemy deixa fora do UPDATE
+    as colunas cujo valor não mudou.
+    Com status_values e core_row, o status e a linha da tabela jobs são gravados na mesma
+    transação: ou os três valem, ou nenhum. Se outro processo gravar o mesmo conteúdo ao
+    mesmo tempo, a transação é desfeita e repetida, já como atualização do job gravado por ele.
+    :param values: dict coluna -> valor
+    :param status_values: dict com as colunas de qe_job_status (sem job_id)
+    :param core_row: função(job) -> linha da tabela jobs (common.jobs.write_jobs)
+    :return: job ou None em caso de erro
+    """
+    for attempt in range(UPSERT_RETRIES):
+        try:
+            # O mesmo conteúdo em outro caminho (ex.: cópia ou saída reenviada) também é o mesmo job
+            job = find_job_by_hash(session, values.get("content_hash")) or find_job_by_output(session, output_file)
+            inserted = job is None
+            if inserted:
+                job = Job(**values)
+                session.add(job)
+            else:
+                for key, value in values.items():
+                    if value is not None:
+                        setattr(job, key, value)
+            session.flush()
+            if status_values is not None:
+                write_rows(session, JobStatus, dict(status_values, job_id=job.job_id),
+                           update_columns=STATUS_UPDATE_COLUMNS)
+            if core_row is not None:
+                write_jobs(session, core_row(job))
             session.commit()
-            print(f"Status do job {data.job_id} inserido com sucesso.")
-    except SQLAlchemyError as e:
-        session.rollback()
-        print(f"Erro ao inserir o status do job: {e}")
+            print("Job inserido com sucesso." if inserted else f"Job {job.job_id} atualizado com sucesso.")
+            return job
+        except IntegrityError as e:
+            session.rollback()
+            if attempt + 1 == UPSERT_RETRIES:
+                print(f"Erro ao inserir ou atualizar o job: {e}")
+        except SQLAlchemyError as e:
+            session.rollback()
+            print(f"Erro ao inserir ou atualizar o job: {e}")
+            return None
+    return None
+
+
+def insert_qe_batch(session, records, batch_size=BATCH_SIZE, skip_existing=True, after_batch=None):
+    """
+    Insere um lote de jobs e seus status com INSERT multi-linha e um commit por lote
+    (ver common.bulk.bulk_insert_jobs). Usado na carga de muitas saídas de uma vez.
+    :param records: iterável de (dict do job, dict do status sem job_id)
+    :return: número de jobs inseridos
+    """
+    return bulk_insert_jobs(session, Job, JobStatus, 'scf_file', records, batch_size, skip_existing, after_batch)
+
+
+# Colunas atualizadas quando o job já tem status (as demais ficam como na inserção)
+STATUS_UPDATE_COLUMNS = ('status', 'scf_file', 'nscf_file', 'updated_at')
+
+
+def _status_row(data):
+    return {column.key: getattr(data, column.key) for column in JobStatus.__table__.columns if column.key != 'id'}
+
+
+def upsert_status(session, changes):
+    """
+    Grava uma ou várias alterações de status (dict ou lista de dicts com job_id) com
+    INSERT ... ON CONFLICT (job_id) DO UPDATE: uma ida ao banco e um commit, sem SELECT
+    prévio e sem risco de dois monitores criarem status duplicados para o mesmo job.
+    :return: número de alterações gravadas ou None em caso de erro
+    """
+    return upsert_rows(session, JobStatus, changes, update_columns=STATUS_UPDATE_COLUMNS)
+
+
+def insert_status_data(session, data):
+    """Insere o status de um job na tabela de status, ou atualiza o existente."""
+    if upsert_status(session, _status_row(data)) is not None:
+        print(f"Status do job {data.job_id} gravado com sucesso.")
 
 
 # Função para atualizar as tabelas (caso necessário)
-def update_tables(engine):
-    """Atualiza as tabelas no banco de dados, se necessário."""
+def update_tables(connection):
+    """
+    Ajustes de schema que o create_all não faz em tabelas já existentes.
+    qe_job_status.job_id passa a ser único (exigido pelo ON CONFLICT do upsert_status):
+    status duplicados de um mesmo job são removidos, ficando o mais recente.
+    As colunas JSON passam a jsonb (com índice GIN), crystal_coord passa ao formato de PackedArray
+    e o índice de qe_job_status.scf_file é criado em tabelas anteriores a ele.
+    A coluna content_hash é adicionada com índice único, assim como vbm, cbm, band_gap,
+    final_positions e relax_* em tabelas anteriores a elas, e qe_scf_history.file_inode.
+    A coluna desc vira description (mesmo nome dos outros pacotes) e os jobs existentes
+    são copiados para a tabela jobs (common.jobs).
+    """
+    if connection.dialect.name != 'postgresql':
+        return
+    connection.execute(text(
+        """DELETE FROM qe_job_status a
+            USING qe_job_status b
+            WHERE a.job_id = b.job_id AND a.id < b.id"""
+    ))
+    connection.execute(text(
+        "CREATE UNIQUE INDEX IF NOT EXISTS qe_job_status_job_id_key ON qe_job_status (job_id)"
+    ))
+    migrate_to_jsonb(connection, 'qe_jobs', JSON_COLUMNS)
+    migrate_to_packed(connection, 'qe_jobs', 'job_id', ARRAY_COLUMNS)
+    for statement in (
+        "ALTER TABLE qe_jobs ADD COLUMN IF NOT EXISTS content_hash VARCHAR(64)",
+        "ALTER TABLE qe_jobs ADD COLUMN IF NOT EXISTS vbm DOUBLE PRECISION",
+        "ALTER TABLE qe_jobs ADD COLUMN IF NOT EXISTS cbm DOUBLE PRECISION",
+        "ALTER TABLE qe_jobs ADD COLUMN IF NOT EXISTS band_gap DOUBLE PRECISION",
+        "ALTER TABLE qe_jobs ADD COLUMN IF NOT EXISTS final_positions JSONB",
+        "ALTER TABLE qe_jobs ADD COLUMN IF NOT EXISTS relax_steps INTEGER",
+        "ALTER TABLE qe_jobs ADD COLUMN IF NOT EXISTS relax_energies BYTEA",
+        "ALTER TABLE qe_jobs ADD COLUMN IF NOT EXISTS relax_forces BYTEA",
+        "ALTER TABLE qe_jobs ADD COLUMN IF NOT EXISTS relax_positions BYTEA",
+        "ALTER TABLE qe_jobs ADD COLUMN IF NOT EXISTS relax_cells BYTEA",
+        "ALTER TABLE qe_scf_history ADD COLUMN IF NOT EXISTS file_inode BIGINT",
+        "CREATE UNIQUE INDEX IF NOT EXISTS ix_qe_jobs_content_hash ON qe_jobs (content_hash)",
+        "CREATE INDEX IF NOT EXISTS ix_qe_jobs_pseudopotentials ON qe_jobs USING gin (pseudopotentials jsonb_path_ops)",
+        "CREATE INDEX IF NOT EXISTS ix_qe_job_status_scf_file ON qe_job_status (scf_file)"
+    ):
+        connection.execute(text(statement))
+    if column_type(connection, 'qe_jobs', 'desc'):
+        connection.execute(text('ALTER TABLE qe_jobs RENAME COLUMN "desc" TO description'))
+    copy_to_core(connection, 'QE', f"""
+        SELECT 'QE', COALESCE(j.created_at, j.updated_at), j.job_id, j.user_id, j.sys_name,
+               j.description, s.status, s.scf_file, j.content_hash, j.total_energy * {RY_TO_EV}, j.updated_at
+        FROM qe_jobs j LEFT JOIN qe_job_status s ON s.job_id = j.job_id""")
+
+
+def update_scf_history(session, job_id, scf_file):
+    """
+    Atualiza o histórico SCF de um job lendo apenas os bytes escritos desde a última chamada.
+    As novas iterações são concatenadas no banco (bytea ||), sem reenviar a série inteira.
+    :return: dict de parse_scf_history só com as iterações novas ('reset' True se a série
+             recomeçou) ou None em caso de erro
+    """
     try:
-        # Exemplo: Verificar e aplicar alterações no schema, se necessário.
-        # Se você estiver usando Alembic para migrações, pode chamar a função `alembic.command.upgrade`.
-        pass
-    except SQLAlchemyError as e:
-        print(f"Erro ao atualizar as tabelas: {e}")
+        history = session.query(ScfHistory).filter_by(job_id=job_id).first()
+        if history is None:
+            history = ScfHistory(job_id=job_id, scf_file=scf_file, byte_offset=0, n_iterations=0,
+                                 iterations=b'', energies=b'', accuracies=b'')
+            session.add(history)
+            session.flush()
 
+        new_data = parse_scf_history(scf_file, history.byte_offset, history.file_inode)
+        count = len(new_data["iterations"])
+        if new_data["reset"]:
+            # Saída reescrita (job reiniciado): a série antiga não vale mais
+            history.iterations = new_data["iterations"].astype('<i4').tobytes()
+            history.energies = new_data["energies"].astype('<f8').tobytes()
+            history.accuracies = new_data["accuracies"].astype('<f8').tobytes()
+            history.n_iterations = count
+            history.byte_offset = new_data["offset"]
+            history.file_inode = new_data["inode"]
+            history.updated_at = datetime.now()
+        elif count:
+            session.query(ScfHistory).filter_by(id=history.id).update({
+                ScfHistory.iterations: ScfHistory.iterations.concat(new_data["iterations"].astype('<i4').tobytes()),
+                ScfHistory.energies: ScfHistory.energies.concat(new_data["energies"].astype('<f8').tobytes()),
+                ScfHistory.accuracies: ScfHistory.accuracies.concat(new_data["accuracies"].astype('<f8').tobytes()),
+                ScfHistory.n_iterations: ScfHistory.n_iterations + count,
+                ScfHistory.byte_offset: new_data["offset"],
+                ScfHistory.file_inode: new_data["inode"],
+                ScfHistory.updated_at: datetime.now()
+            }, synchronize_session=False)
+        elif history.file_inode != new_data["inode"]:
+            history.file_inode = new_data["inode"]
+        session.commit()
+        return new_data
+    except SQLAlchemyError as e:
+        session.rollback()
+        print(f"Erro ao atualizar o histórico SCF do job: {e}")
+        return None
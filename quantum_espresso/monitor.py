@@ -1,6 +1,49 @@
+import re
 import time
 import datetime
-from .db_manager import JobStatus
+from .db_manager import JobStatus, update_scf_history
+from .parser import scf_stalled, scf_tail, ITERATION_PATTERN, SCF_ACCURACY_PATTERN
+from common.readers import read_tail, tail_contains, OutputFollower
+from common.scheduler import PollClock, log_progress
+
+
+TAIL_SIZE = 64 * 1024
+DONE_MARKER = 'JOB DONE'
+ERROR_MARKERS = ('Error', 'stopping')
+CONV_THR_PATTERN = re.compile(r"convergence threshold\s*=\s*([-+]?[0-9]*\.?[0-9]+(?:[eEdD][-+]?\d+)?)")
+
+
+class ScfProgress:
+    """
+    Fração concluída do ciclo SCF corrente, estimada pela queda (em escala log) da
+    'estimated scf accuracy' desde a primeira iteração até o 'convergence threshold'.
+    Recebe as linhas novas do OutputFollower (on_line=progress.feed).
+    """
+
+    def __init__(self):
+        self.threshold = None
+        self.first = None
+        self.last = None
+
+    def feed(self, line):
+        if 'estimated scf accuracy' in line:
+            match = SCF_ACCURACY_PATTERN.search(line)
+            if match:
+                self.last = float(match.group(1))
+                if self.first is None:
+                    self.first = self.last
+        elif 'iteration #' in line:
+            match = ITERATION_PATTERN.search(line)
+            if match and int(match.group(1)) == 1:
+                # Novo ciclo SCF (próximo passo de uma relaxação ou o nscf)
+                self.first = self.last = None
+        elif 'convergence threshold' in line:
+            match = CONV_THR_PATTERN.search(line)
+            if match:
+                self.threshold = float(match.group(1).replace('D', 'E').replace('d', 'e'))
+
+    def fraction(self):
+        return log_progress(self.first, self.last, self.threshold)
 
 
 def check_job_done(scf_path, nscf_path=None):
@@ -13,16 +56,15 @@ def check_job_done(scf_path, nscf_path=None):
     error = False
 
     try:
-        with open(scf_path, 'r') as file:
-            content: str = file.read()
-            if "JOB DONE" in content:
-                scf_done = True
-            elif 'Error' in content or 'stopping' in content:
-                error = True
+        # 'JOB DONE' e as mensagens de erro só aparecem no fim da saída
+        tail = read_tail(scf_path, TAIL_SIZE)
+        if "JOB DONE" in tail:
+            scf_done = True
+        elif 'Error' in tail or 'stopping' in tail:
+            error = True
         if nscf_path:
-            with open(nscf_path, 'r') as file:
-                if "JOB DONE" in file.read():
-                    nscf_done = True
+            if tail_contains(nscf_path, "JOB DONE", TAIL_SIZE):
+                nscf_done = True
 
     except FileNotFoundError:
         print(f"Arquivo {scf_path} ou {nscf_path} não encontrado.")
@@ -33,17 +75,67 @@ def check_job_done(scf_path, nscf_path=None):
         return "COMPLETED"
 
 
+def follow_job(scf_follower, nscf_follower=None):
+    """
+    Mesma verificação de check_job_done, mas com OutputFollower: cada chamada lê apenas
+    o que foi escrito desde a anterior, e os marcadores já vistos ficam guardados no follower.
+    """
+    try:
+        scf_follower.poll()
+        if nscf_follower:
+            nscf_follower.poll()
+    except FileNotFoundError:
+        nscf_path = nscf_follower.file_path if nscf_follower else None
+        print(f"Arquivo {scf_follower.file_path} ou {nscf_path} não encontrado.")
+        return "FAILED"
+
+    if scf_follower.seen(DONE_MARKER):
+        if nscf_follower is None or nscf_follower.seen(DONE_MARKER):
+            return "COMPLETED"
+    elif any(scf_follower.seen(marker) for marker in ERROR_MARKERS):
+        return "FAILED"
+
+
+def watch_scf_history(session, job_id, scf_path, accuracies=()):
+    """
+    Acrescenta ao histórico SCF do job as iterações escritas desde a última chamada e avisa
+    se o ciclo SCF parou de convergir. O aviso usa só as iterações novas e o fim da série
+    guardado em memória pelo chamador, sem reler o histórico gravado.
+    :param accuracies: valor devolvido pela chamada anterior (vazio na primeira)
+    :return: fim da série de accuracies (scf_tail), para a próxima chamada
+    """
+    new_data = update_scf_history(session, job_id, scf_path)
+    if new_data is None or not (new_data["reset"] or len(new_data["accuracies"])):
+        return accuracies
+    accuracies = scf_tail(() if new_data["reset"] else accuracies, new_data["accuracies"])
+    if scf_stalled(accuracies):
+        print(f"Aviso: o ciclo SCF do job {job_id} não converge há várias iterações. Considere interromper.")
+    return accuracies
+
+
 def monitor_jobs(scf_path, nscf_path=None, timeout=172800, job_id=None, session=None):
     """
     Função para monitorar ambos os arquivos até que a string 'JOB DONE' seja encontrada
     em ambos os arquivos. Quando encontrada, o loop é interrompido, retornando o status.
+    O intervalo entre verificações é ajustado pelo PollClock: cresce enquanto os arquivos
+    não mudam e encurta conforme o SCF se aproxima do limiar de convergência.
+    Com job_id e session, o histórico SCF do job é atualizado a cada verificação; só o fim
+    da série de accuracies fica em memória para o aviso de SCF estagnado.
     """
     status = "PENDING"
     start_time = time.time()
     if job_id and session:
         JobStatus.update_status(session, job_id, status)
+    progress = ScfProgress()
+    accuracies = ()
+    clock = PollClock()
+    scf_follower = OutputFollower(scf_path, markers=(DONE_MARKER,) + ERROR_MARKERS, on_line=progress.feed)
+    nscf_follower = OutputFollower(nscf_path, markers=(DONE_MARKER,), on_line=progress.feed) if nscf_path else None
     while True:
-        job_done = check_job_done(scf_path, nscf_path)
+        job_done = follow_job(scf_follower, nscf_follower)
+        if job_id and session:
+            # Só os bytes novos desde a última verificação são lidos
+            accuracies = watch_scf_history(session, job_id, scf_path, accuracies)
 
         if job_done == "COMPLETED":
             status = "COMPLETED"
@@ -64,6 +156,8 @@ def monitor_jobs(scf_path, nscf_path=None, timeout=172800, job_id=None, session=
             if job_id and session:
                 JobStatus.update_status(session, job_id, status)
 
-        print("Aguardando que ambos os arquivos cheguem ao fim...")
-        time.sleep(600)  # Aguarda 10 minutos antes de verificar novamente.
+        size = sum(follower.size or 0 for follower in (scf_follower, nscf_follower) if follower)
+        delay = clock.observe(size, progress.fraction())
+        print(f"Aguardando que ambos os arquivos cheguem ao fim... (próxima verificação em {delay:.0f} s)")
+        time.sleep(delay)
 
@@ -1,43 +1,296 @@
 import re
 import json
 from datetime import datetime
+from array import array
+import numpy as np
+from common.bands import band_edges
+from common.readers import open_output, new_content_hash, OutputFollower
+from common.cache import cached_parse
+
+
+# Versão do formato dos resultados (chave do cache de parsing em common.cache)
+PARSER_VERSION = 2
+AXES_PATTERN = re.compile(r"a\(\d\)\s*=\s*\(\s*(-?[\d.]+)\s+(-?[\d.]+)\s+(-?[\d.]+)\s*\)")
+TOTAL_ENERGY_PATTERN = re.compile(r"^\s*!\s+total energy\s+=\s+([-+]?[0-9]*\.[0-9]+)")
+LATTICE_PARAM_PATTERN = re.compile(r"lattice parameter \(alat\)\s*=\s*([-+]?[0-9]*\.?[0-9]+)")
+NUM_ATOMIC_TYPES_PATTERN = re.compile(r"number of atomic types\s*=\s*(\d+)")
+KOHN_SHAM_STATES_PATTERN = re.compile(r"number of Kohn-Sham states\s*=\s*(\d+)")
+ENERGY_CUTOFF_PATTERN = re.compile(r"kinetic-energy cutoff\s*=\s*([-+]?[0-9]*\.?[0-9]+)")
+PSEUDOPOTENTIAL_PATTERN = re.compile(r"PSEUDOPOTENTIALS/(\S+)")
+STARTS_AT_PATTERN = re.compile(r"starts on (\d{2}[A-Za-z]{3}\d{4}) at (\d{2}:\d{2}:\d{2})")
+ENDS_AT_PATTERN = re.compile(r"This run was terminated on:\s+(\d{2}:\d{2}:\d{2})\s+(\d{2}[A-Za-z]{3}\d{4})")
+
+# Depois desta linha o pw.x não imprime mais nenhum campo do cabeçalho
+HEADER_END_MARKERS = ('Self-consistent Calculation', 'Starting wfcs')
 
 
 def extract_crystal_coordinates(content):
     if content is None:
         return None  # Retorna None se o conteúdo for None
 
-    axes_pattern = r"a\(\d\)\s*=\s*\(\s*(-?[\d.]+)\s+(-?[\d.]+)\s+(-?[\d.]+)\s*\)"
-    crystal_axes = re.findall(axes_pattern, content)
+    crystal_axes = AXES_PATTERN.findall(content)
 
     if crystal_axes:
-        print(f"Found crystal axes: {crystal_axes}")  # Exibe os eixos encontrados para verificação
         return [[float(coord) for coord in axis] for axis in crystal_axes]
-    else:
-        print("No crystal axes found.")
+    return None
+
+
+TOTAL_FORCE_PATTERN = re.compile(r"Total force\s*=\s*([-+]?[0-9]*\.?[0-9]+)")
+BLOCK_UNITS_PATTERN = re.compile(r"\(\s*([A-Za-z]+)\s*(?:=\s*([-+]?[0-9]*\.?[0-9]+))?\s*\)")
+POSITION_ROW_PATTERN = re.compile(r"^\s*([A-Za-z][A-Za-z0-9_]*)\s+(-?\d+\.\d+)\s+(-?\d+\.\d+)\s+(-?\d+\.\d+)")
+CELL_ROW_PATTERN = re.compile(r"^\s*(-?\d+\.\d+)\s+(-?\d+\.\d+)\s+(-?\d+\.\d+)\s*$")
+BOHR_TO_ANGSTROM = 0.529177210903
+
+
+class RelaxScanner:
+    """
+    Segue os passos BFGS de um relax/vc-relax: a cada bloco ATOMIC_POSITIONS fechado
+    devolve um passo com a energia ('!') e a força total que levaram a essa geometria e
+    a última CELL_PARAMETERS lida (convertida para Å). Apenas o passo corrente fica em memória.
+    """
+
+    def __init__(self):
+        self.index = 0
+        self.energy = np.nan
+        self.total_force = np.nan
+        self.cell = None
+        # lattice parameter do cabeçalho (bohr), usado quando CELL_PARAMETERS traz só 'alat'
+        self.alat = None
+        self._block = None
+        self._units = None
+        self._species = []
+        self._rows = array('d')
+        self._final = False
+
+    def feed(self, line):
+        """Processa uma linha; retorna o passo quando um bloco ATOMIC_POSITIONS termina."""
+        if self._block is not None:
+            pattern = POSITION_ROW_PATTERN if self._block == 'positions' else CELL_ROW_PATTERN
+            match = pattern.match(line)
+            if match:
+                if self._block == 'positions':
+                    self._species.append(match.group(1))
+                    self._rows.extend(map(float, match.groups()[1:]))
+                else:
+                    self._rows.extend(map(float, match.groups()))
+                return None
+            if len(self._rows) or line.strip():
+                return self._close_block()
+            return None
+
+        if line.startswith('!'):
+            match = TOTAL_ENERGY_PATTERN.search(line)
+            if match:
+                self.energy = float(match.group(1))
+        elif 'Total force' in line:
+            match = TOTAL_FORCE_PATTERN.search(line)
+            if match:
+                self.total_force = float(match.group(1))
+        elif line.startswith('ATOMIC_POSITIONS'):
+            self._open_block('positions', line)
+        elif line.startswith('CELL_PARAMETERS'):
+            self._open_block('cell', line)
+        elif 'Begin final coordinates' in line:
+            self._final = True
+        elif 'lattice parameter (alat)' in line:
+            match = LATTICE_PARAM_PATTERN.search(line)
+            if match:
+                self.alat = float(match.group(1))
         return None
 
-def parse_scf_output(file_path):
+    def _open_block(self, block, line):
+        self._block = block
+        match = BLOCK_UNITS_PATTERN.search(line)
+        self._units = match.groups() if match else (None, None)
+        self._species = []
+        self._rows = array('d')
+
+    def _close_block(self):
+        block, self._block = self._block, None
+        rows = np.array(self._rows, dtype=np.float64).reshape(-1, 3)
+        units, alat = self._units
+        if block == 'cell':
+            self.cell = cell_to_angstrom(rows, units, float(alat) if alat else self.alat)
+            return None
+        step = {
+            "step": self.index,
+            "energy": self.energy,
+            "total_force": self.total_force,
+            "species": self._species,
+            "positions": rows,
+            "positions_units": units,
+            "cell": self.cell,
+            "final": self._final
+        }
+        self.index += 1
+        return step
+
+    def close(self):
+        """Fecha um bloco que terminou junto com o arquivo."""
+        return self._close_block() if self._block is not None else None
+
+
+def cell_to_angstrom(cell, units, alat=None):
     """
-    Parses the output file for relevant structure data
-    :param file_path: asbolute file path
-    :return: Total energy and relevant data
+    Converte as linhas de CELL_PARAMETERS para Å.
+    :param alat: lattice parameter em bohr (do título ou do cabeçalho), para units 'alat'
+    :return: célula em Å, ou None se units for 'alat' e o lattice parameter não for conhecido
     """
-    try:
-        with open(file_path, 'r') as file:
-            content = file.read()
+    if units == 'bohr':
+        return cell * BOHR_TO_ANGSTROM
+    if units == 'alat':
+        return cell * (alat * BOHR_TO_ANGSTROM) if alat else None
+    return cell
+
+
+class RelaxTrajectory:
+    """Acumula os passos de um relax/vc-relax em buffers array('d') compactos."""
+
+    def __init__(self):
+        self.species = None
+        self.positions_units = None
+        self.energies = array('d')
+        self.total_forces = array('d')
+        self.positions = array('d')
+        self.cells = array('d')
+        self.final = None
+
+    def __len__(self):
+        return len(self.energies)
+
+    def append(self, step):
+        if self.species is None:
+            self.species = step["species"]
+            self.positions_units = step["positions_units"]
+        elif len(step["species"]) != len(self.species):
+            return
+        self.energies.append(step["energy"])
+        self.total_forces.append(step["total_force"])
+        self.positions.extend(step["positions"].ravel())
+        cell = step["cell"] if step["cell"] is not None else np.full((3, 3), np.nan)
+        self.cells.extend(cell.ravel())
+        self.final = step
+
+    def as_arrays(self):
+        if not len(self):
+            return None
+        n = len(self)
+        return {
+            "species": self.species,
+            "positions_units": self.positions_units,
+            "energies": np.array(self.energies, dtype=np.float64),
+            "total_forces": np.array(self.total_forces, dtype=np.float64),
+            "positions": np.array(self.positions, dtype=np.float64).reshape(n, -1, 3),
+            "cells": np.array(self.cells, dtype=np.float64).reshape(n, 3, 3)  # Å
+        }
+
+
+def iter_relax_steps(file_path):
+    """
+    Gera cada passo iônico (ATOMIC_POSITIONS/CELL_PARAMETERS, energia e força total)
+    de uma saída relax/vc-relax sem manter o arquivo em memória.
+    """
+    scanner = RelaxScanner()
+    with open_output(file_path, 'r') as file:
+        for line in file:
+            step = scanner.feed(line)
+            if step is not None:
+                yield step
+    step = scanner.close()
+    if step is not None:
+        yield step
+
+
+class ScfOutputScanner:
+    """
+    Percorre a saída do pw.x uma única vez usando uma tabela palavra-chave -> handler.
+    Os campos do cabeçalho saem da tabela assim que são encontrados (ou quando o
+    cabeçalho termina), então o restante do arquivo só é testado contra os campos finais.
+    """
+
+    def __init__(self):
+        self.matches = {}
+        self.pseudopotentials = []
+        self.crystal_axes = []
+        self.scf_conv = False
+        self.trajectory = RelaxTrajectory()
+        self._relax = RelaxScanner()
+        self._header = [
+            ('lattice parameter (alat)', self._single('lattice_param', LATTICE_PARAM_PATTERN)),
+            ('number of atomic types', self._single('num_atomic_types', NUM_ATOMIC_TYPES_PATTERN)),
+            ('number of Kohn-Sham states', self._single('kohn_sham_states', KOHN_SHAM_STATES_PATTERN)),
+            ('kinetic-energy cutoff', self._single('energy_cutoff', ENERGY_CUTOFF_PATTERN)),
+            ('starts on', self._single('starts_at', STARTS_AT_PATTERN)),
+            ('PSEUDOPOTENTIALS/', self._pseudopotential),
+            ('a(', self._crystal_axis),
+        ]
+        self._body = [
+            ('!', self._total_energy),
+            ('convergence has been achieved', self._convergence),
+            ('This run was terminated on', self._ends_at),
+        ]
+
+    def feed(self, line):
+        """Processa uma linha da saída."""
+        step = self._relax.feed(line)
+        if step is not None:
+            self.trajectory.append(step)
+
+        if self._header:
+            for keyword, handler in self._header:
+                if keyword in line:
+                    handler(line)
+                    return
+            if any(marker in line for marker in HEADER_END_MARKERS):
+                self._header = []
+                return
+
+        for keyword, handler in self._body:
+            if keyword in line:
+                handler(line)
+                return
+
+    def _single(self, key, pattern):
+        """Handler para campos que aparecem uma única vez no cabeçalho."""
+        def handler(line):
+            match = pattern.search(line)
+            if match:
+                self.matches[key] = match
+                self._header = [entry for entry in self._header if entry[1] is not handler]
+        return handler
+
+    def _pseudopotential(self, line):
+        self.pseudopotentials.extend(PSEUDOPOTENTIAL_PATTERN.findall(line))
+
+    def _crystal_axis(self, line):
+        self.crystal_axes.extend(AXES_PATTERN.findall(line))
+
+    def _total_energy(self, line):
+        # Mantém a última ocorrência (energia final em relax/vc-relax)
+        match = TOTAL_ENERGY_PATTERN.search(line)
+        if match:
+            self.matches['total_energy'] = match
 
-        total_energy = re.search(r"^\s*!\s+total energy\s+=\s+([-+]?[0-9]*\.[0-9]+)", content, re.MULTILINE)
-        lattice_param = re.search(r"lattice parameter \(alat\)\s*=\s*([-+]?[0-9]*\.?[0-9]+)", content)
-        num_atomic_types = re.search(r"number of atomic types\s*=\s*(\d+)", content)
-        kohn_sham_states = re.search(r"number of Kohn-Sham states\s*=\s*(\d+)", content)
-        energy_cutoff = re.search(r"kinetic-energy cutoff\s*=\s*([-+]?[0-9]*\.?[0-9]+)", content)
-        pseudopotentials = re.findall(r"PSEUDOPOTENTIALS/(\S+)", content)
-        scf_conv = re.search(r"convergence has been achieved", content)
-        crystal_coord = extract_crystal_coordinates(content)
+    def _convergence(self, line):
+        self.scf_conv = True
 
-        starts_at = re.search(r"starts on (\d{2}[A-Za-z]{3}\d{4}) at (\d{2}:\d{2}:\d{2})", content)
-        ends_at = re.search(r"This run was terminated on:\s+(\d{2}:\d{2}:\d{2})\s+(\d{2}[A-Za-z]{3}\d{4})", content)
+    def _ends_at(self, line):
+        match = ENDS_AT_PATTERN.search(line)
+        if match:
+            self.matches['ends_at'] = match
+
+    def close(self):
+        step = self._relax.close()
+        if step is not None:
+            self.trajectory.append(step)
+
+    def group(self, key):
+        match = self.matches.get(key)
+        return match.group(1) if match else None
+
+    def result(self):
+        starts_at = self.matches.get('starts_at')
+        ends_at = self.matches.get('ends_at')
 
         if starts_at:
             start_date, start_time = starts_at.groups()
@@ -52,18 +305,54 @@ def parse_scf_output(file_path):
         else:
             completed_at = None
 
+        crystal_coord = [[float(coord) for coord in axis] for axis in self.crystal_axes] or None
+        final_positions = None
+        final = self.trajectory.final
+        if final is not None:
+            # relax/vc-relax: a estrutura armazenada é a relaxada, não a inicial
+            lattice_param = self.group('lattice_param')
+            if final["cell"] is not None and lattice_param:
+                # Mesma convenção de crystal_coord: vetores em unidades de alat
+                crystal_coord = (final["cell"] / (float(lattice_param) * BOHR_TO_ANGSTROM)).tolist()
+            final_positions = {
+                "units": final["positions_units"],
+                "species": final["species"],
+                "positions": final["positions"].tolist()
+            }
+
         return {
             "created_at": created_at,
             "completed_at": completed_at,
-            "energy_cutoff": energy_cutoff.group(1) if energy_cutoff else None,
-            "lattice_param": lattice_param.group(1) if lattice_param else None,
-            "total_energy": total_energy.group(1) if total_energy else None,
-            "num_atomic_types": num_atomic_types.group(1) if num_atomic_types else None,
-            "kohn_sham_states": kohn_sham_states.group(1) if kohn_sham_states else None,
-            "pseudopotentials": ", ".join(pseudopotentials) if pseudopotentials else None,
+            "energy_cutoff": self.group('energy_cutoff'),
+            "lattice_param": self.group('lattice_param'),
+            "total_energy": self.group('total_energy'),
+            "num_atomic_types": self.group('num_atomic_types'),
+            "kohn_sham_states": self.group('kohn_sham_states'),
+            "pseudopotentials": ", ".join(self.pseudopotentials) if self.pseudopotentials else None,
             "crystal_coord": crystal_coord,
-            "scf_conv": bool(scf_conv.group(0) if scf_conv else None)
+            "scf_conv": self.scf_conv,
+            "final_positions": final_positions,
+            "relax_trajectory": self.trajectory.as_arrays()
         }
+
+
+@cached_parse(PARSER_VERSION)
+def parse_scf_output(file_path):
+    """
+    Parses the output file for relevant structure data
+    :param file_path: asbolute file path
+    :return: Total energy and relevant data
+    """
+    try:
+        scanner = ScfOutputScanner()
+        content_hash = new_content_hash()
+        with open_output(file_path, 'r', content_hash) as file:
+            for line in file:
+                scanner.feed(line)
+        scanner.close()
+        result = scanner.result()
+        result["content_hash"] = content_hash.hexdigest()
+        return result
     except FileNotFoundError:
         print(f"Arquivo {file_path} nao encontrado.")
         return {}
@@ -72,27 +361,258 @@ def parse_scf_output(file_path):
         return {}
 
 
-def parse_nscf_output(file_path):
+FLOAT_PATTERN = re.compile(r"-?\d+\.\d+")
+NUMBER_OF_K_POINTS_PATTERN = re.compile(r"number of k points\s*=\s*(\d+)")
+NUMBER_OF_ELECTRONS_PATTERN = re.compile(r"number of electrons\s*=\s*([-+]?[0-9]*\.?[0-9]+)")
+HEADER_K_POINT_PATTERN = re.compile(r"k\(\s*\d+\)\s*=\s*\(([^)]*)\),\s*wk\s*=\s*([-+]?[0-9]*\.?[0-9]+)")
+BANDS_K_POINT_PATTERN = re.compile(r"k\s*=\s*(.*?)\s*\(")
+FERMI_PATTERN = re.compile(r"Fermi energy is\s+([-\d.]+)")
+HOMO_LUMO_PATTERN = re.compile(r"highest occupied, lowest unoccupied level \(ev\):\s+([-\d.]+)\s+([-\d.]+)")
+HOMO_PATTERN = re.compile(r"highest occupied level \(ev\):\s+([-\d.]+)")
+BAND_LISTING_START_MARKERS = ('End of band structure calculation', 'End of self-consistent calculation')
+
+
+class BandStructureScanner:
     """
-    Parses the nscf output file for the Fermi energy value
-    :param file_path:
-    :return: fermi_energy
+    Lê as tabelas 'k = ... bands (ev):' de saídas nscf/bands (e scf) em uma única passada,
+    preenchendo arrays NumPy pré-alocados com nk x nbnd a partir do cabeçalho.
+    Se houver mais de uma listagem (relax), vale a última.
     """
-    try:
-        with open(file_path, 'r') as file:
-            content = file.read()
 
-        def extract_pattern(pattern, content, cast_type=None):
-            match = re.search(pattern, content)
+    def __init__(self):
+        self.nk = None
+        self.nbnd = None
+        self.nelec = None
+        self.fermi_level = None
+        self.homo = None
+        self.lumo = None
+        self.header_kpoints = []
+        self.header_weights = []
+        self.eigenvalues = None
+        self.kpoints = None
+        self._header_kpoints_done = False
+        self._spin = 0
+        self._ik = -1
+        self._filled = [0]
+        self._band = 0
+        self._pending = 0
+
+    def feed(self, line):
+        """Processa uma linha da saída."""
+        if self._pending:
+            values = FLOAT_PATTERN.findall(line)
+            if values:
+                count = min(len(values), self._pending)
+                self.eigenvalues[self._spin, self._ik, self._band:self._band + count] = values[:count]
+                self._band += count
+                self._pending -= count
+                return
+            if line.strip():
+                # Tabela incompleta (ex.: saída truncada)
+                self._pending = 0
+
+        if 'bands (ev)' in line:
+            self._start_k_point(line)
+        elif 'SPIN' in line and '------' in line:
+            self._spin = 1 if 'DOWN' in line else 0
+            self._ik = -1
+        elif any(marker in line for marker in BAND_LISTING_START_MARKERS):
+            self._spin = 0
+            self._ik = -1
+            self._filled = [0]
+        elif 'Fermi energy is' in line:
+            match = FERMI_PATTERN.search(line)
             if match:
-                return cast_type(match.group(1)) if cast_type else match.group(1)
-            return None
+                self.fermi_level = float(match.group(1))
+        elif 'highest occupied' in line:
+            match = HOMO_LUMO_PATTERN.search(line)
+            if match:
+                self.homo, self.lumo = float(match.group(1)), float(match.group(2))
+            else:
+                match = HOMO_PATTERN.search(line)
+                if match:
+                    self.homo = float(match.group(1))
+        elif self.nk is None and 'number of k points' in line:
+            match = NUMBER_OF_K_POINTS_PATTERN.search(line)
+            if match:
+                self.nk = int(match.group(1))
+        elif self.nbnd is None and 'number of Kohn-Sham states' in line:
+            match = KOHN_SHAM_STATES_PATTERN.search(line)
+            if match:
+                self.nbnd = int(match.group(1))
+        elif self.nelec is None and 'number of electrons' in line:
+            match = NUMBER_OF_ELECTRONS_PATTERN.search(line)
+            if match:
+                self.nelec = float(match.group(1))
+        elif not self._header_kpoints_done:
+            if 'cryst. coord.' in line:
+                # A segunda lista repete os mesmos pontos em coordenadas cristalinas
+                self._header_kpoints_done = bool(self.header_kpoints)
+            elif 'wk =' in line:
+                match = HEADER_K_POINT_PATTERN.search(line)
+                if match:
+                    self.header_kpoints.append([float(x) for x in FLOAT_PATTERN.findall(match.group(1))])
+                    self.header_weights.append(float(match.group(2)))
 
-        fermi_level = extract_pattern(r"Fermi energy is\s+([-\d.]+)", content, float)
+    def _start_k_point(self, line):
+        if self.nbnd is None:
+            return
+        self._ik += 1
+        self._ensure_capacity(self._ik)
+        match = BANDS_K_POINT_PATTERN.search(line)
+        if match:
+            coords = FLOAT_PATTERN.findall(match.group(1))
+            if len(coords) == 3:
+                self.kpoints[self._ik] = coords
+        if self._spin >= len(self._filled):
+            self._filled.append(0)
+        self._filled[self._spin] = max(self._filled[self._spin], self._ik + 1)
+        self._band = 0
+        self._pending = self.nbnd
 
-        return {
-            "fermi_level": fermi_level
+    def _ensure_capacity(self, ik):
+        """Aloca (ou amplia, se o cabeçalho não informou nk) os arrays de autovalores."""
+        nspin = self._spin + 1
+        if self.eigenvalues is None:
+            nk = max(self.nk or 0, ik + 1)
+            self.eigenvalues = np.full((nspin, nk, self.nbnd), np.nan)
+            self.kpoints = np.full((nk, 3), np.nan)
+            return
+        current_spins, current_nk, _ = self.eigenvalues.shape
+        if nspin > current_spins or ik >= current_nk:
+            nk = max(ik + 1, 2 * current_nk) if ik >= current_nk else current_nk
+            grown = np.full((max(nspin, current_spins), nk, self.nbnd), np.nan)
+            grown[:current_spins, :current_nk] = self.eigenvalues
+            self.eigenvalues = grown
+            kpoints = np.full((nk, 3), np.nan)
+            kpoints[:current_nk] = self.kpoints
+            self.kpoints = kpoints
+
+    def result(self):
+        nk = max(self._filled) if self.eigenvalues is not None else 0
+        eigenvalues = self.eigenvalues[:, :nk] if self.eigenvalues is not None else None
+        kpoints = self.kpoints[:nk] if self.kpoints is not None else None
+        weights = np.array(self.header_weights[:nk]) if len(self.header_weights) >= nk > 0 else None
+
+        edges = None
+        if eigenvalues is not None and nk:
+            reference = self.fermi_level if self.fermi_level is not None else self.homo
+            if reference is not None:
+                occupied = eigenvalues <= reference + 1e-6
+            elif self.nelec is not None and eigenvalues.shape[0] == 1:
+                # Sem referência de energia (ex.: calculation='bands'): ocupa as nelec/2 bandas mais baixas
+                occupied = np.arange(eigenvalues.shape[-1]) < int(round(self.nelec / 2))
+                occupied = np.broadcast_to(occupied, eigenvalues.shape)
+            else:
+                occupied = None
+            if occupied is not None:
+                edges = band_edges(np.nan_to_num(eigenvalues, nan=np.inf), occupied & ~np.isnan(eigenvalues))
+
+        result = {
+            "fermi_level": self.fermi_level,
+            "eigenvalues": eigenvalues,
+            "kpoints": kpoints,
+            "weights": weights
         }
+        result.update(edges or {"vbm": None, "cbm": None, "band_gap": None, "direct_gap": None})
+        return result
+
+
+ITERATION_PATTERN = re.compile(r"^\s*iteration #\s*(\d+)")
+# A iteração convergida é impressa como '!    total energy = ...'
+ITERATION_ENERGY_PATTERN = re.compile(r"^\s*!?\s*total energy\s+=\s+([-+]?[0-9]*\.[0-9]+)")
+SCF_ACCURACY_PATTERN = re.compile(r"estimated scf accuracy\s+<\s+([-+]?[0-9]*\.?[0-9]+(?:[eE][-+]?\d+)?)")
+
+
+def parse_scf_history(file_path, offset=0, inode=None):
+    """
+    Lê as iterações SCF ('iteration #', 'total energy', 'estimated scf accuracy') a partir
+    de um offset em bytes. O offset devolvido aponta para logo após a última iteração
+    completa, então uma iteração ainda sendo escrita é relida na próxima chamada.
+    Se o arquivo foi truncado desde o offset, ou substituído (inode diferente do gravado
+    com o offset), a leitura recomeça do início e 'reset' vem True: a série anterior deve
+    ser descartada. Sem inode, só o truncamento é detectado.
+    :param inode: inode devolvido pela chamada anterior junto com o offset
+    :return: dict com offset, inode, reset, iterations, energies (Ry) e accuracies (Ry) como arrays NumPy
+    """
+    iterations = []
+    energies = []
+    accuracies = []
+    iteration = None
+    energy = None
+    # O follower descarta a linha incompleta no fim do arquivo e detecta saídas reescritas
+    follower = OutputFollower(file_path, offset=offset, inode=inode)
+    new_offset = offset
+
+    for line in follower.iter_new_lines():
+        if 'iteration #' in line:
+            match = ITERATION_PATTERN.search(line)
+            iteration = int(match.group(1)) if match else None
+            energy = None
+        elif 'total energy' in line:
+            match = ITERATION_ENERGY_PATTERN.search(line)
+            if match:
+                energy = float(match.group(1))
+        elif 'estimated scf accuracy' in line and iteration is not None and energy is not None:
+            match = SCF_ACCURACY_PATTERN.search(line)
+            if match:
+                iterations.append(iteration)
+                energies.append(energy)
+                accuracies.append(float(match.group(1)))
+                iteration = energy = None
+                new_offset = follower.offset
+    if follower.resets and not iterations:
+        new_offset = 0
+
+    return {
+        "offset": new_offset,
+        "inode": follower.inode,
+        "reset": bool(follower.resets),
+        "iterations": np.array(iterations, dtype=np.int32),
+        "energies": np.array(energies, dtype=np.float64),
+        "accuracies": np.array(accuracies, dtype=np.float64)
+    }
+
+
+def scf_stalled(accuracies, window=10):
+    """
+    Indica se o ciclo SCF parou de convergir: nas últimas `window` iterações a
+    'estimated scf accuracy' não ficou abaixo do melhor valor anterior.
+    """
+    accuracies = np.asarray(accuracies)
+    if len(accuracies) <= window:
+        return False
+    return bool(accuracies[-window:].min() >= accuracies[:-window].min())
+
+
+def scf_tail(tail, accuracies, window=10):
+    """
+    Junta as accuracies novas ao trecho guardado em memória pelo monitor, mantendo só as
+    últimas `window` e, antes delas, o menor valor anterior. scf_stalled(tail, window) dá o
+    mesmo resultado que sobre a série inteira, sem reler o histórico gravado no banco.
+    """
+    series = np.concatenate((np.asarray(tail, dtype=np.float64), np.asarray(accuracies, dtype=np.float64)))
+    if len(series) <= window + 1:
+        return series
+    return np.concatenate(([series[:-window].min()], series[-window:]))
+
+
+@cached_parse(PARSER_VERSION)
+def parse_nscf_output(file_path):
+    """
+    Parses the nscf output file for the Fermi energy value and the band eigenvalues
+    :param file_path:
+    :return: fermi_level, eigenvalues (spin, nk, nbnd), kpoints, weights e bordas de banda
+    """
+    try:
+        scanner = BandStructureScanner()
+        content_hash = new_content_hash()
+        with open_output(file_path, 'r', content_hash) as file:
+            for line in file:
+                scanner.feed(line)
+        result = scanner.result()
+        result["content_hash"] = content_hash.hexdigest()
+        return result
 
     except FileNotFoundError:
         print(f"Arquivo {file_path} nao encontrado.")
@@ -1,24 +1,162 @@
-import json
-from .db_manager import connect_to_db, create_or_update_tables, insert_qe_data, insert_status_data, create_session, JobStatus, Job
+from .db_manager import connect_to_db, create_or_update_tables, upsert_qe_data, insert_qe_batch, insert_status_data, update_scf_history, create_session, find_job_by_hash, JobStatus, Job, BATCH_SIZE
 from .parser import parse_scf_output, parse_nscf_output
-from .monitor import monitor_jobs
+from .monitor import monitor_jobs, check_job_done, watch_scf_history
+from common.readers import file_content_hash, combined_hash
+from common.jobs import write_jobs, RY_TO_EV
 from datetime import datetime
 
 
 def create_database(engine):
     """Cria ou atualiza as tabelas no banco de dados."""
-    create_or_update_tables(engine)
+    return create_or_update_tables(engine)
 
 
-def process_and_store_data(scf_file, nscf_file, user_id, sys_name, engine, desc):
+def qe_job_values(scf_data, nscf_data, status, user_id, sys_name, desc):
+    """Colunas de qe_jobs a partir dos resultados de parse_scf_output e parse_nscf_output."""
+    relax_trajectory = scf_data.get("relax_trajectory")
+    job_values = dict(
+        package= "QE",
+        user_id= user_id,
+        sys_name= sys_name,
+        description=desc,
+        content_hash=combined_hash(scf_data.get("content_hash"), nscf_data.get("content_hash") if nscf_data else None),
+        updated_at= datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        created_at= scf_data.get("created_at"),
+        completed_at= scf_data.get("completed_at") if status == "COMPLETED" else None,
+        energy_cutoff= scf_data.get("energy_cutoff"),
+        lattice_param= scf_data.get("lattice_param"),
+        num_atomic_types= scf_data.get("num_atomic_types"),
+        kohn_sham_states= scf_data.get("kohn_sham_states"),
+        total_energy= scf_data.get("total_energy"),
+        fermi_energy= nscf_data.get("fermi_level", None) if nscf_data else None,
+        vbm= nscf_data.get("vbm") if nscf_data else None,
+        cbm= nscf_data.get("cbm") if nscf_data else None,
+        band_gap= nscf_data.get("band_gap") if nscf_data else None,
+        pseudopotentials= scf_data.get("pseudopotentials"),
+        crystal_coord= scf_data.get("crystal_coord"),
+        scf_conv= scf_data.get("scf_conv"),
+        final_positions= scf_data.get("final_positions"),
+        relax_steps= len(relax_trajectory["energies"]) if relax_trajectory else None,
+        relax_energies= relax_trajectory["energies"].astype('<f8').tobytes() if relax_trajectory else None,
+        relax_forces= relax_trajectory["total_forces"].astype('<f8').tobytes() if relax_trajectory else None,
+        relax_positions= relax_trajectory["positions"].astype('<f8').tobytes() if relax_trajectory else None,
+        relax_cells= relax_trajectory["cells"].astype('<f8').tobytes() if relax_trajectory else None
+    )
+    return job_values
+
+
+def qe_status_values(scf_file, nscf_file, status, scf_data, user_id):
+    """Colunas de qe_job_status (sem job_id)."""
+    return dict(
+        user_id=user_id,
+        scf_file=scf_file,
+        nscf_file=nscf_file if nscf_file else None,
+        status=status,
+        package='QE',
+        created_at=scf_data.get("created_at"),
+        updated_at=datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    )
+
+
+def qe_core_values(job_values, status_values, job_id):
+    """Linha da tabela jobs (common.jobs) a partir das colunas de qe_jobs e qe_job_status."""
+    energy = job_values.get("total_energy")
+    return dict(
+        package="QE",
+        job_id=job_id,
+        created_at=job_values.get("created_at"),
+        user_id=job_values.get("user_id"),
+        sys_name=job_values.get("sys_name"),
+        description=job_values.get("description"),
+        status=status_values.get("status"),
+        output_file=status_values.get("scf_file"),
+        content_hash=job_values.get("content_hash"),
+        energy=float(energy) * RY_TO_EV if energy is not None else None,
+        updated_at=job_values.get("updated_at")
+    )
+
+
+def qe_content_hash(scf_file, nscf_file=None):
+    """Hash do conteúdo do job (o mesmo gravado em qe_jobs.content_hash), sem fazer o parsing."""
+    try:
+        return combined_hash(file_content_hash(scf_file), file_content_hash(nscf_file) if nscf_file else None)
+    except OSError:
+        return None
+
+
+def start_qe_job(session, scf_file, nscf_file, user_id, sys_name, desc):
+    """
+    Grava o job desta saída com status PENDING antes do monitoramento, para que o histórico
+    SCF seja atualizado enquanto o job roda. Ao fim, upsert_qe_data encontra o mesmo job
+    pela saída (ou reaproveita o já existente, se a saída foi gravada antes).
+    :return: job ou None em caso de erro
+    """
+    job_data = upsert_qe_data(session, scf_file, dict(
+        package="QE",
+        user_id=user_id,
+        sys_name=sys_name,
+        description=desc,
+        updated_at=datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    ))
+    if job_data is not None:
+        status_values = qe_status_values(scf_file, nscf_file, "PENDING", {}, user_id)
+        insert_status_data(session=session, data=JobStatus(job_id=job_data.job_id, **status_values))
+    return job_data
+
+
+def follow_running_job(scf_file, nscf_file, user_id, sys_name, engine, desc, job_id=None, accuracies=()):
+    """
+    Usado pelo daemon a cada verificação em que a saída cresceu: grava o job na primeira
+    chamada (start_qe_job) e acrescenta ao histórico SCF só as iterações novas.
+    :return: (job_id, fim da série de accuracies) para a próxima chamada
+    """
+    session = create_session(engine)
+    try:
+        if job_id is None:
+            job_data = start_qe_job(session, scf_file, nscf_file, user_id, sys_name, desc)
+            if job_data is None:
+                return None, accuracies
+            job_id = job_data.job_id
+        return job_id, watch_scf_history(session, job_id, scf_file, accuracies)
+    finally:
+        session.close()
+
+
+def discard_running_job(session, running_job, kept_job_id):
+    """
+    Remove o job criado por start_qe_job quando o conteúdo já estava gravado em outro job
+    (kept_job_id). Jobs com resultados já gravados (content_hash) nunca são removidos.
+    """
+    if running_job is None or running_job.job_id == kept_job_id or running_job.content_hash:
+        return
+    try:
+        session.delete(running_job)
+        session.commit()
+    except Exception as e:
+        session.rollback()
+        print(f"Erro ao remover o job {running_job.job_id}: {e}")
+
+
+def process_and_store_data(scf_file, nscf_file, user_id, sys_name, engine, desc, on_duplicate='upsert'):
+    """
+    :param on_duplicate: 'upsert' reprocessa e atualiza o job com o mesmo conteúdo ou caminho;
+                         'skip' não faz o parsing se o conteúdo já estiver gravado
+    """
 
     session = create_session(engine)
     if not session:
         print("Erro ao criar a sessão.")
         return
     try:
+        # Antes de gravar qualquer coisa: um job já armazenado não tem status nem histórico reescritos
+        if on_duplicate == 'skip' and find_job_by_hash(session, qe_content_hash(scf_file, nscf_file)):
+            print(f"{scf_file} já está armazenado (mesmo conteúdo). Nada a fazer.")
+            return
+        # O job é gravado antes do monitoramento para o histórico SCF acompanhar a execução
+        running_job = start_qe_job(session, scf_file, nscf_file, user_id, sys_name, desc)
+        running_id = running_job.job_id if running_job else None
         # Monitora os arquivos e obtém o status
-        status = monitor_jobs(scf_file, nscf_file) if nscf_file else monitor_jobs(scf_file)
+        status = monitor_jobs(scf_file, nscf_file, job_id=running_id, session=session)
         if status in ("COMPLETED", "FAILED", "TIMEOUT", "FNF"):
             # Faz o parsing dos arquivos SCF e NSCF
             scf_data = parse_scf_output(scf_file)
@@ -26,50 +164,19 @@ def process_and_store_data(scf_file, nscf_file, user_id, sys_name, engine, desc)
             if nscf_file is None:
                 print("Aviso! Arquivo nscf não fornecido. Nível de Fermi será NULL! (apenas para o QE) Use o grep e seja feliz.")
             # Prepara os dados do job para inserção
-            job_data = Job(
-                package= "QE",
-                user_id= user_id,
-                sys_name= sys_name,
-                description=desc,
-                updated_at= datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-                created_at= scf_data.get("created_at"),
-                completed_at= scf_data.get("completed_at") if status == "COMPLETED" else None,
-                energy_cutoff= scf_data.get("energy_cutoff"),
-                lattice_param= scf_data.get("lattice_param"),
-                num_atomic_types= scf_data.get("num_atomic_types"),
-                kohn_sham_states= scf_data.get("kohn_sham_states"),
-                total_energy= scf_data.get("total_energy"),
-                fermi_energy= nscf_data.get("fermi_level", None) if nscf_data else None,
-                pseudopotentials= scf_data.get("pseudopotentials"),
-                crystal_coord= scf_data.get("crystal_coord"),
-                scf_conv= scf_data.get("scf_conv")
+            job_values = qe_job_values(scf_data, nscf_data, status, user_id, sys_name, desc)
+            status_values = qe_status_values(scf_file, nscf_file, status, scf_data, user_id)
+            # Reprocessar a mesma saída atualiza a linha existente em vez de duplicar o job;
+            # o status e a linha da tabela jobs são gravados na mesma transação
+            job_data = upsert_qe_data(
+                session, scf_file, job_values, status_values,
+                core_row=lambda job: qe_core_values(job_values, status_values, job.job_id)
             )
-
-            # Converte a lista de coordenadas cristalinas para JSON se houver
-            if job_data.crystal_coord:
-                job_data.crystal_coord = json.dumps(job_data.crystal_coord)
-            job_data = insert_qe_data(session, job_data)
-            # Insere os dados do job no banco de dados
-            try:
-                # Prepara os dados do status para inserção
-                dft_status_data = JobStatus(
-                    job_id=job_data.job_id,
-                    user_id=user_id,
-                    scf_file=scf_file,
-                    nscf_file=nscf_file if nscf_file else None,
-                    status=status,
-                    package='QE',
-                    created_at=scf_data.get("created_at"),
-                    updated_at=datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                )
-
-                # Insere o status do job no banco de dados
-                insert_status_data(session=session, data=dft_status_data)
-                session.commit()
-                print("Status do job armazenado com sucesso.")
-            except Exception as e:
-                session.rollback()
-                print(f"{e}")
+            if job_data is None:
+                return
+            print("Status do job armazenado com sucesso.")
+            discard_running_job(session, running_job, job_data.job_id)
+            update_scf_history(session, job_data.job_id, scf_file)
         else:
             print(f"O job terminou com status: {status}. Verifique os logs.")
             return
@@ -81,7 +188,42 @@ def process_and_store_data(scf_file, nscf_file, user_id, sys_name, engine, desc)
         session.close()
 
 
-def run_pipeline(scf_file, nscf_file=None, user_id=None, sys_name=None, desc=None):
+def backfill_outputs(outputs, engine, batch_size=BATCH_SIZE):
+    """
+    Carga em lote de saídas já terminadas, sem monitoramento. Cada item de `outputs` é um
+    dict com scf_file, nscf_file, user_id, sys_name e desc; os arquivos são lidos à medida
+    que os lotes são gravados (insert_qe_batch). O histórico SCF não é gravado nesse modo.
+    :return: número de jobs inseridos
+    """
+    def records():
+        for item in outputs:
+            scf_file, nscf_file = item["scf_file"], item.get("nscf_file")
+            try:
+                # Sem 'JOB DONE' numa saída antiga, o job não terminou
+                status = check_job_done(scf_file, nscf_file) or "FAILED"
+                scf_data = parse_scf_output(scf_file)
+                nscf_data = parse_nscf_output(nscf_file)
+            except Exception as e:
+                print(f"Erro ao processar {scf_file}: {e}")
+                continue
+            yield (
+                qe_job_values(scf_data, nscf_data, status, item["user_id"], item["sys_name"], item.get("desc")),
+                qe_status_values(scf_file, nscf_file, status, scf_data, item["user_id"])
+            )
+
+    session = create_session(engine)
+    try:
+        return insert_qe_batch(session, records(), batch_size, after_batch=record_core_jobs)
+    finally:
+        session.close()
+
+
+def record_core_jobs(session, batch):
+    """Grava na tabela jobs os jobs de um lote de insert_qe_batch, na transação do lote."""
+    write_jobs(session, [qe_core_values(job, status, job_id) for job, status, job_id in batch])
+
+
+def run_pipeline(scf_file, nscf_file=None, user_id=None, sys_name=None, desc=None, on_duplicate='upsert'):
     # Conectar ao banco de dados
     engine = connect_to_db()
 
@@ -101,6 +243,7 @@ def run_pipeline(scf_file, nscf_file=None, user_id=None, sys_name=None, desc=Non
         user_id=user_id,
         sys_name=sys_name,
         engine=engine,
-        desc=desc
+        desc=desc,
+        on_duplicate=on_duplicate
     )
 
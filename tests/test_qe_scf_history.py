@@ -0,0 +1,58 @@
+import numpy as np
+from quantum_espresso.parser import parse_scf_history, scf_stalled, scf_tail
+
+
+SCF_OUTPUT = """\
+     iteration #  1     ecut=    30.00 Ry     beta= 0.70
+     total energy              =     -15.79103983 Ry
+     estimated scf accuracy    <       0.06376267 Ry
+
+     iteration #  2     ecut=    30.00 Ry     beta= 0.70
+
+     End of self-consistent calculation
+
+!    total energy              =     -15.79441848 Ry
+     estimated scf accuracy    <       0.00000069 Ry
+
+     convergence has been achieved in   2 iterations
+"""
+
+
+def test_converged_iteration_is_read(tmp_path):
+    output = tmp_path / "scf.out"
+    output.write_text(SCF_OUTPUT)
+
+    history = parse_scf_history(str(output))
+    assert history["iterations"].tolist() == [1, 2]
+    assert history["energies"].tolist() == [-15.79103983, -15.79441848]
+    assert history["accuracies"].tolist() == [0.06376267, 0.00000069]
+
+    # O offset passa do bloco convergido: a próxima leitura não encontra iterações
+    again = parse_scf_history(str(output), history["offset"])
+    assert len(again["iterations"]) == 0
+    assert not again["reset"]
+
+
+def test_scf_tail_matches_full_series():
+    accuracies = np.array([1.0, 0.5, 0.2, 0.3, 0.4, 0.25, 0.3, 0.21, 0.22, 0.2])
+    tail = ()
+    for start in range(0, len(accuracies), 3):
+        tail = scf_tail(tail, accuracies[start:start + 3], window=4)
+        seen = accuracies[:start + 3]
+        assert scf_stalled(tail, window=4) == scf_stalled(seen, window=4)
+
+
+def test_replaced_output_restarts_series(tmp_path):
+    output = tmp_path / "scf.out"
+    output.write_text(SCF_OUTPUT)
+    history = parse_scf_history(str(output))
+
+    # Saída substituída por outra pelo menos tão longa quanto o offset gravado
+    replacement = tmp_path / "new.out"
+    replacement.write_text(SCF_OUTPUT.replace("-15.79103983", "-16.00000000") * 2)
+    replacement.replace(output)
+
+    again = parse_scf_history(str(output), history["offset"], history["inode"])
+    assert again["reset"]
+    assert again["energies"][0] == -16.0
+    assert len(again["iterations"]) == 4
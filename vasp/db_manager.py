@@ -1,17 +1,22 @@
-from sqlalchemy import create_engine, Column, Integer, String, Float, DateTime, JSON, Boolean, ForeignKey
+from sqlalchemy import Column, Integer, String, Float, DateTime, Boolean, ForeignKey, LargeBinary
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, relationship
-from sqlalchemy.exc import SQLAlchemyError
-import dotenv, os
-
-dotenv.load_dotenv()
-db_url = (
-    f"postgresql+pg8000://{os.getenv('DB_USER')}:{os.getenv('DB_PASSWORD')}"
-    f"@{os.getenv('DB_HOST')}:{os.getenv('DB_PORT')}/{os.getenv('DB_NAME')}"
-)
+from sqlalchemy.orm import relationship
+from sqlalchemy.exc import SQLAlchemyError, IntegrityError
+from sqlalchemy.sql import text
+from common.bulk import bulk_insert_jobs, upsert_rows, write_rows, BATCH_SIZE
+from common.db import get_engine, get_session, ensure_schema, migrate_to_jsonb, migrate_to_packed, JSON_DOCUMENT
+from common.arrays import PackedArray
+from common.jobs import create_core_tables, copy_to_core, write_jobs
+import numpy as np
 
 
 Base = declarative_base()
+# Incrementar a cada mudança nos modelos/update_tables para que create_or_update_tables as aplique
+SCHEMA_VERSION = 6
+JSON_COLUMNS = ('pseudopot', 'toten')
+ARRAY_COLUMNS = ('basis_vec', 'kpoints')
+# Tentativas quando outro processo grava o mesmo conteúdo ao mesmo tempo (a segunda vira atualização)
+UPSERT_RETRIES = 2
 
 
 class Job(Base):
@@ -22,26 +27,37 @@ class Job(Base):
     user_id = Column(String, nullable=False)
     sys_name = Column(String, nullable=False)
     description = Column(String, nullable=True)
+    # sha256 do conteúdo (descomprimido) da saída: a mesma saída nunca gera dois jobs
+    content_hash = Column(String(64), unique=True, index=True)
     created_at = Column(DateTime)
     updated_at = Column(DateTime, nullable=False)
     encut = Column(Float)
     num_atoms = Column(Integer)
-    basis_vec = Column(String)
-    kpoints = Column(String)
-    pseudopot = Column(JSON)
+    # Base inicial (3 x 3, Å) e k-points (n_kpoints x 3, coordenadas recíprocas)
+    basis_vec = Column(PackedArray())
+    kpoints = Column(PackedArray())
+    pseudopot = Column(JSON_DOCUMENT)
     efermi = Column(Float)
-    toten = Column(JSON)
+    toten = Column(JSON_DOCUMENT)
+    vbm = Column(Float)
+    cbm = Column(Float)
+    band_gap = Column(Float)
+    ionic_steps = Column(Integer)
 
     job_status = relationship("JobStatus", back_populates="job", cascade="all, delete-orphan")
+    trajectory = relationship("TrajectoryChunk", back_populates="job", cascade="all, delete-orphan",
+                              order_by="TrajectoryChunk.first_step")
 
 
 class JobStatus(Base):
     __tablename__ = 'vasp_job_status'
 
     id = Column(Integer, primary_key=True, autoincrement=True)
-    job_id = Column(Integer, ForeignKey('vasp_jobs.job_id'))
+    job_id = Column(Integer, ForeignKey('vasp_jobs.job_id'), unique=True)
     user_id = Column(String, nullable=False)
-    xml_file = Column(String, nullable=False)
+    xml_file = Column(String, nullable=False, index=True)
+    # 'COMPLETED' ou 'FAILED' (vasprun.xml truncado)
+    status = Column(String)
     package = Column(String, nullable=False)
     created_at = Column(DateTime)
     updated_at = Column(DateTime)
@@ -50,29 +66,60 @@ class JobStatus(Base):
     job = relationship('Job', back_populates='job_status')
 
 
+TRAJECTORY_CHUNK_SIZE = 500
+TRAJECTORY_DTYPE = '<f8'
+
+
+class TrajectoryChunk(Base):
+    """
+    Bloco de passos iônicos consecutivos de um job, com cada grandeza gravada como
+    float64 little-endian contíguo. Formatos após decodificar:
+    positions/forces (n_steps, n_atoms, 3), stress/cells (n_steps, 3, 3), energies (n_steps, 3).
+    """
+    __tablename__ = 'vasp_trajectory_chunks'
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    job_id = Column(Integer, ForeignKey('vasp_jobs.job_id'), nullable=False, index=True)
+    first_step = Column(Integer, nullable=False)
+    n_steps = Column(Integer, nullable=False)
+    n_atoms = Column(Integer, nullable=False)
+    positions = Column(LargeBinary)
+    forces = Column(LargeBinary)
+    stress = Column(LargeBinary)
+    cells = Column(LargeBinary)
+    energies = Column(LargeBinary)
+
+    job = relationship('Job', back_populates='trajectory')
+
+
 
 def connect_to_db():
-    """Conecta ao banco de dados PostgreSQL usando SQLAlchemy e retorna o engine e o session."""
+    """Engine compartilhado (common.db), com pool de conexões e pre-ping."""
     try:
-        engine = create_engine(db_url)
-        return engine
+        return get_engine()
     except SQLAlchemyError as e:
         print(f"Erro ao conectar ao banco de dados: {e}")
         return None
 
 
 def create_session(engine):
-    Session = sessionmaker(bind=engine)
-    return Session()
+    """Sessão reaproveitada entre os jobs da mesma thread; session.close() a devolve ao registro."""
+    return get_session(engine)
 
 # Função para criar ou atualizar as tabelas do banco de dados
 def create_or_update_tables(engine):
-    """Cria ou atualiza as tabelas no banco de dados com base nos modelos definidos."""
+    """
+    Cria ou atualiza as tabelas no banco de dados com base nos modelos definidos.
+    :return: False se a migração falhou (ela é repetida na próxima chamada)
+    """
     try:
-        Base.metadata.create_all(engine)
-        print("Tabelas criadas ou atualizadas com sucesso.")
+        create_core_tables(engine)
+        if ensure_schema(engine, 'vasp', Base.metadata, SCHEMA_VERSION, upgrade=update_tables):
+            print("Tabelas criadas ou atualizadas com sucesso.")
+        return True
     except SQLAlchemyError as e:
         print(f"Erro ao criar ou atualizar as tabelas: {e}")
+        return False
 
 
 # Função para inserir um job na tabela 'jobs'
@@ -89,28 +136,219 @@ def insert_vasp_data(session, job):
         return None
 
 
+def find_job_by_hash(session, content_hash):
+    """Job já gravado com este conteúdo, ou None."""
+    if not content_hash:
+        return None
+    return session.query(Job).filter(Job.content_hash == content_hash).first()
+
+
+def find_job_by_output(session, output_file):
+    """Job já associado a esta saída (chave: pacote + arquivo de saída, via tabela de status), ou None."""
+    return (session.query(Job)
+            .join(JobStatus, JobStatus.job_id == Job.job_id)
+            .filter(JobStatus.xml_file == output_file, Job.package == 'vasp')
+            .order_by(Job.job_id.desc())
+            .first())
+
+
+def upsert_vasp_data(session, output_file, values, status_values=None, core_row=None):
+    """
+    Insere o job desta saída ou atualiza o já existente, em vez de criar uma linha nova a cada chamada.
+    Na atualização só os campos com valor são escritos, e o SQLAlchemy deixa fora do UPDATE
+    as colunas cujo valor não mudou.
+    Com status_values e core_row, o status e a linha da tabela jobs são gravados na mesma
+    transação: ou os três valem, ou nenhum. Se outro processo gravar o mesmo conteúdo ao
+    mesmo tempo, a transação é desfeita e repetida, já como atualização do job gravado por ele.
+    :param values: dict coluna -> valor
+    :param status_values: dict com as colunas de vasp_job_status (sem job_id)
+    :param core_row: função(job) -> linha da tabela jobs (common.jobs.write_jobs)
+    :return: job ou None em caso de erro
+    """
+    for attempt in range(UPSERT_RETRIES):
+        try:
+            # O mesmo conteúdo em outro caminho (ex.: cópia ou saída reenviada) também é o mesmo job
+            job = find_job_by_hash(session, values.get("content_hash")) or find_job_by_output(session, output_file)
+            inserted = job is None
+            if inserted:
+                job = Job(**values)
+                session.add(job)
+            else:
+                for key, value in values.items():
+                    if value is not None:
+                        setattr(job, key, value)
+            session.flush()
+            if status_values is not None:
+                write_rows(session, JobStatus, dict(status_values, job_id=job.job_id),
+                           update_columns=STATUS_UPDATE_COLUMNS)
+            if core_row is not None:
+                write_jobs(session, core_row(job))
+            session.commit()
+            print("Job inserido com sucesso." if inserted else f"Job {job.job_id} atualizado com sucesso.")
+            return job
+        except IntegrityError as e:
+            session.rollback()
+            if attempt + 1 == UPSERT_RETRIES:
+                print(f"Erro ao inserir ou atualizar o job: {e}")
+        except SQLAlchemyError as e:
+            session.rollback()
+            print(f"Erro ao inserir ou atualizar o job: {e}")
+            return None
+    return None
+
+
+def insert_vasp_batch(session, records, batch_size=BATCH_SIZE, skip_existing=True, after_batch=None):
+    """
+    Insere um lote de jobs e seus status com INSERT multi-linha e um commit por lote
+    (ver common.bulk.bulk_insert_jobs). Usado na carga de muitas saídas de uma vez.
+    :param records: iterável de (dict do job, dict do status sem job_id)
+    :return: número de jobs inseridos
+    """
+    return bulk_insert_jobs(session, Job, JobStatus, 'xml_file', records, batch_size, skip_existing, after_batch)
+
+
+# Colunas atualizadas quando o job já tem status (as demais ficam como na inserção)
+STATUS_UPDATE_COLUMNS = ('status', 'xml_file', 'updated_at')
+
+
+def _status_row(data):
+    return {column.key: getattr(data, column.key) for column in JobStatus.__table__.columns if column.key != 'id'}
+
+
+def upsert_status(session, changes):
+    """
+    Grava uma ou várias alterações de status (dict ou lista de dicts com job_id) com
+    INSERT ... ON CONFLICT (job_id) DO UPDATE: uma ida ao banco e um commit, sem SELECT
+    prévio e sem risco de dois monitores criarem status duplicados para o mesmo job.
+    :return: número de alterações gravadas ou None em caso de erro
+    """
+    return upsert_rows(session, JobStatus, changes, update_columns=STATUS_UPDATE_COLUMNS)
+
+
 def insert_status_data(session, data):
-    """Insere o status de um job na tabela de status."""
+    """Insere o status de um job na tabela de status, ou atualiza o existente."""
+    if upsert_status(session, _status_row(data)) is not None:
+        print(f"Status do job {data.job_id} gravado com sucesso.")
+
+
+def _pack_steps(steps, key, shape):
+    values = [step[key] if step[key] is not None else np.full(shape, np.nan) for step in steps]
+    return np.ascontiguousarray(np.stack(values), dtype=TRAJECTORY_DTYPE).tobytes()
+
+
+def _build_chunk(job_id, steps):
+    n_atoms = next((len(step['positions']) for step in steps if step['positions'] is not None), 0)
+    return TrajectoryChunk(
+        job_id=job_id,
+        first_step=steps[0]['step'],
+        n_steps=len(steps),
+        n_atoms=n_atoms,
+        positions=_pack_steps(steps, 'positions', (n_atoms, 3)),
+        forces=_pack_steps(steps, 'forces', (n_atoms, 3)),
+        stress=_pack_steps(steps, 'stress', (3, 3)),
+        cells=_pack_steps(steps, 'cell', (3, 3)),
+        energies=_pack_steps(steps, 'energies', (3,))
+    )
+
+
+def insert_trajectory(session, job_id, steps, chunk_size=TRAJECTORY_CHUNK_SIZE):
+    """
+    Grava a trajetória de um job consumindo um iterável de passos (ver parser.iter_ionic_steps e parser.StepSpool).
+    Cada bloco de chunk_size passos é gravado e liberado antes de ler o próximo.
+    Uma trajetória já gravada para o job (reingestão da mesma saída) é substituída.
+    :return: número de passos gravados ou None em caso de erro
+    """
+    total = 0
+    buffer = []
     try:
-        #verificar se o job_id já existe
-        exists_status = session.query(JobStatus).filter_by(job_id=data.job_id).first()
-        if exists_status:
-            exists_status.xml_file = data.xml_file
-            session.commit()
-            print(f"Status do job {data.job_id} atualizado com sucesso.")
-        else:
-            job_status = JobStatus(
-                job_id=data.job_id,
-                user_id=data.user_id,
-                xml_file=data.xml_file,
-                package=data.package,
-                created_at=data.created_at,
-                updated_at=data.updated_at
-            )
-
-            session.add(job_status)
-            session.commit()
-            print(f"Status do job {data.job_id} inserido com sucesso.")
+        session.query(TrajectoryChunk).filter_by(job_id=job_id).delete(synchronize_session=False)
+        for step in steps:
+            buffer.append(step)
+            if len(buffer) == chunk_size:
+                chunk = _build_chunk(job_id, buffer)
+                session.add(chunk)
+                session.flush()
+                session.expunge(chunk)
+                total += len(buffer)
+                buffer = []
+        if buffer:
+            session.add(_build_chunk(job_id, buffer))
+            total += len(buffer)
+
+        job = session.get(Job, job_id)
+        if job:
+            job.ionic_steps = total
+        session.commit()
+        print(f"Trajetória do job {job_id} armazenada: {total} passos.")
+        return total
     except SQLAlchemyError as e:
         session.rollback()
-        print(f"Erro ao inserir o status do job: {e}")
\ No newline at end of file
+        print(f"Erro ao inserir a trajetória do job: {e}")
+        return None
+
+
+def iter_trajectory(session, job_id):
+    """
+    Lê a trajetória de um job bloco a bloco, decodificando os bytes direto para NumPy.
+    :return: gerador de dicts com arrays por bloco
+    """
+    chunk_ids = session.query(TrajectoryChunk.id).filter_by(job_id=job_id).order_by(TrajectoryChunk.first_step)
+    for (chunk_id,) in chunk_ids.all():
+        chunk = session.get(TrajectoryChunk, chunk_id)
+        n, atoms = chunk.n_steps, chunk.n_atoms
+        yield {
+            "first_step": chunk.first_step,
+            "positions": np.frombuffer(chunk.positions, dtype=TRAJECTORY_DTYPE).reshape(n, atoms, 3),
+            "forces": np.frombuffer(chunk.forces, dtype=TRAJECTORY_DTYPE).reshape(n, atoms, 3),
+            "stress": np.frombuffer(chunk.stress, dtype=TRAJECTORY_DTYPE).reshape(n, 3, 3),
+            "cells": np.frombuffer(chunk.cells, dtype=TRAJECTORY_DTYPE).reshape(n, 3, 3),
+            "energies": np.frombuffer(chunk.energies, dtype=TRAJECTORY_DTYPE).reshape(n, 3)
+        }
+        session.expunge(chunk)
+
+
+def update_tables(connection):
+    """
+    Ajustes de schema que o create_all não faz em tabelas já existentes.
+    vasp_job_status.job_id passa a ser único (exigido pelo ON CONFLICT do upsert_status):
+    status duplicados de um mesmo job são removidos, ficando o mais recente.
+    As colunas JSON passam a jsonb (com índices GIN e de expressão), basis_vec e kpoints
+    (antes o repr da lista em texto) passam ao formato de PackedArray e os índices
+    de vasp_job_status.xml_file e vasp_trajectory_chunks.job_id são criados em tabelas anteriores a eles.
+    A coluna content_hash é adicionada com índice único, assim como vbm, cbm, band_gap e
+    ionic_steps em tabelas anteriores a elas.
+    vasp_job_status ganha a coluna status e os jobs existentes são copiados para a tabela jobs
+    (common.jobs).
+    """
+    if connection.dialect.name != 'postgresql':
+        return
+    connection.execute(text(
+        """DELETE FROM vasp_job_status a
+            USING vasp_job_status b
+            WHERE a.job_id = b.job_id AND a.id < b.id"""
+    ))
+    connection.execute(text(
+        "CREATE UNIQUE INDEX IF NOT EXISTS vasp_job_status_job_id_key ON vasp_job_status (job_id)"
+    ))
+    migrate_to_jsonb(connection, 'vasp_jobs', JSON_COLUMNS)
+    migrate_to_packed(connection, 'vasp_jobs', 'job_id', ARRAY_COLUMNS)
+    for statement in (
+        "ALTER TABLE vasp_jobs ADD COLUMN IF NOT EXISTS content_hash VARCHAR(64)",
+        "ALTER TABLE vasp_jobs ADD COLUMN IF NOT EXISTS vbm DOUBLE PRECISION",
+        "ALTER TABLE vasp_jobs ADD COLUMN IF NOT EXISTS cbm DOUBLE PRECISION",
+        "ALTER TABLE vasp_jobs ADD COLUMN IF NOT EXISTS band_gap DOUBLE PRECISION",
+        "ALTER TABLE vasp_jobs ADD COLUMN IF NOT EXISTS ionic_steps INTEGER",
+        "CREATE UNIQUE INDEX IF NOT EXISTS ix_vasp_jobs_content_hash ON vasp_jobs (content_hash)",
+        "CREATE INDEX IF NOT EXISTS ix_vasp_jobs_pseudopot ON vasp_jobs USING gin (pseudopot jsonb_path_ops)",
+        # Expressão numérica, a mesma das consultas e do copy_to_core (o índice antigo era sobre o texto)
+        "DROP INDEX IF EXISTS ix_vasp_jobs_e0_energy",
+        "CREATE INDEX ix_vasp_jobs_e0_energy ON vasp_jobs (((toten ->> 'e_0_energy')::float8))",
+        "CREATE INDEX IF NOT EXISTS ix_vasp_job_status_xml_file ON vasp_job_status (xml_file)",
+        "CREATE INDEX IF NOT EXISTS ix_vasp_trajectory_chunks_job_id ON vasp_trajectory_chunks (job_id)"
+    ):
+        connection.execute(text(statement))
+    connection.execute(text("ALTER TABLE vasp_job_status ADD COLUMN IF NOT EXISTS status VARCHAR"))
+    copy_to_core(connection, 'vasp', """
+        SELECT 'vasp', COALESCE(j.created_at, j.updated_at), j.job_id, j.user_id, j.sys_name,
+               j.description, s.status, s.xml_file, j.content_hash, (j.toten ->> 'e_0_energy')::float8, j.updated_at
+        FROM vasp_jobs j LEFT JOIN vasp_job_status s ON s.job_id = j.job_id""")
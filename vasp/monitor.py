@@ -0,0 +1,41 @@
+import re
+from common.readers import OutputFollower
+
+
+DONE_MARKER = '</modeling>'
+NSW_PATTERN = re.compile(r'name="NSW"\s*>\s*(\d+)')
+
+
+class IonicProgress:
+    """Fração concluída de uma relaxação/MD: passos iônicos (<calculation>) fechados sobre o NSW."""
+
+    def __init__(self):
+        self.nsw = None
+        self.steps = 0
+
+    def feed(self, line):
+        if '</calculation>' in line:
+            self.steps += 1
+        elif 'name="NSW"' in line:
+            match = NSW_PATTERN.search(line)
+            if match:
+                self.nsw = int(match.group(1))
+
+    def fraction(self):
+        if not self.nsw:
+            return None
+        return min(1.0, self.steps / self.nsw)
+
+
+def new_follower(xml_path, on_line=None):
+    """OutputFollower do vasprun.xml: o arquivo está completo quando o <modeling> raiz fecha."""
+    return OutputFollower(xml_path, markers=(DONE_MARKER,), on_line=on_line)
+
+
+def follow_job(follower):
+    """
+    Verifica, lendo só os bytes novos, se o vasprun.xml já foi fechado.
+    :return: 'COMPLETED' ou None enquanto o VASP escreve
+    """
+    follower.poll()
+    return 'COMPLETED' if follower.seen(DONE_MARKER) else None
@@ -1,71 +1,394 @@
 from datetime import datetime
 import xml.etree.ElementTree as ET
 import logging
+import pickle
+import tempfile
+import numpy as np
+from common.bands import band_edges as _band_edges
+from common.readers import open_output, new_content_hash
+from common.cache import cached_parse
 
 
+# Versão do formato dos resultados (chave do cache de parsing em common.cache)
+PARSER_VERSION = 2
+TOTEN_FIELDS = ('e_fr_energy', 'e_wo_entrp', 'e_0_energy')
+SCALAR_FIELDS = ('ENCUT', 'EFERMI', 'GGA', 'date', 'time') + TOTEN_FIELDS
 
 
-def parse_vasprun(filepath):
+def iter_vasprun(filepath, content_hash=None):
     """
-    Parses the output file for relevant structure data
-    :param file_path: asbolute file path
-    :return: relevant data
+    Percorre o vasprun.xml com iterparse, devolvendo cada elemento no seu evento 'end'
+    junto com a pilha de ancestrais ainda abertos. Depois de consumido, o elemento é
+    limpo e removido do pai, então a memória não cresce com o tamanho do arquivo.
+    Arquivos truncados (job ainda rodando) são lidos até o último elemento completo.
+    :param content_hash: ver open_output
+    """
+    path = []
+    with open_output(filepath, 'rb', content_hash) as file:
+        try:
+            for event, elem in ET.iterparse(file, events=('start', 'end')):
+                if event == 'start':
+                    path.append(elem)
+                    continue
+                path.pop()
+                yield elem, path
+                elem.clear()
+                if path:
+                    path[-1].remove(elem)
+        except (ET.ParseError, EOFError) as e:
+            print(f"Aviso: {filepath} incompleto ou truncado ({e}). Usando os dados lidos até aqui.")
+
+
+class VasprunScanner:
+    """Coleta, em uma única passada, os campos do vasprun.xml usados pela pipeline."""
+
+    def __init__(self):
+        self.values = {}
+        self.num_atoms = None
+        self.basis = []
+        self.k_points = []
+        self.pseudopotentials = {}
+        self.complete = False
+        self._row = []
+
+    @staticmethod
+    def _in_atomtypes(path, depth):
+        if len(path) < depth:
+            return False
+        array = path[-depth]
+        return array.tag == 'array' and array.get('name') == 'atomtypes'
+
+    def feed(self, elem, path):
+        """Processa um elemento no seu evento 'end'."""
+        tag = elem.tag
+        parent = path[-1] if path else None
+
+        if tag == 'i':
+            name = elem.get('name')
+            if name in SCALAR_FIELDS and elem.text is not None:
+                self.values[name] = elem.text.strip()
+        elif tag == 'v' and parent is not None and parent.tag == 'varray':
+            name = parent.get('name')
+            # Apenas a primeira base (estrutura inicial) é armazenada
+            if name == 'basis' and len(self.basis) < 3:
+                self.basis.append([float(x) for x in elem.text.split()])
+            elif name == 'kpointlist':
+                self.k_points.append([float(x) for x in elem.text.split()])
+        elif tag == 'atoms' and parent is not None and parent.tag == 'atominfo':
+            self.num_atoms = int(elem.text)
+        elif tag == 'c' and self._in_atomtypes(path, depth=3):
+            # Os <c> já foram descartados quando o <rc> termina: guardamos o texto aqui
+            self._row.append((elem.text or '').strip())
+        elif tag == 'rc' and self._in_atomtypes(path, depth=2):
+            if len(self._row) >= 2:
+                self.pseudopotentials[self._row[1]] = self._row[-1]
+            self._row = []
+        elif not path:
+            self.complete = True
+
+    def result(self):
+        encut = self.values.get('ENCUT')
+        date_str = self.values.get('date')
+        time_str = self.values.get('time')
+        created_at = (
+            datetime.strptime(f"{date_str} {time_str}", "%Y %m %d %H:%M:%S")
+            if date_str and time_str else None
+        )
+
+        return {
+            "created_at": created_at,
+            "encut": float(encut) if encut is not None else None,
+            "efermi": self.values.get('EFERMI'),
+            "num_atoms": self.num_atoms,
+            "basis_vectors": self.basis[0:3],
+            "kpoints": self.k_points,
+            "xcorr": self.values.get('GGA'),
+            "pseudopotentials": self.pseudopotentials,
+            "toten": {field: self.values.get(field) for field in TOTEN_FIELDS},
+            # False se o vasprun.xml terminou antes de </modeling> (job interrompido ou rodando)
+            "complete": self.complete
+        }
+
+
+class _ArrayStacker:
+    """
+    Converte os <set>/<r> aninhados de um <array> do vasprun em um único ndarray.
+    O texto das linhas <r> de cada <set> mais interno é convertido de uma vez com
+    np.fromstring; os <set> externos apenas empilham os arrays dos filhos.
+    """
+
+    def __init__(self, keep_rows=None):
+        self.keep_rows = keep_rows
+        self._rows = []
+        self._row_index = 0
+        self._levels = {}
+
+    def row(self, elem):
+        if self.keep_rows is None or self._row_index in self.keep_rows:
+            self._rows.append(elem.text)
+        self._row_index += 1
+
+    def close_set(self, depth):
+        if self._row_index:
+            if self._rows:
+                data = np.fromstring(' '.join(self._rows), sep=' ').reshape(len(self._rows), -1)
+            else:
+                data = np.empty((0, 0))
+            self._rows = []
+            self._row_index = 0
+        else:
+            data = np.stack(self._levels.pop(depth + 1))
+        self._levels.setdefault(depth, []).append(data)
+
+    def close_array(self, depth):
+        sets = self._levels.pop(depth + 1, None)
+        return sets[0] if sets else None
+
+
+class ElectronicStructureScanner:
     """
-    tree = ET.parse(filepath)
-    root = tree.getroot()
-    def get_value(xpath, default=None):
+    Extrai os blocos <eigenvalues> e <dos> (e, opcionalmente, <projected>) do vasprun.xml.
+    Formatos:
+        eigenvalues: (spin, kpoint, band, 2)  -> [energia, ocupação]
+        dos_total:   (spin, energy, column)   -> [energia, total, integrada]
+        dos_partial: (ion, spin, energy, column)
+        projected:   (spin, kpoint, band, ion, orbital), apenas para os íons em projected_ions
+    O bloco <projected> é ignorado por padrão, pois cresce com íons x bandas x k-points.
+    """
+
+    def __init__(self, projected_ions=None):
+        self.projected_ions = set(projected_ions) if projected_ions is not None else None
+        self.eigenvalues = None
+        self.dos_total = None
+        self.dos_partial = None
+        self.projected = None
+        self.efermi = None
+        self._stacker = None
+        self._parent = None
+        self._parent_block = None
 
-        element = root.findall(xpath)
-        return element[-1].text.strip() if element is not None else default
+    @staticmethod
+    def _block(path):
+        tags = [el.tag for el in path]
+        if 'projected' in tags:
+            # Os autovalores repetidos dentro de <projected> são descartados
+            return None if 'eigenvalues' in tags else 'projected'
+        if 'eigenvalues' in tags:
+            return 'eigenvalues'
+        if 'dos' in tags:
+            if 'total' in tags:
+                return 'dos_total'
+            if 'partial' in tags:
+                return 'dos_partial'
+            return 'dos'
+        return None
 
-    encut = float(get_value(".//i[@name='ENCUT']"))
+    def feed(self, elem, path):
+        """Processa um elemento no seu evento 'end'."""
+        tag = elem.tag
+        if tag not in ('r', 'set', 'array', 'i') or not path:
+            return
 
-    num_atoms = int(root.find(".//atominfo/atoms").text)
+        # As linhas <r> de um mesmo <set> compartilham o bloco do pai
+        parent = path[-1]
+        if parent is not self._parent:
+            self._parent = parent
+            self._parent_block = self._block(path)
+        block = self._parent_block
+        if block is None:
+            return
 
-    basis = [
-        [float(x) for x in vector.text.split()]
-        for vector in root.findall(".//varray[@name='basis']/v")
-    ]
+        if tag == 'i':
+            if block == 'dos' and elem.get('name') == 'efermi':
+                self.efermi = float(elem.text)
+            return
+        if block == 'projected' and self.projected_ions is None:
+            return
 
-    efermi = get_value(".//i[@name='EFERMI']")
+        if self._stacker is None:
+            self._stacker = _ArrayStacker(self.projected_ions if block == 'projected' else None)
+        if tag == 'r':
+            self._stacker.row(elem)
+        elif tag == 'set':
+            self._stacker.close_set(len(path))
+        else:
+            setattr(self, block, self._stacker.close_array(len(path)))
+            self._stacker = None
 
-    k_points = [
-        [float(x) for x in vector.text.split()]
-        for vector in root.findall(".//varray[@name='kpointlist']/v")
-    ]
+    def result(self):
+        result = {
+            "efermi": self.efermi,
+            "eigenvalues": self.eigenvalues,
+            "dos_total": self.dos_total,
+            "dos_partial": self.dos_partial,
+            "projected": self.projected
+        }
+        edges = band_edges(self.eigenvalues) if self.eigenvalues is not None else None
+        result.update(edges or {"vbm": None, "cbm": None, "band_gap": None, "direct_gap": None})
+        return result
 
-    xcorr = get_value(".//i[@name='GGA']")
 
-    pseudopotentials = {
-        rc.findall("c")[1].text.strip(): rc.findall("c")[-1].text.strip()
-        for rc in root.findall(".//array[@name='atomtypes']/set/rc")
-        if len(rc.findall("c")) >= 2
-    }
+def band_edges(eigenvalues, occupation_threshold=0.5):
+    """
+    Calcula VBM, CBM, gap fundamental e gap direto a partir do array (spin, kpoint, band, 2).
+    :return: dict com os valores em eV, ou None se não houver estados ocupados e vazios
+    """
+    return _band_edges(eigenvalues[..., 0], eigenvalues[..., 1] > occupation_threshold)
+
+
+@cached_parse(PARSER_VERSION)
+def parse_electronic_structure(filepath, projected_ions=None):
+    """
+    Extrai autovalores, DOS e band gap do vasprun.xml como arrays NumPy.
+    :param projected_ions: índices (base 0) dos íons cujas projeções serão mantidas
+    :return: dict com os arrays e as bordas de banda
+    """
+    scanner = ElectronicStructureScanner(projected_ions)
+    for elem, path in iter_vasprun(filepath):
+        scanner.feed(elem, path)
+    return scanner.result()
 
-    toten = {
-        "e_fr_energy": get_value(".//i[@name='e_fr_energy']"),
-        "e_wo_entrp": get_value(".//i[@name='e_wo_entrp']"),
-        "e_0_energy": get_value(".//i[@name='e_0_energy']")
-    }
 
-    date_str = get_value(".//i[@name='date']")
-    time_str = get_value(".//i[@name='time']")
-    created_at = datetime.strptime(f"{date_str} {time_str}", "%Y %m %d %H:%M:%S")
+class IonicStepScanner:
+    """
+    Monta um passo iônico a cada <calculation> fechado: posições (fracionárias), forças,
+    stress, célula e energias, todos como arrays float64. Apenas o passo corrente fica
+    em memória.
+    """
 
-    return {
-        "created_at": created_at,
-        "encut": encut,
-        "efermi": efermi,
-        "num_atoms": num_atoms,
-        "basis_vectors": basis[0:3],
-        "kpoints": k_points,
-        "xcorr": xcorr,
-        "pseudopotentials": pseudopotentials,
-        "toten": toten
-    }
+    STEP_VARRAYS = ('basis', 'positions', 'forces', 'stress')
+
+    def __init__(self):
+        self.index = 0
+        self._rows = []
+        self._current = {}
+
+    def feed(self, elem, path):
+        """Processa um elemento no seu evento 'end'; retorna o passo quando um <calculation> termina."""
+        tag = elem.tag
+        depth = len(path)
+        if depth < 2 or path[1].tag != 'calculation':
+            if tag == 'calculation' and depth == 1:
+                return self._close_step()
+            return None
+
+        if tag == 'v':
+            parent = path[-1]
+            if parent.get('name') in self.STEP_VARRAYS and not self._in_scstep(path):
+                self._rows.append(elem.text)
+        elif tag == 'varray':
+            name = elem.get('name')
+            if name in self.STEP_VARRAYS and not self._in_scstep(path) and self._rows:
+                self._current[name] = np.fromstring(' '.join(self._rows), sep=' ').reshape(-1, 3)
+            self._rows = []
+        elif tag == 'i' and depth == 3 and path[2].tag == 'energy':
+            # Energias do passo iônico (filhas diretas de <calculation><energy>, não de <scstep>)
+            name = elem.get('name')
+            if name in TOTEN_FIELDS and elem.text is not None:
+                self._current[name] = float(elem.text)
+        return None
+
+    @staticmethod
+    def _in_scstep(path):
+        return len(path) > 2 and path[2].tag == 'scstep'
+
+    def _close_step(self):
+        current, self._current = self._current, {}
+        step = {
+            "step": self.index,
+            "positions": current.get('positions'),
+            "forces": current.get('forces'),
+            "stress": current.get('stress'),
+            "cell": current.get('basis'),
+            "energies": np.array([current.get(field, np.nan) for field in TOTEN_FIELDS])
+        }
+        self.index += 1
+        return step
+
+
+def iter_ionic_steps(filepath):
+    """
+    Gera cada passo iônico (relaxação ou MD) do vasprun.xml à medida que o iterparse avança.
+    Um <calculation> incompleto no fim de um arquivo truncado é descartado.
+    :return: gerador de dicts com arrays 'positions', 'forces', 'stress', 'cell' e 'energies'
+    """
+    scanner = IonicStepScanner()
+    for elem, path in iter_vasprun(filepath):
+        step = scanner.feed(elem, path)
+        if step is not None:
+            yield step
+
+
+class StepSpool:
+    """
+    Guarda num arquivo temporário local os passos iônicos entregues por scan_vasprun, um
+    pickle por passo, para que sejam gravados depois que o job já tiver job_id sem uma
+    segunda leitura do vasprun.xml. Só o passo corrente fica em memória.
+    """
+
+    def __init__(self):
+        self._file = tempfile.TemporaryFile()
+
+    def append(self, step):
+        pickle.dump(step, self._file, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def __iter__(self):
+        self._file.seek(0)
+        while True:
+            try:
+                yield pickle.load(self._file)
+            except EOFError:
+                return
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def scan_vasprun(filepath, with_bands=False, on_step=None):
+    """
+    Passada única do vasprun.xml usada por parse_vasprun (sem o cache de parsing).
+    :param on_step: função chamada com cada passo iônico (ver iter_ionic_steps) durante a
+                    mesma passada, ex.: StepSpool.append
+    """
+    scanner = VasprunScanner()
+    bands = ElectronicStructureScanner() if with_bands else None
+    steps = IonicStepScanner() if on_step else None
+    content_hash = new_content_hash()
+    for elem, path in iter_vasprun(filepath, content_hash):
+        if steps:
+            step = steps.feed(elem, path)
+            if step is not None:
+                on_step(step)
+        scanner.feed(elem, path)
+        if bands:
+            bands.feed(elem, path)
+
+    result = scanner.result()
+    result["content_hash"] = content_hash.hexdigest()
+    if bands:
+        electronic = bands.result()
+        result.update({key: electronic[key] for key in ("vbm", "cbm", "band_gap")})
+    return result
+
+
+@cached_parse(PARSER_VERSION)
+def parse_vasprun(filepath, with_bands=False):
+    """
+    Parses the output file for relevant structure data
+    :param file_path: asbolute file path
+    :param with_bands: também extrai VBM/CBM/band gap na mesma passada
+    :return: relevant data
+    """
+    return scan_vasprun(filepath, with_bands)
 
 
 if __name__ == '__main__':
     file_path = 'C:/Users/User/aws/testmoqueca/vasprun.xml'
     xml_data = parse_vasprun(file_path)
-    print(xml_data)
\ No newline at end of file
+    print(xml_data)
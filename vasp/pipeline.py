@@ -1,54 +1,106 @@
 import json
-from .db_manager import connect_to_db, create_or_update_tables, insert_vasp_data, insert_status_data, create_session, JobStatus, Job
-from .parser import parse_vasprun
+from .db_manager import connect_to_db, create_or_update_tables, upsert_vasp_data, insert_vasp_batch, insert_trajectory, create_session, find_job_by_hash, JobStatus, Job, BATCH_SIZE
+from .parser import parse_vasprun, scan_vasprun, StepSpool
+from common.readers import file_content_hash
+from common.jobs import write_jobs
 from datetime import datetime
 
 
 def create_database(engine):
     """Cria ou atualiza as tabelas no banco de dados."""
-    create_or_update_tables(engine)
+    return create_or_update_tables(engine)
 
 
-def process_and_store_data(xml_file, user_id, sys_name, desc, engine):
+def vasp_job_values(vasp_data, user_id, sys_name, desc):
+    """Colunas de vasp_jobs a partir do resultado de parse_vasprun."""
+    return dict(
+        package="vasp",
+        user_id=user_id,
+        sys_name=sys_name,
+        description=desc,
+        content_hash=vasp_data.get("content_hash"),
+        created_at=vasp_data.get("created_at"),
+        updated_at=datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        encut=vasp_data.get("encut"),
+        num_atoms=vasp_data.get("num_atoms"),
+        pseudopot=vasp_data.get("pseudopotentials"),
+        efermi=vasp_data.get("efermi"),
+        toten=vasp_data.get("toten"),
+        basis_vec=vasp_data.get("basis_vectors"),
+        kpoints=vasp_data.get("kpoints"),
+        vbm=vasp_data.get("vbm"),
+        cbm=vasp_data.get("cbm"),
+        band_gap=vasp_data.get("band_gap")
+    )
+
+
+def vasp_status_values(xml_file, created_at, user_id, status):
+    """Colunas de vasp_job_status (sem job_id)."""
+    return dict(
+        user_id=user_id,
+        xml_file=xml_file,
+        status=status,
+        package='vasp',
+        created_at=created_at,
+        updated_at=datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    )
+
+
+def vasp_job_status(vasp_data):
+    """'COMPLETED' se o vasprun.xml foi lido até o fim, senão 'FAILED'."""
+    return 'COMPLETED' if vasp_data.get("complete") else 'FAILED'
+
+
+def vasp_core_values(job_values, status_values, job_id):
+    """Linha da tabela jobs (common.jobs) a partir das colunas de vasp_jobs e vasp_job_status."""
+    energy = (job_values.get("toten") or {}).get("e_0_energy")
+    return dict(
+        package="vasp",
+        job_id=job_id,
+        created_at=job_values.get("created_at"),
+        user_id=job_values.get("user_id"),
+        sys_name=job_values.get("sys_name"),
+        description=job_values.get("description"),
+        status=status_values.get("status"),
+        output_file=status_values.get("xml_file"),
+        content_hash=job_values.get("content_hash"),
+        energy=float(energy) if energy is not None else None,
+        updated_at=job_values.get("updated_at")
+    )
+
+
+def process_and_store_data(xml_file, user_id, sys_name, desc, engine, on_duplicate='upsert'):
+    """
+    :param on_duplicate: 'upsert' reprocessa e atualiza o job com o mesmo conteúdo ou caminho;
+                         'skip' não faz o parsing se o conteúdo já estiver gravado
+    """
     session = create_session(engine)
     if not session:
         print("Erro ao criar a sessão.")
         return
 
     try:
-        vasp_data = parse_vasprun(xml_file)
-        job_data = Job(
-            package="vasp",
-            user_id=user_id,
-            sys_name=sys_name,
-            description=desc,
-            created_at=vasp_data.get("created_at"),
-            updated_at=datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-            encut=vasp_data.get("encut"),
-            num_atoms=vasp_data.get("num_atoms"),
-            pseudopot=vasp_data.get("pseudopotentials"),
-            efermi=vasp_data.get("efermi"),
-            toten=vasp_data.get("toten"),
-            basis_vec=vasp_data.get("basis_vectors"),
-            kpoints=vasp_data.get("kpoints")
-        )
-        job_data = insert_vasp_data(session, job_data)
-
-        try:
-            vasp_status_data = JobStatus(
-                job_id=job_data.job_id,
-                user_id=user_id,
-                xml_file=xml_file,
-                package='vasp',
-                created_at=job_data.created_at,
-                updated_at=datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        if on_duplicate == 'skip' and find_job_by_hash(session, file_content_hash(xml_file)):
+            print(f"{xml_file} já está armazenado (mesmo conteúdo). Nada a fazer.")
+            return
+        # Uma única leitura do vasprun.xml: os passos iônicos ficam num arquivo temporário
+        # local até o job ter job_id
+        with StepSpool() as steps:
+            vasp_data = scan_vasprun(xml_file, with_bands=True, on_step=steps.append)
+            job_values = vasp_job_values(vasp_data, user_id, sys_name, desc)
+            status_values = vasp_status_values(xml_file, job_values.get("created_at"), user_id, vasp_job_status(vasp_data))
+            # Reprocessar a mesma saída atualiza a linha existente em vez de duplicar o job;
+            # o status e a linha da tabela jobs são gravados na mesma transação
+            job_data = upsert_vasp_data(
+                session, xml_file, job_values, status_values,
+                core_row=lambda job: vasp_core_values(job_values, status_values, job.job_id)
             )
-            insert_status_data(session=session, data=vasp_status_data)
-            session.commit()
+            if job_data is None:
+                return
             print("Status do job armazenado com sucesso.")
-        except Exception as e:
-            session.rollback()
-            print(f"exceção {e}")
+
+            # Trajetória completa (relaxação/MD), gravada em blocos sem carregar o arquivo inteiro
+            insert_trajectory(session, job_data.job_id, steps)
 
 
 
@@ -59,7 +111,39 @@ def process_and_store_data(xml_file, user_id, sys_name, desc, engine):
         session.close()
 
 
-def run_pipeline(scf_file, nscf_file=None, user_id=None, sys_name=None, desc=None):
+def backfill_outputs(outputs, engine, batch_size=BATCH_SIZE):
+    """
+    Carga em lote de vasprun.xml já terminados. Cada item de `outputs` é um dict com
+    xml_file, user_id, sys_name e desc; os arquivos são lidos à medida que os lotes são
+    gravados (insert_vasp_batch). A trajetória iônica não é gravada nesse modo.
+    :return: número de jobs inseridos
+    """
+    def records():
+        for item in outputs:
+            xml_file = item["xml_file"]
+            try:
+                vasp_data = parse_vasprun(xml_file, with_bands=True)
+            except Exception as e:
+                print(f"Erro ao processar {xml_file}: {e}")
+                continue
+            yield (
+                vasp_job_values(vasp_data, item["user_id"], item["sys_name"], item.get("desc")),
+                vasp_status_values(xml_file, vasp_data.get("created_at"), item["user_id"], vasp_job_status(vasp_data))
+            )
+
+    session = create_session(engine)
+    try:
+        return insert_vasp_batch(session, records(), batch_size, after_batch=record_core_jobs)
+    finally:
+        session.close()
+
+
+def record_core_jobs(session, batch):
+    """Grava na tabela jobs os jobs de um lote de insert_vasp_batch, na transação do lote."""
+    write_jobs(session, [vasp_core_values(job, status, job_id) for job, status, job_id in batch])
+
+
+def run_pipeline(scf_file, nscf_file=None, user_id=None, sys_name=None, desc=None, on_duplicate='upsert'):
     engine = connect_to_db()
     if not engine:
         print("Erro ao conectar ao DB")
@@ -73,7 +157,8 @@ def run_pipeline(scf_file, nscf_file=None, user_id=None, sys_name=None, desc=Non
         user_id=user_id,
         sys_name=sys_name,
         engine=engine,
-        desc=desc
+        desc=desc,
+        on_duplicate=on_duplicate
     )
 
 
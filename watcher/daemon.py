@@ -0,0 +1,380 @@
+import asyncio
+import importlib
+import os
+import signal
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from common.readers import OutputFollower
+from common.scheduler import PollClock, PollScheduler, MIN_INTERVAL, MAX_INTERVAL
+from .inotify import Inotify, inotify_available, IN_IGNORED
+
+
+DISCOVER_INTERVAL = 30  # s: intervalo entre leituras de pedidos novos
+DEBOUNCE = 1.0  # s: agrupa os eventos de escritas seguidas no mesmo arquivo
+TIMEOUT = 172800  # s: mesmo limite do monitor do QE (dois dias)
+PIPELINE_WORKERS = 4
+
+
+class WatchedJob:
+    """
+    Um job observado pelo daemon: o pedido de origem, os followers das suas saídas,
+    o estimador de progresso do pacote e o PollClock que agenda a próxima verificação.
+    Em modo progressivo (ORCA), um OrcaOutputScanner recebe as mesmas linhas novas e o
+    estado parcial é gravado na linha do job a cada verificação em que a saída cresceu.
+    Jobs do QE têm o histórico SCF atualizado da mesma forma enquanto rodam.
+    """
+
+    def __init__(self, source, key, request, clock, progressive=False):
+        self.source = source
+        self.key = key
+        self.request = request
+        self.package = request["package"]
+        self.started = time.time()
+        self.done = False
+        self.busy = False
+        self.recheck = False
+        self.clock = clock
+        self.progress = None
+        self.scanner = None
+        self.ingested_offset = 0
+        # Recomeços do follower (saída truncada ou substituída) já refletidos no scanner
+        self.scanner_resets = 0
+        # QE: job gravado na primeira verificação e fim da série de accuracies do SCF
+        self.job_id = None
+        self.scf_accuracies = ()
+        if progressive and self.package == 'orca':
+            from orca.parser import OrcaOutputScanner
+            self.scanner = OrcaOutputScanner()
+        self.followers = self._new_followers()
+
+    def _new_followers(self):
+        if self.package == 'quantum_espresso':
+            from quantum_espresso.monitor import DONE_MARKER, ERROR_MARKERS, ScfProgress
+            self.progress = ScfProgress()
+            followers = [OutputFollower(self.request["output"], markers=(DONE_MARKER,) + ERROR_MARKERS,
+                                        on_line=self.progress.feed)]
+            if self.request["nscf_path"]:
+                followers.append(OutputFollower(self.request["nscf_path"], markers=(DONE_MARKER,),
+                                                on_line=self.progress.feed))
+            return followers
+        if self.package == 'orca':
+            from orca.monitor import new_follower, OptProgress
+            self.progress = OptProgress()
+            if self.scanner:
+                return [new_follower(self.request["output"], on_line=self._feed_orca)]
+        else:
+            from vasp.monitor import new_follower, IonicProgress
+            self.progress = IonicProgress()
+        return [new_follower(self.request["output"], on_line=self.progress.feed)]
+
+    def _feed_orca(self, line):
+        follower = self.followers[0]
+        if follower.resets != self.scanner_resets:
+            # O follower voltou ao início do arquivo: o que o scanner já leu seria somado de novo
+            from orca.parser import OrcaOutputScanner
+            from orca.monitor import OptProgress
+            self.scanner_resets = follower.resets
+            self.scanner = OrcaOutputScanner()
+            self.progress = OptProgress()
+            self.ingested_offset = 0
+        self.progress.feed(line)
+        self.scanner.feed(line)
+
+    def has_new_data(self):
+        """True se o scanner progressivo (ORCA) ou o histórico SCF (QE) têm linhas ainda não gravadas."""
+        if self.scanner is None and self.package != 'quantum_espresso':
+            return False
+        return self.followers[0].offset > self.ingested_offset
+
+    @property
+    def paths(self):
+        return [os.path.abspath(follower.file_path) for follower in self.followers]
+
+    def check(self):
+        """
+        Lê o que foi escrito desde a última verificação (fora do event loop).
+        :return: 'COMPLETED', 'FAILED' ou None enquanto o job roda (ou ainda não começou)
+        """
+        output = self.followers[0]
+        if not os.path.exists(output.file_path):
+            return None
+
+        if self.package == 'quantum_espresso':
+            from quantum_espresso.monitor import follow_job
+            nscf = self.followers[1] if len(self.followers) > 1 else None
+            if nscf and not os.path.exists(nscf.file_path):
+                # O nscf só começa depois do scf: um scf concluído ainda não encerra o job
+                return 'FAILED' if follow_job(output) == 'FAILED' else None
+            return follow_job(output, nscf)
+        if self.package == 'orca':
+            from orca.monitor import follow_job
+        else:
+            from vasp.monitor import follow_job
+        return follow_job(output)
+
+    def next_delay(self):
+        """Registra a verificação no PollClock. :return: segundos até a próxima"""
+        size = sum(follower.size or 0 for follower in self.followers)
+        return self.clock.observe(size, self.progress.fraction())
+
+    def run_pipeline(self, engine):
+        """Chama a pipeline do pacote com o engine compartilhado do daemon."""
+        request = self.request
+        pipeline = importlib.import_module(f"{self.package}.pipeline")
+        if self.scanner:
+            # O scanner já leu a saída inteira: a gravação final não relê o arquivo
+            pipeline.ingest_orca_scan(
+                output_file=request["output"], scanner=self.scanner, user_id=request["user_id"],
+                sys_name=request["sys_name"], engine=engine, desc=request["desc"], final=self.done
+            )
+            self.ingested_offset = self.followers[0].offset
+        elif self.package == 'quantum_espresso' and not self.done:
+            # Job ainda rodando: só o histórico SCF é atualizado
+            self.job_id, self.scf_accuracies = pipeline.follow_running_job(
+                scf_file=request["output"], nscf_file=request["nscf_path"], user_id=request["user_id"],
+                sys_name=request["sys_name"], engine=engine, desc=request["desc"],
+                job_id=self.job_id, accuracies=self.scf_accuracies
+            )
+            self.ingested_offset = self.followers[0].offset
+        elif self.package == 'quantum_espresso':
+            pipeline.process_and_store_data(
+                scf_file=request["output"], nscf_file=request["nscf_path"], user_id=request["user_id"],
+                sys_name=request["sys_name"], engine=engine, desc=request["desc"]
+            )
+        elif self.package == 'orca':
+            pipeline.process_and_store_orca_data(
+                output_file=request["output"], user_id=request["user_id"],
+                sys_name=request["sys_name"], engine=engine, desc=request["desc"]
+            )
+        else:
+            pipeline.process_and_store_data(
+                xml_file=request["output"], user_id=request["user_id"],
+                sys_name=request["sys_name"], desc=request["desc"], engine=engine
+            )
+
+
+class JobWatcher:
+    """
+    Observa muitos jobs a partir de um único event loop asyncio.
+    Com inotify (Linux), cada diretório de saída recebe um watch e uma escrita dispara a
+    verificação do job logo em seguida. Além disso, cada job tem a próxima verificação por
+    stat agendada numa fila de prioridade (PollScheduler), com o intervalo dado pelo seu
+    PollClock: jobs parados são verificados cada vez menos, jobs perto do fim, mais.
+    Essa varredura roda sempre, pois escritas feitas por outro nó em NFS/Lustre não geram
+    eventos locais. A leitura das saídas e as pipelines rodam em threads, fora do loop.
+    """
+
+    def __init__(self, sources, engine, min_interval=MIN_INTERVAL, max_interval=MAX_INTERVAL,
+                 workers=PIPELINE_WORKERS, timeout=TIMEOUT, use_inotify=True, progressive=False):
+        self.sources = sources
+        self.progressive = progressive
+        self.engine = engine
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.workers = workers
+        self.timeout = timeout
+        self.use_inotify = use_inotify
+        self.jobs = {}
+        self._by_path = {}
+        self._watches = {}
+        self._watched_dirs = {}
+        self._scheduled = set()
+        self._queue = PollScheduler()
+        self._wakeup = None
+        self._tables_ready = set()
+        self._tables_lock = threading.Lock()
+        self._inotify = None
+        self._loop = None
+        self._pipelines = None
+
+    async def run(self):
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self._pipelines = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='pipeline')
+        if self.use_inotify and inotify_available():
+            try:
+                self._inotify = Inotify()
+                self._loop.add_reader(self._inotify.fileno(), self._on_inotify)
+            except OSError as e:
+                print(f"inotify indisponível ({e}). Usando apenas a varredura por stat.")
+                self._inotify = None
+        mode = "inotify + varredura por stat" if self._inotify else "varredura por stat"
+        print(f"Watcher iniciado ({mode}, intervalos de {self.min_interval:g} a {self.max_interval:g} s).")
+
+        try:
+            await asyncio.gather(self._discover_loop(), self._poll_loop())
+        finally:
+            if self._inotify:
+                self._loop.remove_reader(self._inotify.fileno())
+                self._inotify.close()
+            self._pipelines.shutdown(wait=True)
+
+    async def _discover_loop(self):
+        while True:
+            for source in self.sources:
+                for key, request in await asyncio.to_thread(source.claim):
+                    self._add(source, key, request)
+            await asyncio.sleep(DISCOVER_INTERVAL)
+
+    async def _poll_loop(self):
+        while True:
+            for job in self._queue.pop_due():
+                self._schedule(job, delay=0)
+            delay = self._queue.next_delay()
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.max_interval if delay is None else delay)
+            except asyncio.TimeoutError:
+                pass
+
+    def _push(self, job, delay):
+        self._queue.push(job, delay)
+        self._wakeup.set()
+
+    def _add(self, source, key, request):
+        job_key = (id(source), key)
+        if job_key in self.jobs:
+            return
+        job = WatchedJob(source, key, request, PollClock(self.min_interval, self.max_interval), self.progressive)
+        self.jobs[job_key] = job
+        for path in job.paths:
+            self._by_path.setdefault(path, set()).add(job)
+            self._watch_directory(os.path.dirname(path))
+        print(f"Observando {request['package']}: {request['output']} ({len(self.jobs)} jobs ativos)")
+        self._schedule(job, delay=0)
+
+    def _remove(self, job):
+        self.jobs.pop((id(job.source), job.key), None)
+        self._queue.discard(job)
+        for path in job.paths:
+            jobs = self._by_path.get(path)
+            if jobs is None:
+                continue
+            jobs.discard(job)
+            if not jobs:
+                del self._by_path[path]
+                self._unwatch_directory(os.path.dirname(path))
+
+    def _watch_directory(self, directory):
+        if self._inotify is None or directory in self._watched_dirs:
+            return
+        try:
+            wd = self._inotify.add_watch(directory)
+        except OSError as e:
+            # Diretório inexistente ou limite de watches: o job fica só na varredura
+            print(f"Não foi possível observar {directory} ({e}). Usando a varredura por stat.")
+            return
+        self._watches[wd] = directory
+        self._watched_dirs[directory] = wd
+
+    def _unwatch_directory(self, directory):
+        wd = self._watched_dirs.get(directory)
+        if wd is None or any(os.path.dirname(path) == directory for path in self._by_path):
+            return
+        del self._watched_dirs[directory]
+        del self._watches[wd]
+        self._inotify.rm_watch(wd)
+
+    def _on_inotify(self):
+        for wd, mask, name in self._inotify.read_events():
+            directory = self._watches.get(wd)
+            if directory is None:
+                continue
+            if mask & IN_IGNORED:
+                # Diretório removido: o watch deixou de existir
+                del self._watches[wd]
+                self._watched_dirs.pop(directory, None)
+                continue
+            for job in self._by_path.get(os.path.join(directory, name), ()):
+                self._schedule(job, delay=DEBOUNCE)
+
+    def _schedule(self, job, delay):
+        if job in self._scheduled:
+            return
+        self._scheduled.add(job)
+        self._loop.call_later(delay, lambda: self._loop.create_task(self._check(job)))
+
+    async def _check(self, job):
+        self._scheduled.discard(job)
+        if job.done:
+            return
+        if job.busy:
+            job.recheck = True
+            return
+        job.busy = True
+        try:
+            status = await asyncio.to_thread(job.check)
+        except OSError as e:
+            print(f"Erro ao ler {job.request['output']}: {e}")
+            status = None
+        finally:
+            job.busy = False
+
+        if status is None and time.time() - job.started > self.timeout:
+            status = 'TIMEOUT'
+        if status:
+            await self._finish(job, status)
+            return
+        if job.has_new_data():
+            job.busy = True
+            try:
+                await self._loop.run_in_executor(self._pipelines, self._process, job)
+            except Exception as e:
+                print(f"Erro ao gravar o estado parcial de {job.request['output']}: {e}")
+            finally:
+                job.busy = False
+        self._push(job, job.next_delay())
+        if job.recheck:
+            job.recheck = False
+            self._schedule(job, delay=DEBOUNCE)
+
+    def _prepare_tables(self, package):
+        with self._tables_lock:
+            if package in self._tables_ready:
+                return
+            pipeline = importlib.import_module(f"{package}.pipeline")
+            create = pipeline.create_database_orca if package == 'orca' else pipeline.create_database
+            # Migração que falhou é tentada de novo no próximo job do pacote
+            if create(self.engine):
+                self._tables_ready.add(package)
+
+    def _process(self, job):
+        self._prepare_tables(job.package)
+        job.run_pipeline(self.engine)
+
+    async def _finish(self, job, status):
+        job.done = True
+        self._remove(job)
+        print(f"Job {job.request['output']} terminou com status {status}.")
+        if status == 'TIMEOUT':
+            print("Tempo limite de monitoramento atingido. A pipeline não será executada.")
+        else:
+            try:
+                await self._loop.run_in_executor(self._pipelines, self._process, job)
+            except Exception as e:
+                print(f"Erro ao processar e armazenar os dados: {e}")
+                status = 'FAILED'
+        await asyncio.to_thread(job.source.finish, job.key, status)
+
+
+def run_daemon(sources, engine, **options):
+    """Executa o watcher até ser interrompido (Ctrl+C ou SIGTERM)."""
+    watcher = JobWatcher(sources, engine, **options)
+
+    async def main():
+        task = asyncio.current_task()
+        loop = asyncio.get_running_loop()
+        try:
+            loop.add_signal_handler(signal.SIGTERM, task.cancel)
+        except (NotImplementedError, RuntimeError):
+            pass
+        try:
+            await watcher.run()
+        except asyncio.CancelledError:
+            print("Watcher encerrado.")
+
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        print("Watcher encerrado.")
@@ -0,0 +1,96 @@
+import ctypes
+import ctypes.util
+import errno
+import os
+import struct
+import sys
+
+
+# Constantes de <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+
+# Mudanças relevantes para uma saída sendo escrita dentro de um diretório observado
+OUTPUT_EVENTS = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE_SELF | IN_MOVE_SELF
+
+_EVENT_HEADER = struct.Struct('iIII')
+_READ_SIZE = 64 * 1024
+
+
+def _load_libc():
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        libc.inotify_init1
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+
+_libc = _load_libc()
+
+
+def inotify_available():
+    """True em Linux com inotify na libc."""
+    return _libc is not None
+
+
+class Inotify:
+    """
+    Interface mínima ao inotify do Linux via ctypes, sem dependências externas.
+    O descritor é não bloqueante, para ser registrado no event loop (loop.add_reader).
+    Observa diretórios: os eventos trazem o nome do arquivo alterado dentro deles.
+    """
+
+    def __init__(self):
+        if _libc is None:
+            raise OSError(errno.ENOSYS, "inotify não disponível nesta plataforma")
+        self.fd = _libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+    def fileno(self):
+        return self.fd
+
+    def add_watch(self, path, mask=OUTPUT_EVENTS):
+        """:return: descritor do watch (o mesmo para um diretório já observado)"""
+        wd = _libc.inotify_add_watch(self.fd, os.fsencode(path), ctypes.c_uint32(mask))
+        if wd < 0:
+            err = ctypes.get_errno()
+            # ENOSPC: limite fs.inotify.max_user_watches atingido
+            raise OSError(err, os.strerror(err), path)
+        return wd
+
+    def rm_watch(self, wd):
+        _libc.inotify_rm_watch(self.fd, wd)
+
+    def read_events(self):
+        """:return: lista de (wd, mask, nome) com os eventos pendentes"""
+        try:
+            data = os.read(self.fd, _READ_SIZE)
+        except BlockingIOError:
+            return []
+        events = []
+        pos = 0
+        while pos + _EVENT_HEADER.size <= len(data):
+            wd, mask, _cookie, length = _EVENT_HEADER.unpack_from(data, pos)
+            pos += _EVENT_HEADER.size
+            name = os.fsdecode(data[pos:pos + length].rstrip(b'\0'))
+            pos += length
+            events.append((wd, mask, name))
+        return events
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
@@ -0,0 +1,202 @@
+import json
+import os
+import socket
+import uuid
+from datetime import datetime, timedelta
+from sqlalchemy import Column, Integer, String, DateTime, or_, and_
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.sql import text
+from common.db import get_session, ensure_schema
+
+
+# Nomes aceitos para cada pacote (os mesmos do --package do main.py)
+PACKAGE_ALIASES = {
+    "QE": "quantum_espresso",
+    "qe": "quantum_espresso",
+    "quantum_espresso": "quantum_espresso",
+    "vasp": "vasp",
+    "orca": "orca",
+    "ORCA": "orca"
+}
+
+Base = declarative_base()
+SCHEMA_VERSION = 2
+# s: validade da reserva de um pedido; o daemon a renova a cada leitura da fila
+LEASE_DURATION = 300
+
+
+class WatchRequest(Base):
+    """
+    Fila de jobs a observar pelo daemon. Uma linha por job, com os mesmos argumentos do main.py;
+    state passa de PENDING para WATCHING e termina em COMPLETED, FAILED ou TIMEOUT.
+    Enquanto WATCHING, owner identifica o daemon que observa o job e lease_until é o prazo
+    da reserva: vencido o prazo sem renovação (daemon parado), outro daemon pode retomá-lo.
+    """
+    __tablename__ = 'watch_queue'
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    package = Column(String, nullable=False)
+    output_file = Column(String, nullable=False)
+    nscf_file = Column(String, nullable=True)
+    user_id = Column(String, nullable=False)
+    sys_name = Column(String, nullable=False)
+    desc = Column(String, nullable=True)
+    state = Column(String, nullable=False, default='PENDING', index=True)
+    owner = Column(String, nullable=True)
+    lease_until = Column(DateTime, nullable=True)
+    created_at = Column(DateTime, default=datetime.now)
+    updated_at = Column(DateTime)
+
+
+def normalize_request(data):
+    """
+    Valida um pedido (dict com package, output, user_id, sys_name, nscf_path e desc opcionais).
+    :return: dict normalizado ou None se o pedido for inválido
+    """
+    package = PACKAGE_ALIASES.get(data.get("package"))
+    if package is None or not data.get("output") or not data.get("user_id") or not data.get("sys_name"):
+        print(f"Pedido inválido ignorado: {data}")
+        return None
+    return {
+        "package": package,
+        "output": data["output"],
+        "nscf_path": data.get("nscf_path"),
+        "user_id": str(data["user_id"]),
+        "sys_name": data["sys_name"],
+        "desc": data.get("desc")
+    }
+
+
+class SpoolSource:
+    """
+    Pedidos em arquivos .json num diretório de spool. Cada arquivo novo é movido para
+    active/ ao ser aceito e para done/ ou failed/ quando o job termina; os que estiverem
+    em active/ são retomados se o daemon reiniciar.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        for sub in ('active', 'done', 'failed'):
+            os.makedirs(os.path.join(directory, sub), exist_ok=True)
+        self._resumed = False
+
+    def _load(self, path):
+        try:
+            with open(path) as file:
+                return normalize_request(json.load(file))
+        except (OSError, ValueError) as e:
+            print(f"Erro ao ler o pedido {path}: {e}")
+            return None
+
+    def claim(self):
+        """:return: lista de (chave, pedido) aceitos desde a última chamada"""
+        claimed = []
+        active = os.path.join(self.directory, 'active')
+        if not self._resumed:
+            self._resumed = True
+            for name in sorted(os.listdir(active)):
+                if name.endswith('.json'):
+                    request = self._load(os.path.join(active, name))
+                    if request:
+                        claimed.append((name, request))
+
+        for name in sorted(os.listdir(self.directory)):
+            path = os.path.join(self.directory, name)
+            if not name.endswith('.json') or not os.path.isfile(path):
+                continue
+            request = self._load(path)
+            target = os.path.join(active if request else os.path.join(self.directory, 'failed'), name)
+            os.replace(path, target)
+            if request:
+                claimed.append((name, request))
+        return claimed
+
+    def finish(self, key, state):
+        folder = 'done' if state == 'COMPLETED' else 'failed'
+        try:
+            os.replace(os.path.join(self.directory, 'active', key), os.path.join(self.directory, folder, key))
+        except OSError as e:
+            print(f"Erro ao mover o pedido {key}: {e}")
+
+
+class QueueSource:
+    """
+    Pedidos na tabela watch_queue. As linhas PENDING, e as WATCHING cuja reserva venceu
+    (daemon interrompido), são reservadas com FOR UPDATE SKIP LOCKED e recebem o owner
+    deste daemon e um prazo (lease_until). Cada leitura da fila renova o prazo dos pedidos
+    do próprio daemon, então dois daemons vivos nunca observam o mesmo pedido.
+    """
+
+    def __init__(self, engine, lease_duration=LEASE_DURATION):
+        self.engine = engine
+        self.lease_duration = lease_duration
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        ensure_schema(engine, 'watcher', Base.metadata, SCHEMA_VERSION, upgrade=update_tables)
+
+    def claim(self):
+        claimed = []
+        session = get_session(self.engine)
+        try:
+            now = datetime.now()
+            lease_until = now + timedelta(seconds=self.lease_duration)
+            # Heartbeat: renova a reserva dos pedidos que este daemon já observa
+            session.query(WatchRequest).filter(
+                WatchRequest.owner == self.owner, WatchRequest.state == 'WATCHING'
+            ).update({WatchRequest.lease_until: lease_until}, synchronize_session=False)
+
+            rows = (session.query(WatchRequest)
+                    .filter(or_(
+                        WatchRequest.state == 'PENDING',
+                        and_(WatchRequest.state == 'WATCHING',
+                             or_(WatchRequest.lease_until.is_(None), WatchRequest.lease_until < now))
+                    ))
+                    .order_by(WatchRequest.id)
+                    .with_for_update(skip_locked=True)
+                    .all())
+            for row in rows:
+                request = normalize_request({
+                    "package": row.package,
+                    "output": row.output_file,
+                    "nscf_path": row.nscf_file,
+                    "user_id": row.user_id,
+                    "sys_name": row.sys_name,
+                    "desc": row.desc
+                })
+                row.state = 'WATCHING' if request else 'FAILED'
+                row.owner = self.owner if request else None
+                row.lease_until = lease_until if request else None
+                row.updated_at = now
+                if request:
+                    claimed.append((row.id, request))
+            session.commit()
+        except SQLAlchemyError as e:
+            session.rollback()
+            print(f"Erro ao ler a fila de jobs: {e}")
+        finally:
+            session.close()
+        return claimed
+
+    def finish(self, key, state):
+        session = get_session(self.engine)
+        try:
+            # Só o dono da reserva encerra o pedido (outro daemon pode tê-lo retomado)
+            session.query(WatchRequest).filter_by(id=key, owner=self.owner).update(
+                {WatchRequest.state: state, WatchRequest.owner: None, WatchRequest.lease_until: None,
+                 WatchRequest.updated_at: datetime.now()},
+                synchronize_session=False
+            )
+            session.commit()
+        except SQLAlchemyError as e:
+            session.rollback()
+            print(f"Erro ao atualizar a fila de jobs: {e}")
+        finally:
+            session.close()
+
+
+def update_tables(connection):
+    """Ajustes de schema que o create_all não faz: watch_queue ganha owner e lease_until."""
+    if connection.dialect.name != 'postgresql':
+        return
+    connection.execute(text("ALTER TABLE watch_queue ADD COLUMN IF NOT EXISTS owner VARCHAR"))
+    connection.execute(text("ALTER TABLE watch_queue ADD COLUMN IF NOT EXISTS lease_until TIMESTAMP"))